@@ -0,0 +1,8 @@
+"""
+Benchmarks for the VIRAGO image pipeline.
+Run from the repository root, e.g. python3 -m benchmarks.bench_zprofile
+bench_stages times every pipeline stage on synthetic stacks (see synthetic.py) and writes JSON
+that can be compared across commits:
+    python3 -m benchmarks.bench_stages --out base.json
+    python3 -m benchmarks.bench_stages --compare base.json
+"""
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+from __future__ import division
+from timeit import default_timer
+from skimage.measure import label
+import numpy as np
+from modules import vquant
+from benchmarks.bench_zprofile import synthetic_particles
+"""
+Compares the per-particle bounding box background path that vloop used to run with
+vquant.bbox_background, checking that both give the same cv_bg and perc_contrast.
+"""
+#*********************************************************************************************#
+def _background_loop(shape_df, pic3D):
+    """The per-particle get_bbox_pixels path bbox_background replaced, kept as the reference"""
+    bbox_pixel_dict = {}
+    for z, z_df in shape_df.groupby('max_z_slice'):
+        pic_z = pic3D[z]
+        for i, bbox in z_df.bbox.items():
+            bbox_pixel_dict[i] = vquant.get_bbox_pixels(bbox.copy(), pic_z)
+    bbox_pixels = [bbox_pixel_dict[i] for i in shape_df.index]
+
+    median_bg_list, cv_bg = zip(*map(lambda x: (np.median(x), np.std(x)/np.mean(x)), bbox_pixels))
+
+    return np.array(median_bg_list), np.array(cv_bg)
+#*********************************************************************************************#
+def main(particle_count=2000, repeat=3):
+    pic3D, pic_binary = synthetic_particles(particle_count)
+    pic_label = label(pic_binary, connectivity=2)
+
+    shape_df = vquant.label_props(pic_label, ['label','bbox'], pix_range=(0, np.inf))
+    shape_df['bbox'] = shape_df.bbox.map(vquant.bbox_verts)
+    profile_df = vquant.measure_z_profiles(pic_label, shape_df.label, pic3D)
+    shape_df['max_z_slice'] = profile_df.max_z_slice.values
+    shape_df['greatest_max'] = profile_df.greatest_max.values
+    print("{} particles, stack shape {}".format(len(shape_df), pic3D.shape))
+
+    loop_times, batch_times = [], []
+    for i in range(repeat):
+        start = default_timer()
+        loop_median, loop_cv = _background_loop(shape_df, pic3D)
+        loop_times.append(default_timer() - start)
+
+        start = default_timer()
+        batch_median, batch_cv = vquant.bbox_background(shape_df.bbox, shape_df.max_z_slice, pic3D)
+        batch_times.append(default_timer() - start)
+
+    loop_contrast = (shape_df.greatest_max - loop_median) * 100 / loop_median
+    batch_contrast = (shape_df.greatest_max - batch_median) * 100 / batch_median
+    if not np.array_equal(loop_median, batch_median):
+        raise ValueError("bbox_background does not match the loop for the median background")
+    if not (np.allclose(loop_cv, batch_cv, rtol=1e-9, atol=0)
+            and np.allclose(loop_contrast, batch_contrast, rtol=1e-9, atol=0)):
+        raise ValueError("bbox_background does not match the loop for cv_bg or perc_contrast")
+
+    loop_time, batch_time = min(loop_times), min(batch_times)
+    print("Per-particle loop: {} s".format(round(loop_time,3)))
+    print("bbox_background: {} s".format(round(batch_time,3)))
+    print("Speedup: {}x, outputs match".format(round(loop_time / batch_time,1)))
+
+if __name__ == '__main__':
+    main()
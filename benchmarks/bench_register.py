@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+from __future__ import division
+from timeit import default_timer
+from scipy.ndimage import gaussian_filter
+import numpy as np
+from modules import vimage, vregister
+from benchmarks.synthetic import synthetic_stack
+"""
+Checks that vregister.phase_shift recovers known integer translations exactly, at a single
+level and in pyramid mode, on blurred textures and on synthetic IRIS SD projections (also noisy
+and out of focus), all above PHASE_MIN_CONFIDENCE, while unrelated images stay well under it.
+Also checks that register rejects the (0,0) shift that dust fixed to the camera gives, when the
+markers of the two passes say otherwise, and times phase_shift against ORB matching.
+"""
+##Known (row, col) translations; the second image shows the scene of the first moved by the shift
+SHIFTS = [(13,27), (6,-9), (-40,25), (0,0), (2,55)]
+#*********************************************************************************************#
+def shifted_pair(canvas, shift, size, noise, seed, blur=0):
+    """
+    Two crops of canvas, the second showing the scene of the first moved by shift, with
+    independent noise added to each as two passes would have. blur defocuses the second.
+    """
+    rng = np.random.RandomState(seed)
+    nrows, ncols = size
+    row0, col0 = (canvas.shape[0] - nrows) // 2, (canvas.shape[1] - ncols) // 2
+    img1 = canvas[row0:row0+nrows, col0:col0+ncols]
+    img2 = canvas[row0-shift[0]:row0-shift[0]+nrows, col0-shift[1]:col0-shift[1]+ncols]
+    if blur:
+        img2 = gaussian_filter(img2, blur)
+
+    return (np.float32(img1 + rng.normal(0, noise, size)),
+            np.float32(img2 + rng.normal(0, noise, size)))
+#*********************************************************************************************#
+def blurred_texture(sigma, seed, shape=(1320,2040)):
+    rng = np.random.RandomState(seed)
+    texture = gaussian_filter(rng.rand(*shape), sigma)
+
+    return (texture - texture.min()) * 255 / (texture.max() - texture.min())
+#*********************************************************************************************#
+def iris_projection(seed=0):
+    """SD projection of a synthetic IRIS stack, as vloop registers it, and its marker locations"""
+    pic3D, truth = synthetic_stack('standard', z_slices=9, seed=seed)
+    pic3D_norm, pic3D_rescale, sd_proj_rescale = vimage.contrast_3D(pic3D, **vimage.CONTRAST_SETTINGS,
+                                                                    perc_range=(3,97))
+    return np.float64(sd_proj_rescale), truth['marker_locs']
+#*********************************************************************************************#
+def _check_shifts(name, canvas, size, noise, blur=0, levels=(0,2), seeds=range(3)):
+    """Raises if any known shift is not recovered to the nearest pixel with enough confidence"""
+    min_conf = 1
+    for shift in SHIFTS:
+        for seed in seeds:
+            img1, img2 = shifted_pair(canvas, shift, size, noise, seed, blur=blur)
+            for level in levels:
+                found, conf = vregister.phase_shift(img1, img2, levels=level)
+                if (tuple(int(round(coord)) for coord in found) != shift) or (conf < vregister.PHASE_MIN_CONFIDENCE):
+                    raise ValueError("{}: phase_shift(levels={}) gave {} (confidence {}) for a shift of {}".format(
+                                     name, level, tuple(np.round(found, 2)), round(conf, 3), shift))
+                min_conf = min(min_conf, conf)
+    print("{}: every shift recovered exactly at levels {} (lowest confidence {})".format(name, levels,
+                                                                                        round(min_conf, 2)))
+#*********************************************************************************************#
+def main(repeat=5):
+    for sigma in (3, 8):
+        for seed in range(2):
+            _check_shifts("Texture (blur {}, seed {})".format(sigma, seed), blurred_texture(sigma, seed),
+                          size=(1200,1920), noise=2)
+
+    sd_proj, marker_locs = iris_projection()
+    _check_shifts("IRIS SD projection", sd_proj, size=(1060,1780), noise=6)
+    _check_shifts("Noisy, out of focus IRIS SD projection", sd_proj, size=(1060,1780), noise=30, blur=3)
+
+    rng = np.random.RandomState(9)
+    unrelated = [blurred_texture(3, seed=9, shape=sd_proj.shape), blurred_texture(8, seed=10, shape=sd_proj.shape),
+                 rng.normal(128, 6, sd_proj.shape), rng.normal(128, 30, sd_proj.shape)]
+    max_conf = max(vregister.phase_shift(sd_proj + rng.normal(0, 6, sd_proj.shape), img, levels=level)[1]
+                   for img in unrelated for level in (0, 2))
+    if max_conf >= vregister.PHASE_MIN_CONFIDENCE / 2:
+        raise ValueError("Unrelated images registered with confidence {}".format(max_conf))
+    print("Unrelated images rejected (highest confidence {}, cutoff {})".format(round(max_conf, 3),
+                                                                               vregister.PHASE_MIN_CONFIDENCE))
+
+    ##Dust on the camera stays put while the chip moves, so it pulls the correlation to (0,0)
+    shift, size = (13,27), (1060,1780)
+    img1, img2 = shifted_pair(sd_proj, shift, size, noise=6, seed=0)
+    dust = gaussian_filter(np.float64(rng.rand(*size) < 0.002), 4)
+    dust *= 160 / dust.max()
+    row0, col0 = (sd_proj.shape[0] - size[0]) // 2, (sd_proj.shape[1] - size[1]) // 2
+    locs1 = [(row - row0, col - col0) for row, col in marker_locs]
+    locs2 = [(row + shift[0], col + shift[1]) for row, col in locs1]
+    found, method, confidences = vregister.register(img1 - dust, img2 - dust, markers=(locs1, locs2))
+    if (found is not None) and (tuple(int(round(coord)) for coord in found) != shift):
+        raise ValueError("Camera dust gave a shift of {} ({}) for {}".format(found, confidences, shift))
+    print("Shift pulled to (0,0) by camera dust rejected by the markers ({})".format(confidences))
+
+    img1, img2 = shifted_pair(sd_proj, (6,-9), size=(1060,1780), noise=6, seed=0)
+    img1, img2 = np.uint8(img1.clip(0,255)), np.uint8(img2.clip(0,255))
+    phase_times, orb_times = [], []
+    for i in range(repeat):
+        start = default_timer()
+        vregister.phase_shift(img1, img2)
+        phase_times.append(default_timer() - start)
+
+        start = default_timer()
+        vimage.measure_shift_ORB(img1, img2, ham_thresh=10, show=False)
+        orb_times.append(default_timer() - start)
+
+    print("phase_shift: {} s".format(round(min(phase_times),3)))
+    print("measure_shift_ORB: {} s".format(round(min(orb_times),3)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+from __future__ import division
+from timeit import default_timer
+import numpy as np
+import pandas as pd
+import warnings
+from modules import vquant, vgraph
+"""
+Compares the per-spot density_normalizer and per-spot-type average_spot_data loops that the
+drivers used to run with the grouped vquant.density_normalizer and vgraph.average_spot_data,
+on a synthetic chip, checking that both give the same numbers.
+"""
+#*********************************************************************************************#
+def synthetic_spot_df(spot_count=150, pass_count=30, seed=0):
+    """spot_df as the drivers build it, with missing densities, unrecorded times and invalid passes"""
+    rng = np.random.RandomState(seed)
+    spot_df = pd.DataFrame({'spot_number': np.repeat(np.arange(1, spot_count + 1), pass_count),
+                            'scan_number': np.tile(np.arange(1, pass_count + 1), spot_count),
+                            'spot_type'  : np.repeat(rng.choice(['CD63','CD81','CD9','MIgG'], spot_count), pass_count),
+                            'scan_time'  : np.round(np.tile(np.arange(pass_count) * 5.0, spot_count)
+                                                    + rng.normal(0, 0.5, spot_count * pass_count), 2),
+                            'validity'   : rng.rand(spot_count * pass_count) > 0.1
+    })
+    spot_df['kparticle_density'] = np.round(spot_df.groupby('spot_number').scan_number.cumsum()
+                                            * rng.uniform(0.01, 0.2, len(spot_df)), 3)
+    spot_df.loc[rng.rand(len(spot_df)) < 0.05, 'kparticle_density'] = np.nan
+    spot_df.loc[rng.rand(len(spot_df)) < 0.05, 'scan_time'] = 0
+    ##Spots that only have data from a later pass, and one with none at all
+    spot_df.loc[(spot_df.spot_number == 2) & (spot_df.scan_number <= 3), 'kparticle_density'] = np.nan
+    spot_df.loc[spot_df.spot_number == 3, 'kparticle_density'] = np.nan
+
+    return spot_df
+#*********************************************************************************************#
+def _density_normalizer_loop(spot_df, spot_counter):
+    """The per-spot loop density_normalizer replaced, kept as the reference"""
+    normalized_density = []
+    for x in range(1, spot_counter + 1):
+        kp_df = spot_df.kparticle_density[(spot_df.spot_number == x)].reset_index(drop=True)
+        pass_count = len(kp_df)
+        j = 0
+        if pass_count > 1:
+            while np.isnan(kp_df[j]):
+                j += 1
+                if (j == pass_count - 1):
+                    break
+        normalized_density.append([kp_df[i] - kp_df[j] for i in range(0,len(kp_df))])
+
+    return [item for sublist in normalized_density for item in sublist]
+#*********************************************************************************************#
+def _average_spot_data_loop(spot_df, pass_counter):
+    """The spot type by pass loop average_spot_data replaced, kept as the reference"""
+    averaged_df = []
+    spot_list = []
+    for val in spot_df.spot_type:
+        if val not in spot_list:
+            spot_list.append(val)
+
+    for spot in spot_list:
+        sub_df = spot_df[(spot_df.spot_type == spot) & (spot_df.validity == True)]
+        avg_time, avg_kpd, avg_nd, std_kpd, std_nd = [],[],[],[],[]
+        for i in range(1,pass_counter+1):
+            subsub_df = sub_df[sub_df.scan_number == i]
+            avg_time.append(round(np.nanmean(subsub_df.scan_time.iloc[np.flatnonzero(subsub_df.scan_time)]),2))
+            avg_kpd.append(round(np.nanmean(subsub_df.kparticle_density),2))
+            std_kpd.append(round(np.nanstd(subsub_df.kparticle_density),3))
+            avg_nd.append(round(np.nanmean(subsub_df.normalized_density),2))
+            std_nd.append(round(np.nanstd(subsub_df.normalized_density),3))
+        averaged_df.append(pd.DataFrame({'scan_number': np.arange(1,pass_counter+1),
+                                         'spot_type': [spot] * pass_counter,
+                                         'avg_time': avg_time,
+                                         'avg_density': avg_kpd,
+                                         'std_density': std_kpd,
+                                         'avg_norm_density': avg_nd,
+                                         'std_norm_density': std_nd
+        }))
+
+    return pd.concat(averaged_df, ignore_index=True)
+#*********************************************************************************************#
+def main(spot_count=150, pass_count=30):
+    spot_df = synthetic_spot_df(spot_count, pass_count)
+    print("{} spots x {} passes".format(spot_count, pass_count))
+
+    start = default_timer()
+    loop_norm = _density_normalizer_loop(spot_df, spot_count)
+    norm_loop_time = default_timer() - start
+    start = default_timer()
+    batch_norm = vquant.density_normalizer(spot_df, spot_count)
+    norm_batch_time = default_timer() - start
+    if not np.allclose(loop_norm, batch_norm, rtol=0, atol=1e-12, equal_nan=True):
+        raise ValueError("density_normalizer does not match the loop")
+    spot_df['normalized_density'] = batch_norm
+
+    with warnings.catch_warnings():
+        ##np.nanmean warns about the empty passes the loop averages
+        warnings.simplefilter("ignore", RuntimeWarning)
+        start = default_timer()
+        loop_avg_df = _average_spot_data_loop(spot_df, pass_count)
+        avg_loop_time = default_timer() - start
+    start = default_timer()
+    batch_avg_df = vgraph.average_spot_data(spot_df, pass_count)
+    avg_batch_time = default_timer() - start
+    ##Groups are summed in a different order than np.nanmean does, which can move a value sitting
+    ##on a rounding boundary by one step in the last decimal
+    pd.testing.assert_frame_equal(loop_avg_df, batch_avg_df, check_dtype=False, check_exact=False,
+                                  rtol=0, atol=0.0101
+    )
+    rounding_steps = (loop_avg_df.iloc[:,2:] - batch_avg_df.iloc[:,2:]).abs().gt(1e-9).sum().sum()
+
+    print("density_normalizer: loop {} s, grouped {} s".format(round(norm_loop_time,3), round(norm_batch_time,3)))
+    print("average_spot_data: loop {} s, grouped {} s".format(round(avg_loop_time,3), round(avg_batch_time,3)))
+    print("Outputs match ({} of {} values one rounding step apart)".format(rounding_steps,
+                                                                          batch_avg_df.iloc[:,2:].size))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+from __future__ import division
+from contextlib import contextmanager
+from timeit import default_timer
+from scipy.ndimage import gaussian_filter, binary_fill_holes
+from skimage.feature import shape_index
+from skimage.measure import perimeter
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import cv2
+import argparse, json, os, platform, shutil, subprocess, sys, tempfile, warnings
+from modules import vpipes, vimage, vquant, vgraph, vfilo, vspot, vregister, vcache
+from benchmarks.synthetic import synthetic_stack, FRAMES
+"""
+Times each stage of the per-pass pipeline on synthetic IRIS stacks and writes the results as JSON.
+The stages follow the first pass of vloop.main_loop, plus the registration done on later passes.
+
+    python3 -m benchmarks.bench_stages --out base.json
+    python3 -m benchmarks.bench_stages --compare base.json
+
+With --compare, stages that got slower than --tolerance times the baseline are listed and the
+exit status is 1, so the suite can gate a commit.
+"""
+##Magnification and camera pixel size used for each frame, as in the driver scripts
+OPTICS = {'standard': (40, 5.86),
+          'highres' : (44, 3.45)
+}
+SPOT_RADII = {'standard': (350, 601),
+               'highres' : (700, 1301)
+}
+##Stages a vloop cache hit skips, and the cache stages a warm run does instead
+CACHED_STAGES = ('contrast_3D','measure_focal_plane','shape_index','classify_shape')
+#*********************************************************************************************#
+#
+#           SUBROUTINES
+#
+#*********************************************************************************************#
+@contextmanager
+def _stage(stage_times, name):
+    start = default_timer()
+    yield
+    stage_times.setdefault(name, []).append(default_timer() - start)
+#*********************************************************************************************#
+def _write_tiff(pic3D, tiff_file):
+    with vpipes.TiffWriter(tiff_file, imagej=True) as tif_img:
+        for img in pic3D:
+            tif_img.save(img, compress=0)
+#*********************************************************************************************#
+def run_pipeline(tiff_file, truth, frame, out_dir, stage_times, perc_range=(3,97), cv_cutoff=0.5, threads=1):
+    """Runs one pass through every stage, adding each stage's wall time to stage_times"""
+    mag, cam_micron_per_pix = OPTICS[frame]
+    pix_per_um = mag / cam_micron_per_pix
+    spacing = 1 / pix_per_um
+    marker = truth['marker']
+
+    with _stage(stage_times, 'load'):
+        pic3D = vpipes.LazyStack([tiff_file], True)
+
+    with _stage(stage_times, 'contrast_3D'):
+        pic3D_norm, pic3D_rescale, sd_proj_rescale = vimage.contrast_3D(pic3D, perc_range=perc_range, threads=threads,
+                                                                        **vimage.CONTRAST_SETTINGS)
+
+    with _stage(stage_times, 'marker_finder'):
+        marker_locs = vimage.marker_finder(pic3D_rescale[0], marker=marker, thresh=0.6)
+
+    with _stage(stage_times, 'measure_focal_plane'):
+        pos_plane_list = vquant.measure_focal_plane(pic3D_norm, marker_locs, True, marker_shape=marker.shape,
+                                                    threads=threads)
+    pos_plane = max(pos_plane_list) if pos_plane_list else truth['focal_plane']
+
+    with _stage(stage_times, 'spot_finder'):
+        spot_coords = vspot.find_spot(sd_proj_rescale, SPOT_RADII[frame], min_dist=500)
+
+    nrows, ncols = sd_proj_rescale.shape
+    row, col = np.ogrid[:nrows,:ncols]
+    disk_mask = ((col - spot_coords[0])**2 + (row - spot_coords[1])**2 > (spot_coords[2] - 25)**2)
+
+    with _stage(stage_times, 'marker_masker'):
+        marker_mask, found_markers = vimage.marker_masker(pic3D_rescale[0], marker_locs, marker)
+    full_mask = disk_mask + marker_mask
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        with _stage(stage_times, 'shape_index'):
+            shapedex = shape_index(pic3D_rescale[pos_plane])
+            shapedex = np.ma.array(shapedex, mask=full_mask).filled(fill_value=np.nan)
+            shapedex_gauss = gaussian_filter(shapedex, sigma=vquant.SHAPE_SMOOTH_SIGMA)
+
+    ##In-liquid antibody spots
+    background, ridge, sphere, ridge_s = (vquant.SHAPE_CLASSES[name] for name in
+                                          ('background', 'ridge', 'sphere', 'ridge_s'))
+    with _stage(stage_times, 'classify_shape'):
+        bg_mask = vquant.classify_shape_mask(shapedex, sd_proj_rescale, background[0], delta=background[1],
+                                             intensity=0)
+        sd_proj_bg = sd_proj_rescale[bg_mask]
+        bg_median, bg_stdev = np.median(sd_proj_bg), np.std(sd_proj_bg)
+        ridge_thresh, sphere_thresh, ridge_thresh_s = vquant.shape_thresholds(bg_median, bg_stdev, True, False)
+        ridge_mask = vquant.classify_shape_mask(shapedex, sd_proj_rescale, ridge[0], delta=ridge[1],
+                                                intensity=ridge_thresh)
+        sphere_mask = vquant.classify_shape_mask(shapedex, sd_proj_rescale, sphere[0], delta=sphere[1],
+                                                 intensity=sphere_thresh)
+        ridge_mask_s = vquant.classify_shape_mask(shapedex_gauss, sd_proj_rescale, ridge_s[0], delta=ridge_s[1],
+                                                  intensity=ridge_thresh_s)
+        pix_mask = ridge_mask | sphere_mask
+        ridge_mask_s = pix_mask & ~ridge_mask_s
+        pic_binary = binary_fill_holes(pix_mask)
+
+    ##The entries vloop writes for this pass, and what a rerun reads back instead of recomputing them
+    cache_dir = os.path.join(out_dir, 'cache')
+    with _stage(stage_times, 'cache_key'):
+        contrast_key = vcache.stage_key('contrast', vcache.file_key(pic3D.files), pic3D.mirror, perc_range,
+                                        vimage.CONTRAST_SETTINGS)
+        focal_key = vcache.stage_key('focal', contrast_key, marker_locs, True, marker.shape)
+        classify_key = vcache.stage_key('classify', contrast_key, pos_plane, full_mask, True, False,
+                                        (vquant.SHAPE_CLASSES, vquant.SHAPE_SMOOTH_SIGMA, vquant.SHAPE_THRESHOLDS))
+    with _stage(stage_times, 'cache_save'):
+        vcache.save(cache_dir, contrast_key, 2**30, sd_proj_rescale=sd_proj_rescale,
+                    marker_plane=pic3D_rescale[0])
+        vcache.save(cache_dir, focal_key, 2**30, pos_plane=pos_plane, pic_rescale_pos=pic3D_rescale[pos_plane])
+        vcache.save(cache_dir, classify_key, 2**30, pix_area=np.count_nonzero(~np.isnan(shapedex)),
+                    sd_proj_bg_median=bg_median, sd_proj_bg_stdev=bg_stdev, ridge_mask=ridge_mask,
+                    sphere_mask=sphere_mask, ridge_mask_s=ridge_mask_s, pic_binary=pic_binary)
+    with _stage(stage_times, 'cache_load'):
+        for key in (contrast_key, focal_key, classify_key):
+            if vcache.load(cache_dir, key) is None:
+                raise ValueError("Cache entry {} could not be read back".format(key))
+
+    prop_list = ['label','coords','area','centroid','moments_central','bbox',
+                 'filled_image','major_axis_length','minor_axis_length']
+    with _stage(stage_times, 'binary_data_extraction'):
+        shape_df, pic_label = vquant.binary_data_extraction(pic_binary, pic3D[pos_plane], prop_list,
+                                                            pix_range=(3,500), return_label=True)
+        shape_df['pass_number'] = 1
+        shape_df['bbox'] = shape_df.bbox.map(vquant.bbox_verts)
+    if shape_df.empty:
+        return 0
+
+    with _stage(stage_times, 'label_pixel_counts'):
+        shape_df['filo_points'] = (vquant.label_pixel_counts(pic_label, ridge_mask, shape_df.label)
+                                   + vquant.label_pixel_counts(pic_label, ridge_mask_s, shape_df.label) * 0.15)
+        shape_df['round_points'] = vquant.label_pixel_counts(pic_label, sphere_mask, shape_df.label)
+
+    with _stage(stage_times, 'measure_z_profiles'):
+        profile_df = vquant.measure_z_profiles(pic_label, shape_df.label, pic3D)
+    for col_name in ('max_z_slice','max_z_stack','z_intensity','greatest_max','validity'):
+        shape_df[col_name] = profile_df[col_name].values
+
+    with _stage(stage_times, 'bbox_background'):
+        median_bg, shape_df['cv_bg'] = vquant.bbox_background(shape_df.bbox, shape_df.max_z_slice, pic3D)
+        shape_df['perc_contrast'] = (shape_df['greatest_max'] - median_bg) * 100 / median_bg
+
+    with _stage(stage_times, 'remove_overlapping_objs'):
+        shape_df = vquant.remove_overlapping_objs(shape_df, radius=10)
+
+    with _stage(stage_times, 'shape_metrics'):
+        shape_df['circularity'] = list(map(lambda A,P: round((4*np.pi*A)/(perimeter(P)**2),4),
+                                           shape_df.area, shape_df.filled_image))
+        shape_df['ellipticity'] = round(shape_df.major_axis_length/shape_df.minor_axis_length,4)
+        shape_df['eccentricity'] = shape_df.moments_central.map(vquant.eccentricity)
+        shape_df['filo_score'] = (shape_df['filo_points'] - shape_df['round_points']) / shape_df['area']
+
+    with _stage(stage_times, 'measure_fiber_length'):
+        filolen_df = pd.DataFrame([vfilo.measure_fiber_length(coords, spacing=spacing)
+                                   for coords in shape_df.coords],
+                                  columns=['fiber_length','vertices'], index=shape_df.index)
+    shape_df = pd.concat([shape_df, filolen_df], axis=1)
+
+    with _stage(stage_times, 'gen_particle_image'):
+        vgraph.gen_particle_image(sd_proj_rescale, shape_df, spot_coords, pix_per_um=pix_per_um,
+                                  show_particles=True, cv_cutoff=cv_cutoff, r2_cutoff=0,
+                                  scalebar=15, markers=marker_locs, exo_toggle=False)
+        plt.savefig(os.path.join(out_dir, 'particles.png'), **vgraph.PARTICLE_PNG_SETTINGS)
+        plt.clf(); plt.close('all')
+
+    ##A later pass is the same chip moved by a few pixels
+    shifted_img = np.roll(sd_proj_rescale, (6, -9), axis=(0,1))
+    with _stage(stage_times, 'measure_shift_ORB'):
+        vimage.measure_shift_ORB(sd_proj_rescale, shifted_img, ham_thresh=10, show=False)
+
+    with _stage(stage_times, 'register'):
+        valid_shift, reg_method, reg_conf = vregister.register(sd_proj_rescale, shifted_img)
+    valid_shift = tuple(round(x) for x in valid_shift) if valid_shift is not None else (0,0)
+
+    with _stage(stage_times, 'overlayer'):
+        vimage.overlay_difference(sd_proj_rescale, shifted_img, valid_shift)
+
+    return len(shape_df)
+#*********************************************************************************************#
+def bench_frame(frame, repeat=3, particle_count=800, z_slices=25, seed=0, threads=1):
+    """Times every stage repeat times on one synthetic stack; returns the per-frame result dict"""
+    out_dir = tempfile.mkdtemp(prefix='virago_bench_')
+    try:
+        print("Generating {} stack {}...".format(frame, (z_slices,) + FRAMES[frame]))
+        pic3D, truth = synthetic_stack(frame, z_slices=z_slices, particle_count=particle_count, seed=seed)
+        tiff_file = os.path.join(out_dir, 'BENCH.001.001.tif')
+        _write_tiff(pic3D, tiff_file)
+        del pic3D
+
+        stage_times = {}
+        for run in range(repeat):
+            particles_found = run_pipeline(tiff_file, truth, frame, out_dir, stage_times, threads=threads)
+            print("Run {}: {} s, {} particles".format(run + 1,
+                                                     round(sum(times[-1] for times in stage_times.values()),2),
+                                                     particles_found))
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+    stages = {name: {'median': float(np.median(times)), 'min': float(np.min(times)), 'runs': times}
+              for name, times in stage_times.items()}
+
+    ##A first run computes the cached stages and writes their entries; a rerun only keys and reads them
+    cache_times = {'cold': float(sum(stages[name]['median'] for name in CACHED_STAGES + ('cache_key','cache_save'))),
+                   'warm': float(stages['cache_key']['median'] + stages['cache_load']['median'])
+    }
+    print("Cached stages: cold run {} s, warm run {} s".format(round(cache_times['cold'],3),
+                                                               round(cache_times['warm'],3)))
+
+    return {'shape': [z_slices] + list(FRAMES[frame]),
+            'particles': particle_count,
+            'particles_found': particles_found,
+            'total': float(sum(stage['median'] for stage in stages.values())),
+            'cache': cache_times,
+            'stages': stages
+    }
+#*********************************************************************************************#
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+#*********************************************************************************************#
+def compare_results(results, baseline, tolerance=1.25, min_time=0.05):
+    """Prints the per-stage ratio to the baseline; returns the stages slower than tolerance"""
+    regressions = []
+    for frame, frame_result in results['frames'].items():
+        if frame not in baseline['frames']:
+            continue
+        base_stages = baseline['frames'][frame]['stages']
+        print("\n{} frame (baseline {}):".format(frame, baseline.get('commit')))
+        for name, stage in frame_result['stages'].items():
+            if name not in base_stages:
+                print("  {:<26}{:>10.3f} s   (new)".format(name, stage['median']))
+                continue
+            base_time = base_stages[name]['median']
+            ratio = stage['median'] / base_time if base_time > 0 else float('inf')
+            flag = ''
+            if (ratio > tolerance) and (stage['median'] > min_time):
+                flag = '  <-- slower'
+                regressions.append((frame, name, ratio))
+            print("  {:<26}{:>10.3f} s {:>8.2f}x{}".format(name, stage['median'], ratio, flag))
+
+    return regressions
+#*********************************************************************************************#
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-stage timings of the VIRAGO pipeline on synthetic stacks")
+    parser.add_argument("--frames", nargs='+', choices=sorted(FRAMES), default=sorted(FRAMES, reverse=True))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--particles", type=int, default=800)
+    parser.add_argument("--z-slices", dest='z_slices', type=int, default=25)
+    parser.add_argument("--threads", type=int, default=1,
+                        help="Threads for the per-plane stages (0 = one per CPU core)")
+    parser.add_argument("--out", default=None, help="JSON file to write the results to")
+    parser.add_argument("--compare", default=None, help="Baseline JSON file to compare against")
+    parser.add_argument("--tolerance", type=float, default=1.25,
+                        help="Slowdown ratio that counts as a regression")
+    parser.add_argument("--min-time", dest='min_time', type=float, default=0.05,
+                        help="Stages faster than this (s) are too noisy to count as regressions")
+    args = parser.parse_args(argv)
+
+    results = {'commit': _git_commit(),
+               'python': platform.python_version(),
+               'numpy': np.__version__,
+               'opencv': cv2.__version__,
+               'threads': args.threads,
+               'frames': {}
+    }
+    for frame in args.frames:
+        results['frames'][frame] = bench_frame(frame, repeat=args.repeat,
+                                               particle_count=args.particles, z_slices=args.z_slices,
+                                               threads=args.threads)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("Results written to {}".format(args.out))
+    else:
+        print(json.dumps({frame: {name: round(stage['median'],4) for name, stage in result['stages'].items()}
+                          for frame, result in results['frames'].items()}, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline, tolerance=args.tolerance, min_time=args.min_time)
+        if regressions:
+            print("\n{} stage(s) slower than {}x the baseline".format(len(regressions), args.tolerance))
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
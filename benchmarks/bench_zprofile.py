@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+from __future__ import division
+from timeit import default_timer
+from skimage.measure import label, regionprops
+import numpy as np
+from modules.vquant import measure_z_profiles
+"""
+Compares the per-particle z-profile loop that vloop used to run with vquant.measure_z_profiles
+on a synthetic 1000-particle image, checking that both give the same numbers.
+"""
+#*********************************************************************************************#
+def synthetic_particles(particle_count=1000, shape=(1200,1920), z_slices=25, seed=0):
+    """Scatters small non-touching blobs over a noisy uint16 stack with a bright peak slice"""
+    rng = np.random.RandomState(seed)
+    pic3D = rng.normal(10000, 300, (z_slices,) + shape).clip(0, 65535).astype(np.uint16)
+    pic_binary = np.zeros(shape, dtype=bool)
+
+    grid_rows, grid_cols = shape[0] // 30, shape[1] // 30
+    cells = rng.choice(grid_rows * grid_cols, particle_count, replace=False)
+    for cell in cells:
+        r, c = (cell // grid_cols) * 30 + 15, (cell % grid_cols) * 30 + 15
+        rad = rng.randint(2,7)
+        rr, cc = np.ogrid[-rad:rad+1, -rad:rad+1]
+        blob = (rr**2 + cc**2) <= rad**2
+        pic_binary[r-rad:r+rad+1, c-rad:c+rad+1] |= blob
+        peak = rng.randint(0, z_slices)
+        profile = (2000 * np.exp(-(np.arange(z_slices) - peak)**2 / 8.0)).astype(np.uint16)
+        pic3D[:, r-rad:r+rad+1, c-rad:c+rad+1] += (profile[:,None,None] * blob).astype(np.uint16)
+
+    return pic3D, pic_binary
+#*********************************************************************************************#
+def _zprofile_loop(coords_list, pic3D, diff_img=None):
+    """The per-particle loop measure_z_profiles replaced, kept as the reference"""
+    greatest_max_list, max_z_stacks, max_z_slice_list, z_intensity_list = [],[],[],[]
+    shape_validity, intensity_increase_list = [],[]
+    for coord_array in coords_list:
+        all_z_stacks = np.array([pic3D[:,coords[0],coords[1]] for coords in coord_array])
+        greatest_max = np.max(all_z_stacks)
+        max_z_stack = all_z_stacks[np.where(all_z_stacks == np.max(all_z_stacks))[0][0]].tolist()
+        shape_validity.append(max_z_stack[0] >= max_z_stack[-1])
+        maxmax_z = max(max_z_stack)
+        max_z_slice_list.append(max_z_stack.index(maxmax_z))
+        z_intensity_list.append((maxmax_z - min(max_z_stack))*100)
+        max_z_stacks.append(max_z_stack)
+        greatest_max_list.append(greatest_max)
+        if diff_img is not None:
+            intensity_increase_list.append(max([diff_img[coords[0],coords[1]] for coords in coord_array]))
+
+    return {'greatest_max': greatest_max_list, 'max_z_stack': max_z_stacks,
+            'max_z_slice': max_z_slice_list, 'z_intensity': z_intensity_list,
+            'validity': shape_validity, 'intensity_increase': intensity_increase_list}
+#*********************************************************************************************#
+def main(particle_count=1000):
+    pic3D, pic_binary = synthetic_particles(particle_count)
+    diff_img = pic3D[-1].astype(float) - pic3D[0].astype(float)
+
+    pic_label = label(pic_binary, connectivity=2)
+    props = regionprops(pic_label)
+    labels = [region.label for region in props]
+    coords_list = [[tuple(x) for x in region.coords] for region in props]
+    print("{} particles, stack shape {}".format(len(labels), pic3D.shape))
+
+    start = default_timer()
+    loop_data = _zprofile_loop(coords_list, pic3D, diff_img)
+    loop_time = default_timer() - start
+
+    start = default_timer()
+    profile_df = measure_z_profiles(pic_label, labels, pic3D, diff_img=diff_img)
+    batch_time = default_timer() - start
+
+    for col, values in loop_data.items():
+        if not np.array_equal(np.array(values), np.array(profile_df[col].tolist())):
+            raise ValueError("measure_z_profiles does not match the loop for {}".format(col))
+
+    print("Per-particle loop: {} s".format(round(loop_time,3)))
+    print("measure_z_profiles: {} s".format(round(batch_time,3)))
+    print("Speedup: {}x, outputs identical".format(round(loop_time / batch_time,1)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+from __future__ import division
+from scipy.ndimage import gaussian_filter
+from skimage import io as skio
+import numpy as np
+import os
+"""
+Synthetic IRIS z-stacks for benchmarking: a shaded background, an antibody spot disk,
+IRIS markers that come into focus partway through the stack, and point and filament
+particles whose contrast follows a defocus profile through z.
+"""
+##Frame shapes the pipeline handles: the standard camera, and the 6981120-pixel high-res camera
+FRAMES = {'standard': (1200, 1920),
+          'highres' : (2020, 3456)
+}
+##Spot radii that fall inside the HoughCircles radius range vloop uses for each frame
+SPOT_RADIUS = {'standard': 475,
+               'highres' : 1000
+}
+MARKER_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                           'images', 'IRISmarker_new.tif'
+)
+#*********************************************************************************************#
+#
+#           SUBROUTINES
+#
+#*********************************************************************************************#
+def _particle_patch(rng, kind):
+    """Unit-amplitude footprint of one particle: a small PSF spot, or a short curved filament"""
+    if kind == 'point':
+        patch = np.zeros((11,11))
+        patch[5,5] = 1
+        return gaussian_filter(patch, sigma=rng.uniform(1.0, 1.6)) / gaussian_filter(patch, 1.0).max()
+
+    length = rng.randint(10, 30)
+    angle = rng.uniform(0, np.pi)
+    bend = rng.uniform(-0.04, 0.04)
+    t = np.arange(length)
+    rows = t * np.sin(angle) + bend * (t - length/2)**2 * np.cos(angle)
+    cols = t * np.cos(angle) - bend * (t - length/2)**2 * np.sin(angle)
+    rows, cols = np.round(rows - rows.min()).astype(int) + 4, np.round(cols - cols.min()).astype(int) + 4
+
+    patch = np.zeros((rows.max() + 5, cols.max() + 5))
+    patch[rows, cols] = 1
+    return gaussian_filter(patch, sigma=0.8) / gaussian_filter(patch, sigma=0.8).max()
+#*********************************************************************************************#
+def synthetic_stack(frame='standard', z_slices=25, particle_count=800, filament_frac=0.15,
+                    shift=(0,0), seed=0, marker=None):
+    """
+    Builds a uint16 stack of shape (z_slices,) + FRAMES[frame].
+    Returns the stack and a dict with the marker template, the marker locations,
+    the spot (x, y, radius), the focal plane and the particle centers.
+    shift moves everything on the chip by (rows, cols), to mimic a later pass.
+    """
+    rng = np.random.RandomState(seed)
+    nrows, ncols = FRAMES[frame]
+    if marker is None:
+        marker = skio.imread(MARKER_FILE)
+
+    ##Smooth illumination falloff, like the mirror image corrects for
+    row, col = np.ogrid[:nrows, :ncols]
+    shading = 1 - 0.15 * (((row - nrows/2) / nrows)**2 + ((col - ncols/2) / ncols)**2)
+
+    spot_r = SPOT_RADIUS[frame]
+    spot_x, spot_y = ncols/2 + shift[1], nrows/2 + shift[0]
+    spot_dist = np.sqrt((col - spot_x)**2 + (row - spot_y)**2)
+    spot = 0.03 / (1 + np.exp((spot_dist - spot_r) / 3.0))
+
+    background = (12000 * shading).astype(np.float32)
+    spot_img = (12000 * spot).astype(np.float32)
+
+    marker_h, marker_w = marker.shape
+    edge = 60
+    marker_locs = [(edge + marker_h//2 + shift[0], edge + marker_w//2 + shift[1]),
+                   (edge + marker_h//2 + shift[0], ncols - edge - marker_w//2 + shift[1]),
+                   (nrows - edge - marker_h//2 + shift[0], edge + marker_w//2 + shift[1]),
+                   (nrows - edge - marker_h//2 + shift[0], ncols - edge - marker_w//2 + shift[1])
+    ]
+    focal_plane = z_slices // 3
+    marker_img = (marker.astype(np.float32) / 255) - 0.5
+
+    particles = []
+    for i in range(particle_count):
+        kind = 'filament' if rng.rand() < filament_frac else 'point'
+        angle, dist = rng.uniform(0, 2*np.pi), spot_r * 0.95 * np.sqrt(rng.rand())
+        center = (int(spot_y + dist * np.sin(angle)), int(spot_x + dist * np.cos(angle)))
+        particles.append((center, _particle_patch(rng, kind),
+                          rng.uniform(0.02, 0.08), rng.normal(z_slices / 2, 2.0), kind))
+
+    pic3D = np.empty((z_slices, nrows, ncols), dtype=np.uint16)
+    z_vals = np.arange(z_slices)
+    for z in z_vals:
+        ##The spot's reflectance changes through focus, which is what makes it stand out in the SD projection
+        img = background + spot_img * np.float32(1 + 1.5 * np.cos(np.pi * (z - focal_plane) / z_slices))
+
+        ##Markers are sharpest at the focal plane and blur away from it
+        blur = 0.5 + abs(z - focal_plane) * 0.6
+        marker_z = gaussian_filter(marker_img, sigma=blur) * 3000
+        for loc in marker_locs:
+            top, left = loc[0] - marker_h//2, loc[1] - marker_w//2
+            img[top:top+marker_h, left:left+marker_w] += marker_z
+
+        for center, patch, contrast, z_peak, kind in particles:
+            amp = contrast * 12000 * np.exp(-(z - z_peak)**2 / 8.0)
+            ph, pw = patch.shape
+            top, left = center[0] - ph//2, center[1] - pw//2
+            if (top < 0) or (left < 0) or (top + ph > nrows) or (left + pw > ncols):
+                continue
+            img[top:top+ph, left:left+pw] += patch * amp
+
+        img += rng.normal(0, 60, img.shape).astype(np.float32)
+        pic3D[z] = np.clip(img, 0, 65535)
+
+    truth = {'marker': marker,
+             'marker_locs': marker_locs,
+             'spot_coords': (spot_x, spot_y, spot_r),
+             'focal_plane': focal_plane,
+             'particles': [(center, kind) for center, patch, contrast, z_peak, kind in particles]
+    }
+
+    return pic3D, truth
+#*********************************************************************************************#
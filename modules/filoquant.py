@@ -14,6 +14,7 @@ from scipy import ndimage as ndi
 # from skimage.filters import gaussian
 from skimage import exposure, feature, transform, filters, util, measure, morphology, io, img_as_float
 import os, json, math, warnings, sys, glob
+from modules.vfilo import measure_fiber_length
 #*********************************************************************************************#
 #
 #           SUBROUTINES
@@ -79,20 +80,10 @@ def filoskel(pic_binary, pic_orig):
 def _measure_filament(coords_dict, res):
     filo_lengths, vertex1, vertex2 = [],[],[]
     for key in coords_dict:
-        fiber_coords = coords_dict[key]
-        dist_matrix = pdist(fiber_coords, metric='cityblock')
-        sparse_matrix = csr_matrix(squareform(dist_matrix))
-        distances, preds = csgraph.shortest_path(sparse_matrix,
-                                                 method = 'FW',
-                                                 return_predecessors=True)
-        ls_path = np.max(distances)
-        farpoints = np.where(distances == ls_path)
-        endpt_loc = len(farpoints[0]) // 2
-        v1 = fiber_coords[farpoints[0][0]]
-        v2 = fiber_coords[farpoints[0][endpt_loc]]
-        filo_lengths.append(float(round(ls_path / res, 3)))
-        vertex1.append(tuple(v1))
-        vertex2.append(tuple(v2))
+        filo_len, vertices = measure_fiber_length(coords_dict[key], spacing=1/res)
+        filo_lengths.append(filo_len)
+        vertex1.append(vertices[0])
+        vertex2.append(vertices[1])
 
     return filo_lengths, vertex1, vertex2
 #*********************************************************************************************#
@@ -0,0 +1,76 @@
+from __future__ import division
+import pandas as pd
+import numpy as np
+"""
+Chip-wide aggregation of the particle tables after scanning. All the particles of a chip are
+handled as one long table, so the per-pass counts, the cumulative counts and the densities
+come from a single groupby on (spot, pass) rather than one filter per spot and pass.
+metric_df is long: one row per valid particle, with spot_number, pass_number, area_squm
+and the histogram metric in 'value'.
+"""
+#*********************************************************************************************#
+#
+#           SUBROUTINES
+#
+#*********************************************************************************************#
+def pass_areas(spot_df, bad_spots=()):
+    """spot_number, pass_number and area_squm of every pass of the spots that are not in bad_spots"""
+    area_df = pd.DataFrame({'spot_number': spot_df.spot_number.astype(int).values,
+                            'pass_number': spot_df.scan_number.astype(int).values,
+                            'area_squm'  : (spot_df.area_sqmm.astype(float) * 1e6).astype(int).values
+    })
+
+    return area_df[~area_df.spot_number.isin(bad_spots)].reset_index(drop=True)
+#*********************************************************************************************#
+def metric_table(particle_df, spot_df, histo_metric, bad_spots=()):
+    """
+    Long table of the histo_metric value of every valid particle, with the counting area of
+    its pass. A pass without valid particles keeps one row with a NaN value, so it still
+    gets an (empty) histogram.
+    """
+    valid_df = particle_df.loc[particle_df.validity == True, ['spot_number','pass_number',histo_metric]]
+    valid_df = valid_df.rename(columns={histo_metric: 'value'})
+    valid_df = valid_df.astype({'spot_number': int, 'pass_number': int})
+
+    metric_df = pass_areas(spot_df, bad_spots).merge(valid_df, on=['spot_number','pass_number'],
+                                                     how='left', sort=False
+    )
+
+    return metric_df
+#*********************************************************************************************#
+def particle_counts(metric_df, spot_df, metric_window, bad_spots=()):
+    """
+    Adds new_particles, cumulative_particles and kparticle_density to spot_df, counting the
+    particles with metric_window[0] < value <= metric_window[1] in each pass. Spots in bad_spots
+    (and passes without particles) count 0.
+    """
+    min_cont, max_cont = metric_window
+    in_window = metric_df[(metric_df.value > min_cont) & (metric_df.value <= max_cont)]
+    pass_counts = in_window.groupby(['spot_number','pass_number']).size()
+
+    pass_index = pd.MultiIndex.from_arrays([spot_df.spot_number.astype(int), spot_df.scan_number.astype(int)])
+    new_particles = np.array(pass_counts.reindex(pass_index, fill_value=0))
+    new_particles[np.isin(spot_df.spot_number.astype(int), list(bad_spots))] = 0
+
+    spot_df['new_particles'] = new_particles
+    ##spot_df lists the passes of each spot in order, as iris_txt_reader builds it
+    spot_df['cumulative_particles'] = spot_df.groupby('spot_number', sort=False).new_particles.cumsum()
+    spot_df['kparticle_density'] = np.round(spot_df.cumulative_particles
+                                            / spot_df.area_sqmm.astype(float) * 0.001, 3
+    )
+
+    return spot_df
+#*********************************************************************************************#
+def print_counts(spot_df, bad_spots=()):
+    """One line per pass with the particles accumulated so far, as the scan loop printed them"""
+    for spot_num, pass_num, cumulative_particles in zip(spot_df.spot_number, spot_df.scan_number,
+                                                        spot_df.cumulative_particles):
+        if spot_num in bad_spots:
+            if pass_num == 1:
+                print("No data for spot {}\n".format(str(spot_num).zfill(3)))
+            continue
+        print(  'Spot scanned: {}; '.format(str(spot_num).zfill(3))
+              + 'Scan {}, '.format(pass_num)
+              + 'Particles accumulated: {}'.format(cumulative_particles)
+        )
+#*********************************************************************************************#
@@ -0,0 +1,99 @@
+from __future__ import division
+import numpy as np
+import hashlib, json, os, zipfile
+"""
+On-disk cache for the per-pass intermediates of the spot loop.
+Entries are uncompressed .npz files named by a hash of the input files, of every parameter
+that feeds the stage and of the stage version, so changing a setting only invalidates the
+stages downstream of it.
+Only small results that are expensive to recompute are worth an entry: writing or reading a
+whole stack costs about as much as recomputing it.
+The cache is trimmed to a maximum size by deleting the least recently used entries.
+"""
+##Version of each cached stage, part of its keys: bump it whenever the code of the stage or the
+##arrays of its entries change, so entries written by the old code are never read
+STAGE_VERSIONS = {'contrast': 1, 'focal': 1, 'classify': 1}
+#*********************************************************************************************#
+#
+#           SUBROUTINES
+#
+#*********************************************************************************************#
+def file_key(files, header_size=2**16):
+    """
+    Identifies the image files by path, size, modification time and a hash of their first
+    header_size bytes (the TIFF/PGM header), without reading whole stacks.
+    """
+    sha = hashlib.sha1()
+    for file in files:
+        stat = os.stat(file)
+        sha.update(str((os.path.abspath(file), stat.st_size, stat.st_mtime_ns)).encode())
+        with open(file, 'rb') as f:
+            sha.update(f.read(header_size))
+
+    return sha.hexdigest()
+#*********************************************************************************************#
+def stage_key(stage, *parts):
+    """
+    Combines a stage name and its STAGE_VERSIONS entry with anything it depends on: keys of
+    earlier stages, parameters (anything json can write) and arrays, which are hashed by content.
+    """
+    sha = hashlib.sha1('{}:{}'.format(stage, STAGE_VERSIONS.get(stage, 0)).encode())
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            sha.update(str((part.shape, part.dtype.str)).encode())
+            sha.update(np.ascontiguousarray(part).view(np.uint8).data)
+        else:
+            sha.update(json.dumps(part, sort_keys=True, default=str).encode())
+
+    return sha.hexdigest()
+#*********************************************************************************************#
+def load(cache_dir, key):
+    """Returns the cached arrays for key as a dict, or None if there are none"""
+    cache_file = os.path.join(cache_dir, key + '.npz')
+    try:
+        with np.load(cache_file) as npz:
+            arrays = {name: npz[name] for name in npz.files}
+        ##Reads count as use, so recently read entries are evicted last
+        os.utime(cache_file, None)
+    except (IOError, OSError, ValueError, zipfile.BadZipfile):
+        return None
+
+    return arrays
+#*********************************************************************************************#
+def save(cache_dir, key, max_bytes, **arrays):
+    """Writes the arrays for key, then evicts old entries until the cache is under max_bytes"""
+    if max_bytes <= 0:
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+
+    cache_file = os.path.join(cache_dir, key + '.npz')
+    ##Written under a temporary name so other processes never read a partial file
+    temp_file = '{}.{}.part'.format(cache_file, os.getpid())
+    with open(temp_file, 'wb') as f:
+        ##Uncompressed: zlib on image data costs several times what the entry saves
+        np.savez(f, **arrays)
+    os.replace(temp_file, cache_file)
+
+    evict(cache_dir, max_bytes)
+#*********************************************************************************************#
+def evict(cache_dir, max_bytes):
+    """Deletes the least recently used entries until the cache holds at most max_bytes"""
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.npz'):
+            try:
+                stat = os.stat(os.path.join(cache_dir, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+    cache_size = sum(entry[1] for entry in entries)
+    for mtime, size, name in sorted(entries):
+        if cache_size <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except OSError:
+            pass
+        cache_size -= size
+#*********************************************************************************************#
@@ -0,0 +1,65 @@
+from __future__ import division
+from scipy.sparse import coo_matrix, csgraph
+import numpy as np
+"""
+Filament measurements on the pixel graph of an object
+"""
+#*********************************************************************************************#
+#
+#           SUBROUTINES
+#
+#*********************************************************************************************#
+def pixel_graph(coords, spacing=1):
+    """
+    Builds the 8-connected adjacency graph of the pixels in coords as a sparse matrix.
+    Edges between side neighbors are weighted by spacing, diagonal ones by spacing*sqrt(2).
+    """
+    coords = np.asarray(coords, dtype=int).reshape(-1,2)
+    rows, cols = coords[:,0] - coords[:,0].min(), coords[:,1] - coords[:,1].min()
+
+    pix_index = np.full((rows.max() + 1, cols.max() + 1), -1, dtype=int)
+    pix_index[rows, cols] = np.arange(len(coords))
+
+    ##Each edge is only needed once for an undirected graph, so only half the neighbors are checked
+    steps = ((0,1,1.0), (1,0,1.0), (1,1,np.sqrt(2)), (1,-1,np.sqrt(2)))
+    edge_from, edge_to, edge_len = [],[],[]
+    for dr, dc, dist in steps:
+        n_rows, n_cols = rows + dr, cols + dc
+        in_bounds = ((n_rows < pix_index.shape[0]) & (n_cols >= 0) & (n_cols < pix_index.shape[1]))
+        neighbors = np.full(len(coords), -1, dtype=int)
+        neighbors[in_bounds] = pix_index[n_rows[in_bounds], n_cols[in_bounds]]
+        connected = neighbors >= 0
+        edge_from.append(np.flatnonzero(connected))
+        edge_to.append(neighbors[connected])
+        edge_len.append(np.full(np.count_nonzero(connected), dist * spacing))
+
+    graph = coo_matrix((np.concatenate(edge_len),
+                       (np.concatenate(edge_from), np.concatenate(edge_to))),
+                       shape=(len(coords), len(coords))
+    ).tocsr()
+
+    return graph
+#*********************************************************************************************#
+def _farthest_pixel(graph, source):
+    distances = csgraph.dijkstra(graph, directed=False, indices=source)
+    distances[np.isinf(distances)] = -1
+    far_pix = int(np.argmax(distances))
+
+    return far_pix, distances[far_pix]
+#*********************************************************************************************#
+def measure_fiber_length(coords, spacing=1):
+    """
+    Measures the longest geodesic path through an object's pixels with two Dijkstra sweeps:
+    the pixel farthest from an arbitrary start is one end of the fiber, and the pixel farthest
+    from that is the other. Returns the length (in the units of spacing) and the two end points.
+    """
+    coords = np.asarray(coords, dtype=int).reshape(-1,2)
+    graph = pixel_graph(coords, spacing=spacing)
+
+    vertex1, _ = _farthest_pixel(graph, 0)
+    vertex2, fiber_length = _farthest_pixel(graph, vertex1)
+
+    vertices = [tuple(coords[vertex1]), tuple(coords[vertex2])]
+
+    return float(round(fiber_length, 3)), vertices
+#*********************************************************************************************#
@@ -5,6 +5,7 @@ import matplotlib.pyplot as plt
 import matplotlib.lines as lines
 import mpl_toolkits.mplot3d.art3d as art3d
 from matplotlib.patches import Polygon, Patch
+from matplotlib.collections import PolyCollection, LineCollection
 from mpl_toolkits.mplot3d import Axes3D
 from matplotlib.colors import to_rgba_array
 from skimage import io as skio
@@ -17,6 +18,9 @@ import sys
 """
 A suite of graphing subroutines for IRIS images
 """
+##savefig settings for the per-pass particle images: zlib level 1 writes the full-size PNG
+##several times faster than the default level 6, for a slightly larger file
+PARTICLE_PNG_SETTINGS = dict(dpi=96, pil_kwargs={'compress_level': 1})
 #*********************************************************************************************#
 def get_vhf_colormap():
     vhf_colormap = ('#e41a1c',
@@ -111,8 +115,13 @@ def _circle_particles(particle_df, axes, exo_toggle):
     plt.ylabel("PARTICLE COUNT", color='w')
 #*********************************************************************************************#
 def gen_particle_image(pic_to_show, shape_df, spot_coords, pix_per_um, cv_cutoff=1,
-                        r2_cutoff=0, show_particles=True, scalebar=0, markers=[], exo_toggle=False):
-
+                        r2_cutoff=0, show_particles=True, scalebar=0, markers=[], exo_toggle=False,
+                        show_labels=True):
+    """
+    Draws the spot, the markers and the particles of the latest pass in shape_df over the image.
+    Valid particles are boxed and invalid ones crossed out, each set drawn as one collection;
+    show_labels=False leaves out the label: z_intensity text of every valid particle.
+    """
     nrows, ncols=pic_to_show.shape
 
     fig, axes = _gen_img_fig(pic_to_show)
@@ -133,33 +142,32 @@ def gen_particle_image(pic_to_show, shape_df, spot_coords, pix_per_um, cv_cutoff
         except ValueError: current_pass = 0
         curr_pass_df = shape_df[shape_df.pass_number == current_pass]
 
-        patch_settings=dict(fill=False, color='r',linewidth=1, alpha=0.75)
-        line_settings=dict(lw=1,color='purple',alpha=0.25)
+        patch_settings=dict(facecolors='none', edgecolors='r',linewidths=1, alpha=0.75)
+        line_settings=dict(linewidths=1,colors='purple',alpha=0.25)
         text_settings=dict(fontsize='6', alpha = 0.8, horizontalalignment='right')
 
-        for val in curr_pass_df.index.values:
-            label,filo_score,bbox,validity,z_int,centroid = curr_pass_df[['label',
-                                                                          'filo_score',
-                                                                          'bbox',
-                                                                          'validity',
-                                                                          'z_intensity',
-                                                                          'centroid']].loc[val]
-            lowleft_x = bbox[0][1]
-            lowleft_y = bbox[0][0]
-
-            if validity == True:
-                box_w = bbox[2][1] - lowleft_x
-                box_h = bbox[2][0] - lowleft_y
-                particle_box = plt.Rectangle((lowleft_x-1,lowleft_y-2), box_w, box_h, **patch_settings)
-                axes.add_patch(particle_box)
-                datastr = '{}: {}'.format(label, round(z_int,1))
-                axes.text(y=centroid[0], x=centroid[1], s=datastr, color='c', **text_settings)
-
-            else:
-                line1=lines.Line2D([bbox[3][1],bbox[1][1]],[bbox[3][0],bbox[1][0]], **line_settings)
-                line2=lines.Line2D([lowleft_x, bbox[2][1]],[lowleft_y, bbox[2][0]], **line_settings)
-                axes.add_line(line1)
-                axes.add_line(line2)
+        if not curr_pass_df.empty:
+            ##bbox vertices are (row, col): top left, top right, bottom right, bottom left
+            bbox_array = np.stack(curr_pass_df.bbox.values)
+            bbox_x, bbox_y = bbox_array[:,:,1], bbox_array[:,:,0]
+            valid = (curr_pass_df.validity == True).values
+
+            box_x0, box_y0 = bbox_x[valid,0] - 1, bbox_y[valid,0] - 2
+            box_x1 = box_x0 + bbox_x[valid,2] - bbox_x[valid,0]
+            box_y1 = box_y0 + bbox_y[valid,2] - bbox_y[valid,0]
+            box_verts = np.stack([np.column_stack(corner) for corner in
+                                  ((box_x0,box_y0), (box_x1,box_y0), (box_x1,box_y1), (box_x0,box_y1))], axis=1)
+            axes.add_collection(PolyCollection(box_verts, closed=True, **patch_settings))
+
+            cross_segments = np.concatenate([np.stack([bbox_array[~valid][:,3,::-1], bbox_array[~valid][:,1,::-1]], axis=1),
+                                             np.stack([bbox_array[~valid][:,0,::-1], bbox_array[~valid][:,2,::-1]], axis=1)])
+            axes.add_collection(LineCollection(cross_segments, **line_settings))
+
+            if show_labels == True:
+                valid_df = curr_pass_df[valid]
+                for label, z_int, centroid in zip(valid_df.label, valid_df.z_intensity, valid_df.centroid):
+                    datastr = '{}: {}'.format(label, round(z_int,1))
+                    axes.text(y=centroid[0], x=centroid[1], s=datastr, color='c', **text_settings)
 
     if scalebar > 0:
         scalebar_len_pix=pix_per_um * scalebar
@@ -177,97 +185,105 @@ def gen_particle_image(pic_to_show, shape_df, spot_coords, pix_per_um, cv_cutoff
 
 
 #*********************************************************************************************#
-def histogrammer(value_df, spot_counter, metric_window, bin_size=0.1,norm_to_area=True):
-    """Returns a DataFrame of histogram data from the particle dictionary.
+def save_particle_image(png_path, pic_to_show, shape_df, spot_coords, pix_per_um, **kwargs):
+    """gen_particle_image saved to png_path with PARTICLE_PNG_SETTINGS, as one vrender.submit job"""
+    gen_particle_image(pic_to_show, shape_df, spot_coords, pix_per_um, **kwargs)
+    plt.savefig(png_path, **PARTICLE_PNG_SETTINGS)
+    plt.clf(); plt.close('all')
+#*********************************************************************************************#
+def _split_histogram_cols(histogram_df):
+    """Spot and pass numbers of histogram columns named spot_pass"""
+    spot_pass = np.array([col.split('_') for col in histogram_df.columns], dtype=int).reshape(-1,2)
+
+    return spot_pass[:,0], spot_pass[:,1]
+#*********************************************************************************************#
+def histogrammer(metric_df, spot_counter, metric_window, bin_size=0.1,norm_to_area=True):
+    """Returns a DataFrame of histogram data from the long metric table (see vaggregate.metric_table),
+    with one column per spot and pass, named spot_pass.
+    Every pass is binned at once: each value gets a (pass, bin) index and the counts come from one bincount.
     """
     metric_1=float(metric_window[1])
     bin_no=int(metric_1 / bin_size)
-    area_list = [float(col.split('.')[-1])*1e-3 for col in value_df.columns]
-
-    histogram_df= pd.DataFrame()
-    for col in value_df:
-        new_col = '_'.join([str(int(x)) for x in col.split('.')[:-1]])
-        histogram_df[new_col], hbins=np.histogram(value_df[col].dropna(), bins=bin_no, range=(0,metric_1))
+    hbins = np.histogram_bin_edges([], bins=bin_no, range=(0,metric_1))
+
+    pass_keys = ['spot_number','pass_number','area_squm']
+    pass_ix = metric_df.groupby(pass_keys, sort=True).ngroup().values
+    pass_df = metric_df[pass_keys].drop_duplicates().sort_values(pass_keys)
+    pass_count = len(pass_df)
+
+    ##np.histogram's bins: closed on the left, and the last bin also holds the top edge
+    values = metric_df.value.values.astype(float)
+    bin_ix = np.searchsorted(hbins, values, side='right') - 1
+    bin_ix[values == hbins[-1]] = bin_no - 1
+    in_range = (values >= hbins[0]) & (values <= hbins[-1])
+
+    counts = np.bincount(pass_ix[in_range] * bin_no + bin_ix[in_range], minlength=pass_count * bin_no)
+    histogram_df = pd.DataFrame(counts.reshape(pass_count, bin_no).T, index=hbins[:-1],
+                                columns=['{}_{}'.format(spot_num, pass_num) for spot_num, pass_num
+                                         in zip(pass_df.spot_number, pass_df.pass_number)]
+    )
 
     if norm_to_area == True:
-        histogram_df = histogram_df.div(area_list,axis=1)
-        # for i, col in enumerate(histogram_df.columns):
-        #     histogram_df[col] = round((histogram_df[col] / area_list[i])*1e-3, 5)
-
-    for col in histogram_df:
-        if np.all(np.isnan(histogram_df[col])) == True:
-            histogram_df.drop(columns=col, inplace=True)
-
-    histogram_df.set_index(hbins[:-1], inplace=True)
+        histogram_df = histogram_df.div(pass_df.area_squm.values*1e-3,axis=1)
 
-    return histogram_df
+    return histogram_df.loc[:, ~histogram_df.isnull().all()]
 
 #*********************************************************************************************#
 def sum_histogram(raw_histogram_df, spot_counter):
+    """
+    Cumulative histograms: each spot_pass column holds the sum of that spot's passes up to it,
+    leaving out the first pass, which keeps its own histogram. The sums are one cumsum along the passes.
+    """
+    spot_nums, pass_nums = _split_histogram_cols(raw_histogram_df)
+    col_order = np.lexsort((pass_nums, spot_nums))
+    col_order = col_order[(spot_nums[col_order] >= 1) & (spot_nums[col_order] <= spot_counter)]
+    spot_nums = spot_nums[col_order]
 
-    sum_histogram_df = pd.DataFrame(index=raw_histogram_df.index)
-
-    for y in range(1, spot_counter+1):
-        spot_histogram_df = pd.DataFrame()
-        for col in raw_histogram_df:
-
-            if int(col.split('_')[0]) == y:
-                spot_histogram_df=pd.concat([spot_histogram_df, raw_histogram_df[col]], axis=1)
+    spot_histogram_df = raw_histogram_df.iloc[:, col_order]
+    first_pass = np.r_[True, spot_nums[1:] != spot_nums[:-1]] if len(spot_nums) else np.zeros(0, dtype=bool)
 
-        for i in range(1,len(spot_histogram_df.columns)+1):
-            new_name = '{}_{}'.format(y,i)
-            if i == 1:
-                sum_histogram_df[new_name] = spot_histogram_df.pop(new_name)
-            else:
-                cols_to_sum = [col for col in spot_histogram_df if int(col.split('_')[1]) <= i]
-
-                sum_histogram_df= pd.concat([sum_histogram_df,
-                                         spot_histogram_df[cols_to_sum].sum(axis=1).rename(new_name)], axis=1
-                )
+    sum_values = spot_histogram_df.values.astype(float)
+    sum_values[:, first_pass] = 0
+    sum_histogram_df = pd.DataFrame(sum_values, index=spot_histogram_df.index,
+                                    columns=spot_histogram_df.columns
+    ).T.groupby(spot_nums, sort=False).cumsum().T
+    sum_histogram_df.loc[:, first_pass] = spot_histogram_df.loc[:, first_pass]
 
     return sum_histogram_df
 #*********************************************************************************************#
 def average_histogram(sum_histogram_df, spot_df, pass_counter, smooth_window=5, all_locs = False):
-    avg_histogram_df = pd.DataFrame(index=sum_histogram_df.index)
-    spot_type_list = []
+    """
+    Mean and standard error of the mean (_sdm) of the cumulative histograms of the valid spots of
+    each spot type, for every pass, plus their rolling means (_rollingmean) for plotting.
+    """
     spot_df = spot_df[spot_df.validity==True]
-    for val in spot_df.spot_type:
-        if val.startswith('LOC') & (all_locs == True):
-            val = 'ALL LOCs'
-            spot_df.spot_type = 'ALL LOCs'
-
-        if val not in spot_type_list:
-            spot_type_list.append(val)
-
-    for x in range(1,pass_counter+1):
-        pass_histogram_df=pd.DataFrame()
-        for col in sum_histogram_df.columns[1:]:
-            if int(col.split('_')[1]) == x:
-                pass_histogram_df=pd.concat([pass_histogram_df, sum_histogram_df[col]], axis=1)
-        for spot_type in spot_type_list:
-            cols_to_avg=[col for col in pass_histogram_df
-                             if int(col.split('_')[0])
-                             in spot_df.spot_number[(spot_df.spot_type == spot_type)].tolist()
-            ]
+    spot_types = spot_df.spot_type.astype(str)
+    if all_locs == True:
+        spot_types = spot_types.where(~spot_types.str.startswith('LOC'), 'ALL LOCs')
+    spot_type_list = list(pd.unique(spot_types))
+    spot_type_dict = dict(zip(spot_df.spot_number, spot_types))
 
-            sqrt_n = np.sqrt(len(cols_to_avg))
+    spot_nums, pass_nums = _split_histogram_cols(sum_histogram_df)
+    col_types = np.array([spot_type_dict.get(spot_num) for spot_num in spot_nums], dtype=object)
+    has_type = np.array([col_type is not None for col_type in col_types], dtype=bool)
 
-            new_name = spot_type+'_'+str(x)
+    type_groups = sum_histogram_df.loc[:, has_type].T.groupby([pass_nums[has_type], col_types[has_type]])
+    mean_df = type_groups.mean().T
+    sdm_df = (type_groups.std() / np.sqrt(type_groups.size().values)[:,None]).T
 
-            mean_df = sum_histogram_df[cols_to_avg].mean(axis=1).rename(new_name)
+    col_keys = [(x, spot_type) for x in range(1,pass_counter+1) for spot_type in spot_type_list]
+    mean_df = mean_df.reindex(columns=pd.MultiIndex.from_tuples(col_keys))
+    sdm_df = sdm_df.reindex(columns=pd.MultiIndex.from_tuples(col_keys))
+    mean_names = ['{}_{}'.format(spot_type, x) for x, spot_type in col_keys]
+    mean_df.columns = mean_names
+    sdm_df.columns = [name + '_sdm' for name in mean_names]
 
-            sdm_df = sum_histogram_df[cols_to_avg].std(axis=1).apply(lambda x: x/sqrt_n).rename(new_name + '_sdm')
+    avg_histogram_df = pd.concat([mean_df, sdm_df], axis=1)[[col for name in mean_names
+                                                            for col in (name, name + '_sdm')]]
 
-            avg_histogram_df = pd.concat([avg_histogram_df, mean_df, sdm_df], axis=1)
+    smooth_df = mean_df.rolling(window=smooth_window, center=True).mean().add_suffix('_rollingmean')
 
-    for col in avg_histogram_df.columns:
-        if col[-1].isdigit():
-            smooth_df=avg_histogram_df[col].rolling(window=smooth_window,
-                                                    center=True).mean().rename(col+'_rollingmean')
-
-            avg_histogram_df=pd.concat([avg_histogram_df,smooth_df], axis=1)
-
-    return avg_histogram_df
+    return pd.concat([avg_histogram_df, smooth_df], axis=1)
 #*********************************************************************************************#
 def generate_histogram(avg_histogram_df, pass_counter, chip_name, metric_str, histo_metric, histo_dir):
     """Generates a histogram figure for each pass in the IRIS experiment from a
@@ -415,36 +431,35 @@ def defocus_profile_graph(shape_df, pass_num, zslice_count, dir, exo_toggle, img
 #*********************************************************************************************#
 def average_spot_data(spot_df, pass_counter):
     """Creates a dataframe containing the average data for each antibody spot type"""
-    averaged_df=pd.DataFrame()
-    spot_list=[]
-    for val in spot_df.spot_type:
-        if val not in spot_list:
-            spot_list.append(val)
+    spot_list = list(pd.unique(spot_df.spot_type))
+
+    valid_df = spot_df[spot_df.validity == True]
+    ##Passes with no recorded time (0) are left out of the average time
+    type_pass_groups = pd.DataFrame({'spot_type'         : valid_df.spot_type,
+                                     'scan_number'       : valid_df.scan_number,
+                                     'scan_time'         : valid_df.scan_time.where(valid_df.scan_time != 0),
+                                     'kparticle_density' : valid_df.kparticle_density,
+                                     'normalized_density': valid_df.normalized_density
+    }).groupby(['spot_type','scan_number'])
+    mean_df, std_df = type_pass_groups.mean(), type_pass_groups.std(ddof=0)
+
+    stats_df = pd.DataFrame({'avg_time'        : mean_df.scan_time,
+                             'avg_density'     : mean_df.kparticle_density,
+                             'std_density'     : std_df.kparticle_density,
+                             'avg_norm_density': mean_df.normalized_density,
+                             'std_norm_density': std_df.normalized_density
+    })
+
+    type_pass_index = pd.MultiIndex.from_product([spot_list, np.arange(1,pass_counter+1)],
+                                                 names=['spot_type','scan_number']
+    )
+    averaged_df = stats_df.reindex(type_pass_index).round({'avg_time': 2, 'avg_density': 2, 'std_density': 3,
+                                                           'avg_norm_density': 2, 'std_norm_density': 3}
+    )
+    averaged_df = averaged_df.reset_index()
 
-    for i, spot in enumerate(spot_list):
-        sub_df=spot_df[(spot_df.spot_type == spot_list[i]) & (spot_df.validity == True)]
-        avg_time, avg_kpd, avg_nd, std_kpd, std_nd=[],[],[],[],[]
-        for i in range(1,pass_counter+1):
-            subsub_df=sub_df[sub_df.scan_number == i]
-            avg_time.append(
-                     round(
-                     np.nanmean(subsub_df.scan_time.iloc[subsub_df.scan_time.nonzero()]),2))
-            avg_kpd.append(round(np.nanmean(subsub_df.kparticle_density),2))
-            std_kpd.append(round(np.nanstd(subsub_df.kparticle_density),3))
-            avg_nd.append(round(np.nanmean(subsub_df.normalized_density),2))
-            std_nd.append(round(np.nanstd(subsub_df.normalized_density),3))
-        avg_df=pd.DataFrame({
-                              'scan_number': np.arange(1,pass_counter+1),
-                              'spot_type': [spot]* pass_counter,
-                              'avg_time': avg_time,
-                              'avg_density': avg_kpd,
-                              'std_density': std_kpd,
-                              'avg_norm_density':avg_nd,
-                              'std_norm_density':std_nd
-                              })
-        averaged_df=averaged_df.append(avg_df).reset_index(drop=True)
-
-    return averaged_df
+    return averaged_df[['scan_number','spot_type','avg_time','avg_density','std_density',
+                        'avg_norm_density','std_norm_density']]
 #*********************************************************************************************#
 def generate_timeseries(spot_df, averaged_df, metric_window, mAb_dict,
                         chip_name, sample_name, version,
@@ -646,6 +661,107 @@ def iris_barplot_gen(spot_df, pass_counter, metric_window, chip_name, version,
     print('File generated: {}'.format(plot_name))
     plt.close('all')
 #*********************************************************************************************#
+def fluor_bargraph(spot_df, pass_counter, chip_name, version, savedir,
+                    plot_3sigma=True, Amab ='', Cmab='',
+                    neg_ctrl_str='8G5|MOUSE IGG|muIgG|GFP'):
+
+    """
+    Generates a barplot for the dataset.
+    Most useful for before and after scans (pass_counter == 2)
+    """
+
+    sns.set_style('darkgrid')
+
+    Achan = '594(A)'
+    Cchan = '695(C)'
+    axis_min = 2
+
+    pre_df = spot_df[(spot_df.scan_number == 1)  & (spot_df.validity == True)]
+    post_df = spot_df[(spot_df.scan_number == pass_counter) & (spot_df.validity == True)]
+    dflen = len(pre_df)
+
+    chan_series = pd.Series(['{}: {}'.format(Achan,Amab)]*dflen + ['{}: {}'.format(Cchan,Cmab)]*dflen, name='channel')
+    spot_type_series = pre_df.spot_type.apply(lambda x: x.split('_')[0])
+    pre_area_series = pre_df.area_sqmm.astype('float')*1000
+    spot_type_series_x2 = pd.concat([spot_type_series, spot_type_series]).reset_index(drop=True)
+    channel_pre_df  = pd.concat([pre_df['fluor_particles_A'].astype('float')/pre_area_series,
+                                 pre_df['fluor_particles_C'].astype('float')/pre_area_series],
+                                 ignore_index=True).rename('fluor_val_pre')
+
+    fluorbar_df = pd.concat([spot_type_series_x2, chan_series, channel_pre_df], axis=1)
+    ax1_max = max(fluorbar_df['fluor_val_pre'])
+    if ax1_max < axis_min:
+        ax1_max = axis_min
+    elif np.isnan(ax1_max):
+        ax1_max = axis_min
+    else:
+        ax1_max = round(ax1_max,1) + 1
+
+    post_area_series =post_df.area_sqmm.astype('float')*1000
+    channel_post_df  = pd.concat([post_df['fluor_particles_A'].astype('float')/ post_area_series,
+                                  post_df['fluor_particles_C'].astype('float')/ post_area_series],
+                                  ignore_index=True).rename('fluor_val_post')
+
+
+    fluorbar_df = pd.concat([fluorbar_df, channel_post_df], axis=1)
+
+    ax2_max = max(fluorbar_df['fluor_val_post'])
+    if ax2_max < axis_min:
+        ax2_max = axis_min
+    elif np.isnan(ax2_max):
+        ax2_max = axis_min
+    else:
+        ax2_max = round(ax2_max,1) + 1
+
+    fig, (ax1, ax2)=plt.subplots(1, 2, figsize=(8, 6), sharey=True,
+                                 gridspec_kw = {'width_ratios':[ax1_max, ax2_max]}
+    )
+    colors = ('#4daf4a','#de2d26')
+    # labels = [Patch(color=colors[c], label=val) for c, val in enumerate(fluorbar_df.channel.unique())]
+
+    fig.add_subplot(111, frameon=False)
+    plt.tick_params(labelcolor='none', top='off', bottom='off', left='off', right='off')
+    plt.grid(False)
+    plt.suptitle("Fluorescence of {}".format(chip_name), y=1, fontsize=20)
+    plt.xlabel("Fluorescent Particle Density (kparticles/mm" + r'$^2$'+')', fontsize=14)
+
+    ax1 = sns.barplot(x='fluor_val_pre',y='spot_type',hue='channel', data=fluorbar_df,
+                     palette=colors, alpha = 0.5, errwidth=2, ci='sd', ax=ax1)
+    ax1.set_xlim([ax1_max,0])
+    ax1.set_title("Prescan", fontsize=12)
+    ax1.set_ylabel('')
+    ax1.set_xlabel('')
+
+    ax1.legend('')
+
+    ax2 = sns.barplot(x='fluor_val_post',y='spot_type',hue='channel', data=fluorbar_df,
+                     palette=colors, errwidth=2, ci='sd', ax=ax2)
+    if plot_3sigma == True:
+        neg_control_df = fluorbar_df[fluorbar_df.spot_type.str.contains(neg_ctrl_str)]
+        A_neg_vals = neg_control_df.fluor_val_post[neg_control_df.channel.str.contains('A')]
+        C_neg_vals = neg_control_df.fluor_val_post[neg_control_df.channel.str.contains('C')]
+        three_sigma_A = (np.std(A_neg_vals) * 3) + np.mean(A_neg_vals)
+        three_sigma_C = (np.std(C_neg_vals) * 3) + np.mean(C_neg_vals)
+        ax2.axvline(x=three_sigma_A,ls='--',lw=1,color='g', label='3'+r'$\sigma$'+' Signal Threshold A')
+        ax2.axvline(x=three_sigma_C,ls=':',lw=1,color='r', label='3'+r'$\sigma$'+' Signal Threshold C')
+        # line_legend = ax2.get_legend_handles_labels()
+        # labels = labels+line_legend[0]
+    labels = ax2.get_legend_handles_labels()[0]
+    ax2.legend(handles=labels, fontsize=10, loc ='best')
+    ax2.set_xlim([0,ax2_max])
+    ax2.yaxis.set_tick_params(labelsize=12, rotation = 45)
+    ax2.set_title("Postscan", fontsize=12)
+    ax2.set_ylabel('')
+    ax2.set_xlabel('')
+
+    plt.tight_layout()
+    plt.subplots_adjust(wspace=0, hspace=0)
+
+    plot_name="{}_fluorescence_barplot.v{}.png".format(chip_name, version)
+    plt.savefig('{}/{}'.format(savedir, plot_name), bbox_inches='tight', pad_inches=0.1, dpi=300)
+    print('File generated: {}'.format(plot_name))
+    plt.close('all')
+#*********************************************************************************************#
 def filo_image_gen(shape_df, pic1, pic2, pic3,
                   ridge_list, sphere_list, other_list,
                   cv_cutoff=0.1, r2_cutoff=0.85, show=True):
@@ -8,11 +8,17 @@ from scipy.stats import norm, gamma
 from skimage.exposure import cumulative_distribution, equalize_adapthist, rescale_intensity
 from skimage.feature import match_template, peak_local_max
 from skimage.transform import hough_circle, hough_circle_peaks
-import math, warnings
+import math, warnings, os, threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
 
 import cv2
+from modules import vregister
 # from clahe import clahe
 # from vpipes import _dict_matcher
+
+##CLAHE settings vloop gives contrast_3D (part of its cache keys, see vcache)
+CONTRAST_SETTINGS = {'kernel_size': (1,1), 'cliplim': 4}
 #*********************************************************************************************#
 #
 #           SUBROUTINES
@@ -161,31 +167,101 @@ def gen_img3D(im3D, cmap = "gray", step = 1):
     plt.show()
     plt.close('all')
 #*********************************************************************************************#
-def marker_finder(image, marker, thresh = 0.9):
-    """This locates the "backwards-L" shapes in the IRIS images"""
+def _padded_for_match(image, template_shape):
+    """
+    Pads the image with its mean so that template matches are indexed by the template center,
+    like match_template(..., pad_input = True)
+    """
+    h, w = template_shape
+    top, left = h // 2, w // 2
+    return cv2.copyMakeBorder(np.float32(image), top, h - 1 - top, left, w - 1 - left,
+                              cv2.BORDER_CONSTANT, value = float(np.mean(image))
+    )
+#*********************************************************************************************#
+def _refine_match(padded, template, center, radius):
+    """
+    Full-resolution match of template for centers within radius of center.
+    Returns the best normalized correlation and the center it was found at.
+    """
+    h, w = template.shape
+    nrows, ncols = padded.shape[0] - h + 1, padded.shape[1] - w + 1
+    r0, r1 = max(int(center[0]) - radius, 0), min(int(center[0]) + radius + 1, nrows)
+    c0, c1 = max(int(center[1]) - radius, 0), min(int(center[1]) + radius + 1, ncols)
+    if (r0 >= r1) or (c0 >= c1):
+        return -1, None
 
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        warnings.warn(FutureWarning)##Numpy FFT Warning. This is Scikit-Image's problem
-        if marker.ndim == 2:
-
-            locs = peak_local_max(match_template(image, marker, pad_input = True),
-                                  min_distance = 775,
-                                  threshold_rel = thresh,
-                                  exclude_border = False,
-                                  num_peaks = 4
-            )
+    match_map = cv2.matchTemplate(padded[r0:r1 + h - 1, c0:c1 + w - 1], template, cv2.TM_CCOEFF_NORMED)
+    _, score, _, (dc, dr) = cv2.minMaxLoc(match_map)
 
-        elif marker.ndim == 3:
+    return score, (r0 + dr, c0 + dc)
+#*********************************************************************************************#
+def _coarse_peaks(image, template, scale, min_distance, thresh, num_peaks):
+    """Candidate marker centers from a template match on the image shrunk by scale"""
+    nrows, ncols = image.shape
+    h, w = template.shape
+    small_img = cv2.resize(np.float32(image), (ncols // scale, nrows // scale), interpolation = cv2.INTER_AREA)
+    small_temp = cv2.resize(np.float32(template), (max(w // scale, 1), max(h // scale, 1)),
+                            interpolation = cv2.INTER_AREA
+    )
+    match_map = cv2.matchTemplate(_padded_for_match(small_img, small_temp.shape), small_temp,
+                                  cv2.TM_CCOEFF_NORMED
+    )
+    peaks = peak_local_max(match_map, min_distance = max(min_distance // scale, 1),
+                           threshold_rel = thresh,
+                           exclude_border = False,
+                           num_peaks = num_peaks
+    )
+    return [(r * scale + scale // 2, c * scale + scale // 2) for r, c in peaks]
+#*********************************************************************************************#
+def marker_finder(image, marker, thresh = 0.9, near = None, scale = 4, search_radius = 150, min_score = 0.5):
+    """
+    This locates the "backwards-L" shapes in the IRIS images.
+    Markers are found coarse-to-fine: candidates come from a template match on the image shrunk
+    by scale, and each is refined at full resolution in a small window around it.
+    If near (the marker locations of the previous pass) is given, markers are first looked for
+    within search_radius of those; the whole image is only searched if that fails.
+    A 3D marker is a stack of templates, one per marker, each matched on its own.
+    """
+    image = np.float32(image)
+    marker = np.float32(marker)
+    refine_radius = 2 * scale + 2
 
-            locs = [peak_local_max(match_template(image, m, pad_input = True),
-                                                  threshold_rel = thresh - 0.2,
-                                                  exclude_border = False,
-                                                  num_peaks = 1
-                                    ).flatten() for m in marker
+    if marker.ndim == 2:
+        padded = _padded_for_match(image, marker.shape)
+        matches = []
+        if near:
+            matches = [_refine_match(padded, marker, loc, search_radius) for loc in near]
+            matches = [match for match in matches if match[1] is not None]
+            if (not matches) or (max(matches)[0] < min_score):
+                matches = []
+
+        if not matches:
+            matches = [_refine_match(padded, marker, loc, refine_radius)
+                       for loc in _coarse_peaks(image, marker, scale, 775, thresh, 4)
             ]
-
-    locs = list(map(lambda x: tuple(x), locs))
+        if matches:
+            best_score = max(match[0] for match in matches)
+            locs = [loc for score, loc in matches if (loc is not None) and (score >= thresh * best_score)]
+        else:
+            locs = []
+
+    elif marker.ndim == 3:
+        locs = []
+        for m in marker:
+            padded = _padded_for_match(image, m.shape)
+            match = (-1, None)
+            if near:
+                match = max([_refine_match(padded, m, loc, search_radius) for loc in near],
+                            key = lambda match: match[0]
+                )
+            if match[0] < min_score:
+                coarse_locs = _coarse_peaks(image, m, scale, 1, thresh - 0.2, 1)
+                if coarse_locs:
+                    match = _refine_match(padded, m, coarse_locs[0], refine_radius)
+            if match[1] is not None:
+                locs.append(match[1])
+
+    locs = list(map(lambda x: tuple(int(i) for i in x), locs))
     locs.sort(key = lambda coord: coord[1])
     print(locs)
     return locs
@@ -238,39 +314,196 @@ def spot_finder(image, rad_range = (525, 651), Ab_spot = True):
     print("Spot center coordinates (row, column, radius): {}\n".format(xyr))
     return xyr
 #*********************************************************************************************#
-def clahe_3D(img_stack, kernel_size = [270,404], cliplim = 0.004):
+_plane_pools = {}
+def plane_pool(threads):
+    """
+    Thread pool shared by the per-plane 3D operations; threads < 1 means one per CPU core.
+    OpenCV, NumPy and SciPy release the GIL, so planes really are processed side by side.
+    Pools are kept per process, since threads do not survive a fork.
+    """
+    if threads < 1:
+        threads = cpu_count()
+    pool_key = (os.getpid(), threads)
+    if pool_key not in _plane_pools:
+        _plane_pools[pool_key] = ThreadPoolExecutor(max_workers=threads)
+
+    return _plane_pools[pool_key]
+#*********************************************************************************************#
+def map_planes(func, planes, threads = 1):
+    """
+    Returns [func(plane) for plane in planes], running the calls in the shared thread pool
+    when threads != 1. func usually writes its result into a preallocated output array.
+    """
+    planes = list(planes)
+    if (threads == 1) or (len(planes) < 2):
+        return [func(plane) for plane in planes]
+
+    return list(plane_pool(threads).map(func, planes))
+#*********************************************************************************************#
+def _chunks(count, threads):
+    """Splits range(count) into one contiguous block per thread"""
+    if threads < 1:
+        threads = cpu_count()
+    bounds = np.linspace(0, count, min(threads, count) + 1).astype(int)
+
+    return [range(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+#*********************************************************************************************#
+def _plane_normalizer(img_stack, threads = 1):
+    """
+    Finds the min and max of the whole stack, one plane at a time, and returns a function that
+    min-max normalizes a single plane to 8-bit the same way cv2.normalize(..., NORM_MINMAX) does
+    """
+    def plane_range(plane):
+        img = img_stack[plane]
+        return img.min(), img.max()
+
+    plane_mins, plane_maxs = zip(*map_planes(plane_range, range(len(img_stack)), threads))
+    stack_min, stack_max = min(plane_mins), max(plane_maxs)
+
+    stack_range = float(stack_max) - float(stack_min)
+    scale = 255 / stack_range if stack_range > np.finfo(float).eps else 0
+    shift = -float(stack_min) * scale
+
+    ##cv2 scales in single precision, and rounds integer images but truncates float ones
+    round_vals = np.issubdtype(img_stack.dtype, np.integer)
+    scale, shift = np.float32(scale), np.float32(shift)
+
+    def normalize_plane(img):
+        img_norm = img.astype(np.float32) * scale + shift
+        if round_vals:
+            img_norm = np.rint(img_norm)
+        return np.uint8(img_norm)
+
+    return normalize_plane
+#*********************************************************************************************#
+def normalize_3D(img_stack, threads = 1):
+    """
+    Min-max normalizes the whole stack to 8-bit, like cv2.normalize(..., NORM_MINMAX) on the 3D array,
+    but reads one plane at a time so it also works on a vpipes.LazyStack
+    """
+    normalize_plane = _plane_normalizer(img_stack, threads)
+
+    zslice_count = len(img_stack)
+    img3D_norm = np.empty((zslice_count,) + img_stack[0].shape, dtype=np.uint8)
+    def norm_plane(plane):
+        img3D_norm[plane] = normalize_plane(img_stack[plane])
+
+    map_planes(norm_plane, range(zslice_count), threads)
+
+    return img3D_norm
+#*********************************************************************************************#
+def hist_percentile(img, perc_range):
+    """
+    Same values as np.percentile (linear interpolation) for an 8-bit image,
+    but read off the 256-bin histogram instead of sorting the pixels
+    """
+    cum_count = np.cumsum(np.bincount(img.ravel(), minlength=256))
+    ranks = (cum_count[-1] - 1) * np.asarray(perc_range, dtype=float) / 100
+    low_rank = np.floor(ranks)
+    ##The k-th smallest pixel value is the first bin whose cumulative count exceeds k
+    low_vals = np.searchsorted(cum_count, low_rank, side='right')
+    high_vals = np.searchsorted(cum_count, np.minimum(low_rank + 1, cum_count[-1] - 1), side='right')
+
+    return low_vals + (ranks - low_rank) * (high_vals - low_vals)
+#*********************************************************************************************#
+def _rescale_lut(p1, p2):
+    """8-bit lookup table that does what rescale_intensity(img, in_range=(p1,p2)) does to a uint8 image"""
+    lut = np.clip(np.arange(256, dtype=float), p1, p2)
+    if p2 > p1:
+        lut = (lut - p1) / (p2 - p1) * 255
+
+    return lut.astype(np.uint8)
+#*********************************************************************************************#
+def contrast_3D(img_stack, kernel_size = (1,1), cliplim = 4, perc_range = (2,98), threads = 1):
+    """
+    Fused normalize_3D -> cv2_clahe_3D -> rescale_3D -> standard deviation projection.
+    Each plane goes through every step before the next is read, so only the two 8-bit stacks
+    that are returned (normalized and rescaled) are kept, and the projection is accumulated
+    as running sums. Returns the normalized stack, the rescaled stack and the 8-bit
+    SD projection of the rescaled stack.
+    With threads != 1, each thread takes a block of planes and keeps its own sums.
+    """
+    normalize_plane = _plane_normalizer(img_stack, threads)
+
+    zslice_count = len(img_stack)
+    img_shape = img_stack[0].shape
+    img3D_norm = np.empty((zslice_count,) + img_shape, dtype=np.uint8)
+    img3D_rescale = np.empty((zslice_count,) + img_shape, dtype=np.uint8)
+
+    def contrast_chunk(planes):
+        ##CLAHE objects keep internal buffers, so each thread needs its own
+        clahe = cv2.createCLAHE(clipLimit=cliplim, tileGridSize=kernel_size)
+        ##Integer sums are exact, so the variance does not drift as planes are added
+        sum_img = np.zeros(img_shape, dtype=np.int64)
+        sq_sum_img = np.zeros(img_shape, dtype=np.int64)
+        for plane in planes:
+            img3D_norm[plane] = normalize_plane(img_stack[plane])
+
+            img_clahe = clahe.apply(img3D_norm[plane])
+            p1, p2 = hist_percentile(img_clahe, perc_range)
+            img3D_rescale[plane] = cv2.LUT(img_clahe, _rescale_lut(p1, p2))
+
+            img_rescale = img3D_rescale[plane].astype(np.int64)
+            sum_img += img_rescale
+            sq_sum_img += img_rescale * img_rescale
+        return sum_img, sq_sum_img
+
+    chunk_sums = map_planes(contrast_chunk, _chunks(zslice_count, threads), threads)
+    sum_img = sum(chunk[0] for chunk in chunk_sums)
+    sq_sum_img = sum(chunk[1] for chunk in chunk_sums)
+
+    var_img = (sq_sum_img * zslice_count - sum_img * sum_img) / zslice_count**2
+    sd_proj = np.sqrt(var_img)
+    sd_proj = np.uint8(cv2.normalize(sd_proj, None, 0, 255, cv2.NORM_MINMAX))
+
+    return img3D_norm, img3D_rescale, sd_proj
+#*********************************************************************************************#
+def clahe_3D(img_stack, kernel_size = [270,404], cliplim = 0.004, threads = 1):
     """Performs the contrast limited adaptive histogram equalization on the stack of images"""
     if img_stack.ndim == 2: img_stack = np.array([img_stack])
 
     img3D_clahe = np.empty_like(img_stack, dtype='float64')
 
+    def clahe_plane(plane):
+        img3D_clahe[plane] = equalize_adapthist(img_stack[plane], kernel_size, clip_limit = cliplim)
+
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
         warnings.warn(UserWarning)##Images are acutally converted to uint16 for some reason
 
-        for plane, image in enumerate(img_stack):
-            img3D_clahe[plane] = equalize_adapthist(image, kernel_size, clip_limit = cliplim)
+        map_planes(clahe_plane, range(len(img_stack)), threads)
 
     return img3D_clahe
 #*********************************************************************************************#
-def cv2_clahe_3D(img3D, kernel_size = (8,8), cliplim = 156):
+def cv2_clahe_3D(img3D, kernel_size = (8,8), cliplim = 156, threads = 1):
     """Performs the contrast limited adaptive histogram equalization on the stack of images"""
-    if img3D.ndim == 2: img3D = np.array([img_stack])
+    if img3D.ndim == 2: img3D = np.array([img3D])
 
-    clahe = cv2.createCLAHE(clipLimit=cliplim, tileGridSize=kernel_size)
+    ##CLAHE objects keep internal buffers, so each thread gets its own
+    local = threading.local()
+    def clahe_plane(plane):
+        if not hasattr(local, 'clahe'):
+            local.clahe = cv2.createCLAHE(clipLimit=cliplim, tileGridSize=kernel_size)
+        img3D_clahe[plane] = local.clahe.apply(img3D[plane])
 
     img3D_clahe = np.empty_like(img3D, dtype=img3D.dtype)
-    for plane, img in enumerate(img3D):
-        img3D_clahe[plane] = clahe.apply(img)
+    map_planes(clahe_plane, range(len(img3D)), threads)
 
     return img3D_clahe
 #*********************************************************************************************#
-def rescale_3D(img_stack, perc_range = (2,98)):
+def rescale_3D(img_stack, perc_range = (2,98), threads = 1):
     """Streches the histogram for all images in stack to further increase contrast"""
     img3D_rescale = np.empty_like(img_stack)
-    for plane, image in enumerate(img_stack):
-        p1,p2 = np.percentile(image, perc_range)
-        img3D_rescale[plane] = rescale_intensity(image, in_range=(p1,p2))
+    def rescale_plane(plane):
+        image = img_stack[plane]
+        if image.dtype == np.uint8:
+            p1,p2 = hist_percentile(image, perc_range)
+            img3D_rescale[plane] = cv2.LUT(image, _rescale_lut(p1, p2))
+        else:
+            p1,p2 = np.percentile(image, perc_range)
+            img3D_rescale[plane] = rescale_intensity(image, in_range=(p1,p2))
+
+    map_planes(rescale_plane, range(len(img_stack)), threads)
     return img3D_rescale
 #*********************************************************************************************#
 def cv2_rescale_3D(img_stack):
@@ -280,19 +513,22 @@ def cv2_rescale_3D(img_stack):
         img3D_rescale[plane] = cv2.equalizeHist(image)
     return img3D_rescale
 #*********************************************************************************************#
-def masker_3D(image_stack, mask, filled = False, fill_val = 0):
+def masker_3D(image_stack, mask, filled = False, fill_val = 0, threads = 1):
     """Masks all images in stack so only areas not masked (the spot) are quantified.
     Setting filled = True will return a normal array with fill_val filled in on the masked areas.
     Default filled = False returns a numpy masked array."""
 
-    pic3D_masked = np.ma.empty_like(image_stack)
+    ##The mask is allocated up front, so planes written from different threads never replace it
+    pic3D_masked = np.ma.array(np.empty_like(image_stack), mask=np.zeros(np.shape(image_stack), dtype=bool))
     pic3D_filled = np.empty_like(image_stack)
 
-    for plane, image in enumerate(image_stack):
-        pic3D_masked[plane] = np.ma.array(image, mask = mask)
+    def mask_plane(plane):
+        pic3D_masked[plane] = np.ma.array(image_stack[plane], mask = mask)
         if filled == True:
             pic3D_filled[plane] = pic3D_masked[plane].filled(fill_value = fill_val)
 
+    map_planes(mask_plane, range(len(image_stack)), threads)
+
     if filled == False:
         return pic3D_masked
     else:
@@ -375,43 +611,23 @@ def measure_shift(marker_dict, pass_num, spot_num, mode = 'baseline'):
     return tuple(mean_shift), overlay_toggle
 #*********************************************************************************************#
 def measure_shift_ORB(img1, img2, ham_thresh=10, show=False):
-    match_ct = 0
-    while match_ct <= 2:
-        #Convert images to 8-bit for OpenCV compatibility
-        img1=np.uint8(cv2.normalize(img1, None, 0, 255, cv2.NORM_MINMAX))
-        img2=np.uint8(cv2.normalize(img2, None, 0, 255, cv2.NORM_MINMAX))
-
-        # Initiate ORB detector
-        orb = cv2.ORB_create()
-
-        # find the keypoints and descriptors with ORB
-        kp1, des1 = orb.detectAndCompute(img1,None)
-        kp2, des2 = orb.detectAndCompute(img2,None)
-
-        # create BFMatcher object
-        bruteforce = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
-
-        # Match descriptors
-        matches = bruteforce.match(des1,des2)
-        #Throw out all but best descriptors based on Hamming distance
-        matches = [match for match in matches if match.distance <= ham_thresh]
-
-        match_ct = len(matches)
-        #Increase threshold until a few matches are found
-        if match_ct <= 2:
-            ham_thresh += 2
-            print("No matches... increasing Hamming distance threshold to {}\n".format(ham_thresh))
-
-    print('Matched {} descriptors'.format(match_ct))
-
-    # Sort them in the order of their Hamming distance.
-    # matches = sorted(matches, key = lambda x:x.distance)
+    """
+    Row, Column shift of img2 relative to img1 from matched ORB descriptors (see vregister.orb_shift).
+    The Hamming distance threshold is loosened until a few matches are found, up to a limit;
+    returns None if there are still too few.
+    """
+    #Convert images to 8-bit for OpenCV compatibility
+    img1=np.uint8(cv2.normalize(img1, None, 0, 255, cv2.NORM_MINMAX))
+    img2=np.uint8(cv2.normalize(img2, None, 0, 255, cv2.NORM_MINMAX))
 
-    #Measure the pixel shift for each descriptor
-    shift_array = np.array([np.subtract(kp2[mat.trainIdx].pt, kp1[mat.queryIdx].pt) for mat in matches])
+    kp1, des1 = vregister.orb_features(img1)
+    kp2, des2 = vregister.orb_features(img2)
 
-    #Get the median value of all measured shifts and convert into a Row, Column format tuple
+    shift, confidence, matches = vregister.orb_shift((kp1, des1), (kp2, des2), ham_thresh=ham_thresh)
 
+    print('Matched {} descriptors'.format(len(matches)))
+    if shift is None:
+        return None
 
     # Draw first 20 matches.
     if show == True:
@@ -422,43 +638,63 @@ def measure_shift_ORB(img1, img2, ham_thresh=10, show=False):
 
         plt.imshow(img3),plt.show()
 
-    return (round(np.median(shift_array[:,1]),0), round(np.median(shift_array[:,0]),0))
+    #Get the median value of all measured shifts as a Row, Column format tuple
+    return (round(shift[0],0), round(shift[1],0))
 #*********************************************************************************************#
-def overlayer(bot_img, top_img, mean_shift):
+def _shift_slices(shape, shift):
+    """
+    Destination and source slices that move an image by shift (rows, cols), rounded up like
+    the shifts have always been: positive shifts move the content down/right, negative up/left
+    """
+    dst, src = [], []
+    for size, pix in zip(shape, shift):
+        pix = int(math.ceil(pix))
+        pix = max(-size, min(size, pix))
+        if pix >= 0:
+            dst.append(slice(pix, size))
+            src.append(slice(0, size - pix))
+        else:
+            dst.append(slice(0, size + pix))
+            src.append(slice(-pix, size))
 
-    nrows, ncols = bot_img.shape
+    return tuple(dst), tuple(src)
+#*********************************************************************************************#
+def shift_image(img, mean_shift, out=None, fill=0):
+    """
+    Moves a 2D image by mean_shift (rows, cols), filling the uncovered edge with fill.
+    Writes into out if it is given (it must not be img), so a buffer can be reused pass to pass.
+    """
+    if out is None:
+        out = np.empty_like(img)
+    dst, src = _shift_slices(img.shape, mean_shift)
+    out.fill(fill)
+    out[dst] = img[src]
 
-    vshift, hshift = mean_shift
-    vshift = int(math.ceil(vshift))
-    hshift = int(math.ceil(hshift))
+    return out
+#*********************************************************************************************#
+def overlay_difference(bot_img, top_img, mean_shift, out=None):
+    """
+    top_img minus bot_img moved by mean_shift, as int16; the same as the channel 1 minus
+    channel 0 difference of overlayer, without building the shifted image or the overlay
+    """
+    if out is None:
+        out = np.empty(top_img.shape, dtype=np.int16)
+    out[...] = top_img
+    dst, src = _shift_slices(bot_img.shape, mean_shift)
+    out[dst] -= bot_img[src].astype(np.int16, copy=False)
 
-    try:
-        bot_img
-    except NameError:
-        print("Cannot overlay images")
-    else:
-        if vshift < 0:
-            vshift = abs(vshift)
-            bot_img = np.delete(bot_img, np.s_[0:vshift], axis = 0)
-            bot_img = np.append(bot_img, np.zeros((vshift,ncols)), axis=0)
-            # top_img = np.delete(top_img, np.s_[-vshift:], axis = 0)
-        elif vshift > 0:
-            bot_img = np.delete(bot_img, np.s_[-vshift:], axis = 0)
-            bot_img = np.insert(bot_img, 0, np.zeros((vshift,ncols)), axis = 0)
-            # top_img = np.delete(top_img, np.s_[0:vshift], axis = 0)
-
-        if hshift < 0:
-            hshift = abs(hshift)
-            bot_img = np.delete(bot_img, np.s_[0:hshift], axis = 1)
-            bot_img = np.append(bot_img, np.zeros((nrows,hshift)), axis=1)
-            # top_img = np.delete(top_img, np.s_[-abs(hshift):], axis = 1)
-        elif hshift > 0:
-            bot_img = np.delete(bot_img, np.s_[-hshift:], axis = 1)
-            bot_img = np.insert(bot_img, [0], np.zeros((nrows,hshift)), axis=1)
-            # top_img = np.delete(top_img, np.s_[0:abs(hshift)], axis = 1)
-
-        return np.dstack((bot_img, top_img, np.zeros_like(bot_img)))
+    return out
+#*********************************************************************************************#
+def overlayer(bot_img, top_img, mean_shift):
+    """
+    RGB overlay of bot_img moved by mean_shift (red) and top_img (green).
+    The loop only needs the difference of the two; see overlay_difference
+    """
+    img_overlay = np.zeros(top_img.shape + (3,), dtype=np.result_type(bot_img, top_img))
+    shift_image(bot_img, mean_shift, out=img_overlay[:,:,0])
+    img_overlay[:,:,1] = top_img
 
+    return img_overlay
 #*********************************************************************************************#
 def prescan_subtractor(overlay_dict, overlay_toggle, spot_num, pass_num, mean_shift, mode ='baseline'):
     vshift = int(np.ceil(mean_shift[0]))
@@ -526,22 +762,5 @@ def shape_mask_shift(shape_mask, mean_shift):
     Shifts the before-and-after images so that old particles will be masked and not counted in
     the new image
     """
-    vshift = int(np.ceil(mean_shift[0]))
-    hshift = int(np.ceil(mean_shift[1]))
-
-    if vshift > 0:
-        shape_mask = np.delete(shape_mask, np.s_[-abs(vshift):], axis = 0)
-        shape_mask = np.insert(shape_mask, np.s_[0:abs(vshift)], False, axis = 0)
-    elif vshift < 0:
-        shape_mask = np.delete(shape_mask, np.s_[0:abs(vshift)], axis = 0)
-        shape_mask = np.insert(shape_mask, np.s_[-abs(vshift):], False, axis = 0)
-
-    if hshift > 0:
-        shape_mask = np.delete(shape_mask, np.s_[-abs(hshift):], axis = 1)
-        shape_mask = np.insert(shape_mask, np.s_[0:abs(hshift)], False, axis = 1)
-    elif hshift < 0:
-        shape_mask = np.delete(shape_mask, np.s_[0:abs(hshift)], axis = 1)
-        shape_mask = np.insert(shape_mask, np.s_[-abs(hshift):], False, axis = 1)
-
-    return shape_mask
+    return shift_image(shape_mask, mean_shift, fill=False)
 #*********************************************************************************************#
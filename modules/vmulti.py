@@ -0,0 +1,98 @@
+from __future__ import division
+from multiprocessing import cpu_count
+from timeit import default_timer
+import pandas as pd
+import os
+from modules import vprofile, vrender, vworkers
+#*********************************************************************************************#
+#
+#           SUBROUTINES
+#
+#*********************************************************************************************#
+def _spot_task(task):
+    """
+    Runs vloop.main_loop on a single spot and times it.
+    Everything the spot needs is passed in, so no state is shared between tasks.
+    The spot chosen with params_dict['profile_spot'] is also run under cProfile.
+    Figures that failed to render in line are returned for the report of vrender.wait.
+    """
+    from vloop import main_loop
+
+    spot_num, pps_list, mirror, params_dict = task
+    profile_file = None
+    if spot_num == params_dict['profile_spot']:
+        profile_file = '{}/v3-analysis/{}.{}.prof'.format(os.getcwd(), pps_list[0].split(".")[0],
+                                                          str(spot_num).zfill(3))
+    start = default_timer()
+    with vprofile.profiled(profile_file):
+        spot_vdata, zslice_count, stage_times = main_loop(pps_list, mirror, params_dict)
+    spot_time = default_timer() - start
+
+    return spot_num, spot_vdata, zslice_count, spot_time, os.getpid(), stage_times, vrender.pop_failures()
+#*********************************************************************************************#
+def spot_tasker(image_list, spot_nums, mirror, params_dict):
+    """Groups the image files by spot number so each spot can be scanned as its own task"""
+    spot_files = {}
+    for file in image_list:
+        spot_files.setdefault(int(file.split(".")[1]), []).append(file)
+
+    return [(spot_num, sorted(spot_files[spot_num]), mirror, params_dict)
+            for spot_num in spot_nums if spot_num in spot_files]
+#*********************************************************************************************#
+def multip_main_loop(spot_tasks, workers=1, render_workers=0):
+    """
+    Scans every spot in spot_tasks, using a pool of worker processes when workers > 1.
+    A scan in this process draws its figures with render_workers background processes (see
+    vrender); the worker processes draw their own.
+    Prints the wall-clock time for each spot as it finishes and returns a DataFrame
+    with one row per scanned pass, the z-slice count of the stacks and a DataFrame
+    of the stage timings of every pass (see vprofile.timing_frame).
+    """
+    if workers < 1:
+        workers = cpu_count()
+    workers = min(workers, len(spot_tasks))
+
+    start = default_timer()
+    spot_results = []
+    if workers <= 1:
+        vrender.start(render_workers)
+        for task in spot_tasks:
+            spot_results.append(_spot_task(task))
+            _spot_report(*spot_results[-1])
+    else:
+        ##No render pool yet: its threads would make forking the spot pool unsafe (see vworkers)
+        p = vworkers.worker_context().Pool(workers, initializer=vworkers.init_figure_worker)
+        try:
+            for result in p.imap_unordered(_spot_task, spot_tasks):
+                spot_results.append(result)
+                _spot_report(*result)
+        finally:
+            p.close()
+            p.join()
+
+    print("Finished scanning {} spot(s) in {} s using {} process(es)\n".format(len(spot_results),
+                                                                               round(default_timer()-start,1),
+                                                                               max(workers,1))
+    )
+    spot_results.sort(key=lambda result: result[0])
+
+    scan_df = pd.DataFrame([vdata for result in spot_results for vdata in result[1]])
+    if not scan_df.empty:
+        scan_df['spot_number'] = scan_df.img_name.apply(lambda x: int(x.split('.')[1]))
+        scan_df['scan_number'] = scan_df.img_name.apply(lambda x: int(x.split('.')[2]))
+        spot_times = {result[0]: round(result[3],2) for result in spot_results}
+        scan_df['spot_scan_time'] = scan_df.spot_number.map(spot_times)
+
+    zslice_count = max([result[2] for result in spot_results], default=0)
+
+    timing_df = vprofile.timing_frame([result[5] for result in spot_results])
+    for result in spot_results:
+        vrender.add_failures(result[6])
+
+    return scan_df, zslice_count, timing_df
+#*********************************************************************************************#
+def _spot_report(spot_num, spot_vdata, zslice_count, spot_time, pid, stage_times, render_failures):
+    print("#******************Spot {} scanned: {} pass(es) in {} s (process {})************************#\n".format(
+          spot_num, len(spot_vdata), round(spot_time,1), pid)
+    )
+#*********************************************************************************************#
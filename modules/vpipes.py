@@ -7,7 +7,8 @@ import seaborn as sns
 from skimage import io as skio
 from skimage.external.tifffile import TiffWriter, TiffFile
 
-import os, json, math, warnings, sys, glob, zipfile, re
+import os, json, math, warnings, sys, glob, zipfile, re, argparse, multiprocessing, threading
+from modules import vworkers
 #*********************************************************************************************#
 #
 #           SUBROUTINES
@@ -19,6 +20,108 @@ import os, json, math, warnings, sys, glob, zipfile, re
 #
 #     return '0'*(3 - len(number)) + number
 #*********************************************************************************************#
+def spot_range_parser(spot_str):
+    """Turns a spot selection such as '3-9', '2,5,8' or '1-4,7' into a sorted list of spot numbers"""
+    spot_nums = set()
+    try:
+        for part in spot_str.split(','):
+            if '-' in part:
+                first, last = map(int, part.split('-'))
+                spot_nums.update(range(first, last + 1))
+            else:
+                spot_nums.add(int(part))
+    except ValueError:
+        raise argparse.ArgumentTypeError("Invalid spot selection: {}".format(spot_str))
+    return sorted(spot_nums)
+#*********************************************************************************************#
+def _excise_parser(excise_str):
+    """'none' keeps every spot; otherwise a spot selection as in spot_range_parser"""
+    if excise_str.lower() in ('none', 'n', 'no'):
+        return []
+    return spot_range_parser(excise_str)
+#*********************************************************************************************#
+def _config_line_parser(arg_line):
+    """Lets @config files hold one 'option value' pair per line, with # comments"""
+    return arg_line.split('#')[0].split()
+#*********************************************************************************************#
+def get_arg_parser(version=''):
+    """
+    Command-line front end shared by the VIRAGO scripts. Options can also be read from a
+    config file given as @file.txt (one option per line). Any answer that is left out is
+    asked for interactively, as before, unless --batch is given (see batch_defaults).
+    """
+    parser = argparse.ArgumentParser(description="VIRAGO {}: IRIS particle counting".format(version),
+                                     fromfile_prefix_chars='@')
+    parser.convert_arg_line_to_args = _config_line_parser
+
+    parser.add_argument("iris_path", nargs='?', default=None,
+                        help="Folder that contains the IRIS data")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of spots to scan in parallel (0 = one per CPU core)")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="Threads each spot uses for per-plane image operations (0 = one per CPU core)")
+    parser.add_argument("--convert-tiff", dest='convert_tiff', choices=['y','n'], default=None,
+                        help="Convert PGM stacks to TIFFs")
+    parser.add_argument("--spots", type=spot_range_parser, default=None,
+                        help="Spots to scan, e.g. 3-9, 2,5,8 or 4")
+    parser.add_argument("--stage", nargs='+', choices=['scan','aggregate','plot'], default=None,
+                        help="Pipeline stages to run (plot also aggregates); default is all of them")
+    parser.add_argument("--contrast", default=None,
+                        help="Minimum and maximum percent intensity values, separated by a dash (e.g. 0-20)")
+    parser.add_argument("--remove-spots", dest='remove_spots', type=_excise_parser, default=None,
+                        help="Spots to remove from the analysis (e.g. 3,5), or 'none'")
+    parser.add_argument("--sample-name", dest='sample_name', default=None,
+                        help="Sample descriptor (e.g. VSV-MARV@1E6 PFU/mL)")
+    parser.add_argument("--cache-gb", dest='cache_gb', type=float, default=5,
+                        help="Disk space for cached intermediate images, in GB (0 = no cache)")
+    parser.add_argument("--data-format", dest='data_format', choices=['parquet','csv'], default='parquet',
+                        help="Format of the vdata and particle tables (parquet needs pyarrow or fastparquet)")
+    parser.add_argument("--profile-spot", dest='profile_spot', type=int, default=None,
+                        help="Spot to run under cProfile; the stats are written to v3-analysis/CHIP.SPOT.prof")
+    parser.add_argument("--render-workers", dest='render_workers', type=int, default=1,
+                        help="Processes that draw the figures in the background (0 = draw them in line). "
+                             + "With --workers > 1 each spot process draws its own images and the render "
+                             + "processes only start after the scan, for the chip figures")
+    parser.add_argument("--register-levels", dest='register_levels', type=int, default=0,
+                        help="Pyramid levels for registering passes (0 = none); with 2, large shifts are refined "
+                             + "on the scene both passes share, which keeps their confidence up")
+    parser.add_argument("--no-particle-labels", dest='particle_labels', action='store_false',
+                        help="Leave the label: intensity text off the particle images (much faster to render)")
+    parser.add_argument("--batch", action='store_true',
+                        help="Never prompt (for cluster jobs): PGMs are not converted, every spot is scanned "
+                             + "and none are removed unless told otherwise; iris_path and --contrast are required")
+    return parser
+#*********************************************************************************************#
+def batch_defaults(parser, args, stages):
+    """
+    With --batch, fills in the non-interactive defaults of the answers that were left out and
+    stops with a parser error if one without a default is missing, before any work is done.
+    """
+    if not args.batch:
+        return args
+    if args.iris_path is None:
+        parser.error("--batch needs the iris_path argument")
+    if (args.contrast is None) and (('aggregate' in stages) or ('plot' in stages)):
+        parser.error("--batch needs --contrast for the aggregate and plot stages")
+    if args.convert_tiff is None:
+        args.convert_tiff = 'n'
+    if args.remove_spots is None:
+        args.remove_spots = []
+
+    return args
+#*********************************************************************************************#
+def ask(prompt, option, batch=False):
+    """
+    input(prompt) for an answer that was not given as an argument. In batch mode, or when stdin
+    is closed (e.g. a cluster job), exits with an error naming the option to give instead.
+    """
+    if not batch:
+        try:
+            return input(prompt)
+        except EOFError:
+            pass
+    sys.exit("\nNo terminal to ask: {}\nPlease give {}".format(prompt.strip(), option))
+#*********************************************************************************************#
 def find_file(name, path):
     for root, dirs, files in os.walk(path):
         if name in files:
@@ -135,19 +238,6 @@ def get_chip_params(chipFile, Ab_spot_mode):
     #     params_dict['perc_range'] = (3,97)
     return params_dict
 #*********************************************************************************************#
-def sample_namer(iris_path):
-    if sys.platform == 'win32':
-        folder_name = iris_path.split("\\")[-1]
-    elif sys.platform == 'darwin':
-        folder_name = iris_path.split("/")[-1]
-    else: folder_name = ''
-
-    if len(folder_name.split("_")) == 2:
-        sample_name = folder_name.split("_")[-1]
-    else:
-        sample_name = input("\nPlease enter a sample descriptor (e.g. VSV-MARV@1E6 PFU/mL)\n")
-    return sample_name
-#*********************************************************************************************#
 # def write_vdata(dir, filename, list_of_vals):
 #     with open(dir + '/' + filename + '.vdata.txt', 'w') as vdata_file:
 #         vdata_file.write((
@@ -215,9 +305,119 @@ def load_image(img_stack, tiff_toggle):
         pic3D = np.array([pic for pic in scan_collection], dtype='uint16')
 
     return pic3D
-
 #*********************************************************************************************#
+def _pgm_header(pgm_file):
+    """Reads a binary (P5) PGM header; returns (rows, cols, dtype, data offset), or None for other formats"""
+    with open(pgm_file, 'rb') as f:
+        head = f.read(512)
+    if not head.startswith(b'P5'):
+        return None
+
+    fields, pos = [], 2
+    while len(fields) < 3:
+        while head[pos:pos+1].isspace():
+            pos += 1
+        if head[pos:pos+1] == b'#':
+            pos = head.index(b'\n', pos)
+            continue
+        end = pos
+        while not head[end:end+1].isspace():
+            end += 1
+        fields.append(int(head[pos:end]))
+        pos = end
+    cols, rows, maxval = fields
+    dtype = np.dtype('>u2') if maxval > 255 else np.dtype('u1')
+
+    return rows, cols, dtype, pos + 1
+#*********************************************************************************************#
+def _tiff_page_offset(tif, page):
+    """Byte offset of a page's pixel data if it is stored uncompressed in one block, else None"""
+    contiguous = getattr(page, 'is_contiguous', None)
+    if isinstance(contiguous, tuple):
+        return contiguous[0]
+    if (contiguous == True) & (page.compression in (1, None)):
+        return page.dataoffsets[0]
+    return None
+#*********************************************************************************************#
+class LazyStack(object):
+    """
+    A z-stack whose slices are read only when asked for. Uncompressed TIFF pages and binary
+    PGM images are memory-mapped; compressed TIFF pages are decoded one at a time.
+    If a mirror image the size of a slice is given, every slice comes back flat-field
+    corrected (slice / mirror) as float32.
+    Supports len(), stack[z] and stack[:, rows, cols], and np.asarray(stack).
+    """
+    def __init__(self, img_stack, tiff_toggle, mirror=None):
+        self.files = tuple(img_stack)
+        self._tif = None
+        self._slices = []
+        self._lock = threading.Lock()
+        if tiff_toggle == True:
+            self._tif = TiffFile(img_stack[0])
+            for page in self._tif.pages:
+                offset = _tiff_page_offset(self._tif, page)
+                if offset is None:
+                    self._slices.append(page)
+                else:
+                    dtype = np.dtype(page.dtype).newbyteorder(self._tif.byteorder)
+                    self._slices.append(np.memmap(img_stack[0], dtype=dtype, mode='r',
+                                                  offset=offset, shape=page.shape))
+        else:
+            for pgm_file in img_stack:
+                header = _pgm_header(pgm_file)
+                if header is None:
+                    self._slices.append(skio.imread(pgm_file).astype('uint16'))
+                else:
+                    rows, cols, dtype, offset = header
+                    self._slices.append(np.memmap(pgm_file, dtype=dtype, mode='r',
+                                                  offset=offset, shape=(rows, cols)))
+
+        nrows, ncols = self._read(0).shape
+        self.shape = (len(self._slices), nrows, ncols)
+        self.ndim = 3
+
+        if (mirror is not None) and (np.size(mirror) == nrows * ncols):
+            self.mirror = np.asarray(mirror, dtype=np.float32).reshape(nrows, ncols)
+            self.dtype = np.dtype(np.float32)
+        else:
+            self.mirror = None
+            self.dtype = np.dtype('uint16')
+
+    def _read(self, z):
+        img_slice = self._slices[z]
+        if not isinstance(img_slice, np.ndarray):
+            ##Compressed pages share one file handle, so threads take turns decoding them
+            with self._lock:
+                img_slice = img_slice.asarray()
+        return img_slice
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        z_key, xy_key = key[0], key[1:]
+
+        if isinstance(z_key, (int, np.integer)):
+            img_slice = self._read(z_key)
+            if self.mirror is not None:
+                img_slice = img_slice.astype(np.float32) / self.mirror
+            else:
+                img_slice = img_slice.astype(self.dtype, copy=False)
+            return img_slice[xy_key] if xy_key else np.asarray(img_slice)
+
+        return np.stack([self[(z,) + xy_key] for z in range(self.shape[0])[z_key]])
+
+    def __array__(self, dtype=None, copy=None):
+        pic3D = self[:]
+        return pic3D if dtype is None else pic3D.astype(dtype)
 
+    def close(self):
+        self._slices = []
+        if self._tif is not None:
+            self._tif.close()
+#*********************************************************************************************#
 def mirror_finder(pgm_list):
     regex = re.compile('000\.000')
     mirror_list = list(filter(regex.search, pgm_list))
@@ -233,14 +433,22 @@ def mirror_finder(pgm_list):
         mirror = np.ones(shape = 1, dtype = int)
     return pgm_list, mirror
 #*********************************************************************************************#
-def sample_namer(iris_path):
-    if sys.platform == 'win32': folder_name = iris_path.split("\\")[-1]
-    elif sys.platform == 'darwin': folder_name = iris_path.split("/")[-1]
-    else: folder_name = ''
+def sample_namer(iris_path, sample_name=None, batch=False):
+    """
+    Takes the sample descriptor from the data folder name (CHIPNAME_sample), unless one is given.
+    Folders named otherwise are asked about, or used whole in batch mode.
+    """
+    if sample_name:
+        return sample_name
+    if sys.platform == 'win32': folder_name = iris_path.rstrip("\\").split("\\")[-1]
+    else: folder_name = iris_path.rstrip("/").split("/")[-1]
     if len(folder_name.split("_")) == 2:
         sample_name = folder_name.split("_")[-1]
+    elif batch:
+        sample_name = folder_name
+        print("No sample name in the folder name; using {}\n".format(sample_name))
     else:
-        sample_name = input("\nPlease enter a sample descriptor (e.g. VSV-MARV@1E6 PFU/mL)\n")
+        sample_name = ask("\nPlease enter a sample descriptor (e.g. VSV-MARV@1E6 PFU/mL)\n", '--sample-name')
     return sample_name
 #*********************************************************************************************#
 def zipper(filename, filelist, compression='zip', iris_path=os.getcwd()):
@@ -251,16 +459,17 @@ def zipper(filename, filelist, compression='zip', iris_path=os.getcwd()):
     elif compression == 'bz2':
         zMODE = zipfile.ZIP_BZIP2
 
-    if not os.path.exists('archive'):
-        os.makedirs('archive')
+    os.makedirs(iris_path + '/archive', exist_ok=True)
 
-    zf = zipfile.ZipFile(iris_path +'/archive/'+filename+'.'+compression, mode='w')
-    for file in filelist:
-        zf.write(file,compress_type=zMODE)
-        print("{} added to {}.{}".format(file, filename, compression))
+    zip_name = iris_path +'/archive/'+filename+'.'+compression
+    with zipfile.ZipFile(zip_name + '.part', mode='w') as zf:
+        for file in filelist:
+            zf.write(file,compress_type=zMODE)
+            print("{} added to {}.{}".format(file, filename, compression))
+    os.replace(zip_name + '.part', zip_name)
 #*********************************************************************************************#
 def iris_txt_reader(iris_txt, mAb_dict, pass_counter):
-    spot_df = pd.DataFrame()
+    spot_data_list = []
     for ix, txtfile in enumerate(iris_txt):
         spot_ix = ix+1
         dict_vals = mAb_dict[spot_ix]
@@ -288,7 +497,9 @@ def iris_txt_reader(iris_txt, mAb_dict, pass_counter):
             print("Missing text file for spot {}\n".format(txtfile))
             spot_data_solo['scan_time'] = [0] * pass_counter
             expt_date = None
-        spot_df = spot_df.append(spot_data_solo, ignore_index = True)
+        spot_data_list.append(spot_data_solo)
+
+    spot_df = pd.concat(spot_data_list, ignore_index = True) if spot_data_list else pd.DataFrame()
 
     return spot_df, expt_date
 #*********************************************************************************************#
@@ -301,17 +512,43 @@ def pgm_to_tiff(pic3D, img_name, stack_list, tiff_compression = 1, archive_pgm=F
     # stack_name = '.'.join(pgm_name[:-2])
     tiff_name = img_name + '.tif'
 
-    with TiffWriter(tiff_name, imagej=True) as tif_img:
+    ##Written under a temporary name so an interrupted write never leaves a truncated TIFF behind
+    with TiffWriter(tiff_name + '.part', imagej=True) as tif_img:
         for i in range(pic3D.shape[0]):
             tif_img.save(pic3D[i], compress = tiff_compression)
-        print("TIFF file generated: {}".format(tiff_name))
 
     if archive_pgm == True:
         zipper(img_name, stack_list, compression='bz2', iris_path=os.getcwd())
+
+    os.replace(tiff_name + '.part', tiff_name)
+    print("TIFF file generated: {}".format(tiff_name))
+
     for pgm in stack_list:
         os.remove(pgm)
 #*********************************************************************************************#
-def tiff_maker(pgm_list, tiff_compression = 1, archive = True):
+def _tiff_task(task):
+    """Decodes, writes and archives one PGM stack; run on the tiff_maker worker pool"""
+    pgm_name, stack_list, tiff_compression, archive = task
+    pic3D = np.asarray(LazyStack(stack_list, False))
+
+    pgm_to_tiff(pic3D, pgm_name, stack_list, tiff_compression=tiff_compression, archive_pgm=archive)
+
+    return pgm_name
+#*********************************************************************************************#
+def _read_manifest(manifest_file):
+    if not os.path.exists(manifest_file):
+        return set()
+    with open(manifest_file) as f:
+        return set(line.strip() for line in f if line.strip())
+#*********************************************************************************************#
+def tiff_maker(pgm_list, tiff_compression = 1, archive = True, workers = 1):
+    """
+    Converts every PGM stack in pgm_list into a single TIFF.
+    Stacks are converted on a pool of worker processes when workers > 1 (workers < 1 uses all cores),
+    so only one stack per worker is held in memory at a time.
+    Finished stacks are recorded in CHIPNAME.tiff_manifest.txt, and stacks already listed there
+    are skipped, so an interrupted conversion picks up where it stopped when run again.
+    """
     chip_name = pgm_list[0].split(".")[0]
 
     pgm_list, mirror = mirror_finder(pgm_list)
@@ -320,40 +557,52 @@ def tiff_maker(pgm_list, tiff_compression = 1, archive = True):
         pgm_list = [file for file in pgm_list if file not in fluor_files]
         print("Fluorescent channel(s) detected, will not be converted to TIFF\n")
 
-
-
-    pgm_set = set([".".join(file.split(".")[:3]) for file in pgm_list])
-
-    spot_counter = max([int(pgmfile.split(".")[1]) for pgmfile in pgm_list])##Important
-    zslice_count = max([int(pgmfile.split(".")[3]) for pgmfile in pgm_list])
-
-    print("There are {} PGM images, in stacks of {}.\n".format(len(pgm_list), zslice_count))
-
-    pass_counter = int(max([pgm.split(".")[2] for pgm in pgm_list]))##Important
-
-    spot_to_scan = 1
-
-    while spot_to_scan <= spot_counter:
-        print(spot_to_scan)
-
-        pps_list = sorted([file for file in pgm_set if int(file.split(".")[1]) == spot_to_scan])
-        passes_per_spot = len(pps_list)
-
-        if passes_per_spot == 0:
-            print("No pgm files for spot {} \n".format(spot_to_scan))
-
+    stack_dict = {}
+    for file in pgm_list:
+        stack_dict.setdefault(".".join(file.split(".")[:3]), []).append(file)
+
+    zslice_count = max([len(stack_list) for stack_list in stack_dict.values()], default=0)
+    print("There are {} PGM images, in {} stacks of {}.\n".format(len(pgm_list), len(stack_dict), zslice_count))
+
+    manifest_file = '{}.tiff_manifest.txt'.format(chip_name)
+    finished = _read_manifest(manifest_file)
+
+    tiff_tasks = []
+    for pgm_name in sorted(stack_dict):
+        if pgm_name in finished:
+            continue
+        elif os.path.exists(pgm_name + '.tif'):
+            ##Stopped after the TIFF was written but before it was recorded; only the clean-up is left
+            for pgm in stack_dict[pgm_name]:
+                os.remove(pgm)
+            finished.add(pgm_name)
+            with open(manifest_file, 'a') as f:
+                f.write(pgm_name + '\n')
         else:
-            for scan in range(0,passes_per_spot,1):
+            tiff_tasks.append((pgm_name, sorted(stack_dict[pgm_name]), tiff_compression, archive))
 
-                stack_list = [file for file in pgm_list if file.startswith(pps_list[scan])]
-                pgm_name = ".".join(stack_list[0].split(".")[:3])
+    if len(finished) > 0:
+        print("{} stack(s) already converted, {} to go\n".format(len(finished), len(tiff_tasks)))
 
-                pic3D = np.array([pic for pic in skio.imread_collection(stack_list)],
-                                 dtype='uint16')
+    if workers < 1:
+        workers = multiprocessing.cpu_count()
+    workers = min(workers, len(tiff_tasks))
 
-                pgm_to_tiff(pic3D, pgm_name, stack_list,
-                            tiff_compression = tiff_compression, archive_pgm=archive)
-
-        spot_to_scan += 1
+    if workers <= 1:
+        tiff_results = map(_tiff_task, tiff_tasks)
+        p = None
+    else:
+        p = vworkers.worker_context().Pool(workers)
+        tiff_results = p.imap_unordered(_tiff_task, tiff_tasks)
+
+    try:
+        with open(manifest_file, 'a') as f:
+            for pgm_name in tiff_results:
+                f.write(pgm_name + '\n')
+                f.flush()
+    finally:
+        if p is not None:
+            p.close()
+            p.join()
 
     return sorted(glob.glob('{}.*.tif'.format(chip_name)))
@@ -0,0 +1,102 @@
+from __future__ import division
+from contextlib import contextmanager
+from timeit import default_timer
+import pandas as pd
+import cProfile, pstats, sys, time
+try:
+    import resource
+except ImportError: ##Not available on Windows; peak memory is then left blank
+    resource = None
+"""
+Per-stage instrumentation for the spot loop: wall time, CPU time and peak memory of each
+stage, for every spot and pass, plus an optional cProfile dump of a single spot.
+"""
+#*********************************************************************************************#
+#
+#           SUBROUTINES
+#
+#*********************************************************************************************#
+def peak_rss_mb():
+    """High-water mark of this process's resident memory, in MB"""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    ##ru_maxrss is in bytes on macOS and in kB everywhere else
+    if sys.platform == 'darwin':
+        return round(max_rss / 2**20, 1)
+    return round(max_rss / 2**10, 1)
+#*********************************************************************************************#
+class StageTimer(object):
+    """
+    Collects one record per stage of each pass:
+        with timer.stage('contrast', pass_num):
+            ...
+    The records can be returned from worker processes and gathered with timing_frame.
+    """
+    def __init__(self, spot_num):
+        self.spot_num = spot_num
+        self.records = []
+
+    @contextmanager
+    def stage(self, name, pass_num):
+        wall_start, cpu_start = default_timer(), time.process_time()
+        try:
+            yield
+        finally:
+            self.records.append({'spot_number': self.spot_num,
+                                 'pass_number': pass_num,
+                                 'stage'      : name,
+                                 'wall_s'     : round(default_timer() - wall_start, 4),
+                                 'cpu_s'      : round(time.process_time() - cpu_start, 4),
+                                 'peak_rss_mb': peak_rss_mb()
+            })
+#*********************************************************************************************#
+@contextmanager
+def profiled(profile_file=None):
+    """
+    Runs the enclosed code under cProfile and dumps the stats to profile_file
+    (readable with pstats or snakeviz), printing the 25 slowest calls. Does nothing if
+    profile_file is None.
+    """
+    if profile_file is None:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_file)
+        print("Profile written to {}\n".format(profile_file))
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+#*********************************************************************************************#
+def timing_frame(record_lists):
+    """One DataFrame of the stage records from every spot"""
+    columns = ['spot_number','pass_number','stage','wall_s','cpu_s','peak_rss_mb']
+    records = [record for record_list in record_lists for record in record_list]
+
+    return pd.DataFrame(records, columns=columns)
+#*********************************************************************************************#
+def timing_summary(timing_df):
+    """Total and per-pass time of each stage, slowest first, with the highest peak memory seen"""
+    if timing_df.empty:
+        return timing_df
+
+    summary_df = timing_df.groupby('stage', sort=False).agg(total_wall_s=('wall_s','sum'),
+                                                            mean_wall_s=('wall_s','mean'),
+                                                            total_cpu_s=('cpu_s','sum'),
+                                                            peak_rss_mb=('peak_rss_mb','max')
+    )
+    summary_df['perc_wall'] = (summary_df.total_wall_s * 100 / summary_df.total_wall_s.sum()).round(1)
+
+    return summary_df.sort_values('total_wall_s', ascending=False).round(3)
+#*********************************************************************************************#
+def write_timing_log(timing_df, timing_file):
+    """Writes the stage records as CSV and prints the per-stage summary"""
+    timing_df.to_csv(timing_file, index=False)
+    print("Stage timings written to {}\n".format(timing_file))
+    print(timing_summary(timing_df).to_string())
+    print()
+#*********************************************************************************************#
@@ -1,6 +1,7 @@
 from __future__ import division
 from future.builtins import input
 from scipy.ndimage.filters import gaussian_filter
+from scipy.ndimage import find_objects, binary_fill_holes
 # from scipy.ndimage.morphology import binary_dilation
 from scipy.spatial import cKDTree, Delaunay
 from scipy.spatial.distance import pdist, squareform
@@ -16,7 +17,18 @@ import pandas as pd
 import numpy as np
 import itertools as itt
 import math, warnings, re, os, glob
-from modules import vpipes,vimage
+from modules import vpipes,vimage,vfilo,vstore
+
+##Pixel classes of the shape index classification in vloop, as (shape index, tolerance);
+##'ridge_s' is the ridge class of the shape index map smoothed by SHAPE_SMOOTH_SIGMA
+SHAPE_CLASSES = {'background': (0, 0.25), 'ridge': (0.5, 0.25), 'sphere': (1, 0.2), 'ridge_s': (0.5, 0.3)}
+SHAPE_SMOOTH_SIGMA = 1
+##Intensity cutoffs of the ridge, sphere and ridge_s pixels, as (median, SD) multiples of the spot
+##background, for Exoviewer and in-liquid antibody spots and for chips without antibody spots
+SHAPE_THRESHOLDS = {'exo'     : ((3.5,0), (2.5,0), (3.5,0)),
+                    'liquid'  : ((1,2), (1,2), (1,3)),
+                    'no_spots': ((1,2.75), (1,2.75), (1,2.75))
+}
 #*********************************************************************************************#
 #
 #           SUBROUTINES
@@ -101,10 +113,10 @@ def bbox_verts(bbox):
 
     return np.array([(bbox0,bbox1),(bbox0, bbox3),(bbox2, bbox3),(bbox2, bbox1)])
 #*********************************************************************************************#
-def measure_focal_plane(pic3D_norm, marker_locs, exo_toggle, marker_shape):
+def measure_focal_plane(pic3D_norm, marker_locs, exo_toggle, marker_shape, threads=1):
     """
     Uses the markers in the 3D image to determine the best image in the z stack to collect data from
-    based on the defocus curve
+    based on the defocus curve. The planes of each marker are measured in parallel when threads != 1.
     """
     marker_h, marker_w =  marker_shape
     hmarker_h = marker_h // 2
@@ -123,7 +135,10 @@ def measure_focal_plane(pic3D_norm, marker_locs, exo_toggle, marker_shape):
                                           loc[1]-hmarker_w : loc[1]+hmarker_w
                 ]
 
-                teng_vals = [np.mean(sobel_h(img)**2 + sobel_v(img)**2) for img in marker3D_img]
+                teng_vals = vimage.map_planes(lambda z: np.mean(sobel_h(marker3D_img[z])**2
+                                                                + sobel_v(marker3D_img[z])**2),
+                                              range(len(marker3D_img)), threads
+                )
                 min_plane = teng_vals.index(min(teng_vals))
                 pos_vals = teng_vals[:min_plane]
                 if not pos_vals == []:
@@ -136,150 +151,252 @@ def measure_focal_plane(pic3D_norm, marker_locs, exo_toggle, marker_shape):
 
     return pos_plane_list
 #*********************************************************************************************#
-def classify_shape(shapedex, pic2D, shape, delta, intensity, operator = 'greater'):
+def classify_shape_mask(shapedex, pic2D, shape, delta, intensity, operator = 'greater'):
+    """Boolean mask of the pixels whose shape index is within delta of shape and pass the intensity cutoff"""
     with warnings.catch_warnings():
         ##RuntimeWarning ignored: invalid values are expected
         warnings.simplefilter("ignore")
         warnings.warn(RuntimeWarning)
         if operator == 'greater':
-            shape_y, shape_x = np.where((np.abs(shapedex - shape) <= delta) & (pic2D >= intensity))
+            shape_mask = (np.abs(shapedex - shape) <= delta) & (pic2D >= intensity)
         else:
-            shape_y, shape_x = np.where((np.abs(shapedex - shape) <= delta) & (pic2D <= intensity))
+            shape_mask = (np.abs(shapedex - shape) <= delta) & (pic2D <= intensity)
+    return shape_mask
+#*********************************************************************************************#
+def shape_thresholds(bg_median, bg_stdev, Ab_spot_mode, exo_toggle):
+    """The ridge, sphere and ridge_s intensity cutoffs of SHAPE_THRESHOLDS for a spot background"""
+    if Ab_spot_mode == False:
+        multiples = SHAPE_THRESHOLDS['no_spots']
+    elif exo_toggle == True:
+        multiples = SHAPE_THRESHOLDS['exo']
+    else:
+        multiples = SHAPE_THRESHOLDS['liquid']
+
+    return [bg_median*median_x + bg_stdev*stdev_x for median_x, stdev_x in multiples]
+#*********************************************************************************************#
+def classify_shape(shapedex, pic2D, shape, delta, intensity, operator = 'greater'):
+    shape_y, shape_x = np.where(classify_shape_mask(shapedex, pic2D, shape, delta, intensity, operator))
     return list(zip(shape_y, shape_x))
 #*********************************************************************************************#
-def binary_data_extraction(pic_binary, intensity_img, prop_list, pix_range):
+def label_pixel_counts(pic_label, pix_mask, labels):
+    """Counts, for each label in labels, how many of its pixels are set in pix_mask"""
+    counts = np.bincount(pic_label[pix_mask], minlength=pic_label.max() + 1)
+    return counts[np.asarray(labels)]
+#*********************************************************************************************#
+def label_coords(pic_label, labels):
+    """
+    Pixel coordinates of the given labels in CSR form: (offsets, rows, cols), where the
+    pixels of labels[k] are rows[offsets[k]:offsets[k+1]], cols[offsets[k]:offsets[k+1]],
+    in row-major order like regionprops coords
+    """
+    labels = np.asarray(labels, dtype=int)
+    label_index = np.zeros(pic_label.max() + 1, dtype=int)
+    label_index[labels] = np.arange(1, len(labels) + 1)
 
-    binary_props = regionprops(label(pic_binary, connectivity=2), intensity_img,
-                             coordinates='xy', cache=True
-    )
+    pixel_rows, pixel_cols = np.nonzero(pic_label)
+    pixel_ix = label_index[pic_label[pixel_rows, pixel_cols]]
+    in_labels = pixel_ix > 0
+    pixel_rows, pixel_cols, pixel_ix = pixel_rows[in_labels], pixel_cols[in_labels], pixel_ix[in_labels]
+
+    order = np.argsort(pixel_ix, kind='stable')
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(pixel_ix, minlength=len(labels) + 1)[1:])))
 
-    # with warnings.catch_warnings():
-    #     ##UserWarning ignored
-    #     warnings.simplefilter("ignore")
-    #     warnings.warn(UserWarning)
-    #     shape_df = pd.DataFrame([[region['label'],
-    #                               #[tuple(coords) for coords in region['coords']],
-    #                               region['coords'],
-    #                               region['moments'],
-    #                               region['moments_central'],
-    #                               region['moments_normalized'],
-    #                               region['bbox'],
-    #
-    #
-    #                               # region['centroid'],
-    #
-    #                               # region['area'],
-    #                               region['perimeter'],
-    #                               region['convex_image'],
-    #                               region['major_axis_length'],
-    #                               region['minor_axis_length']]
-    #                               for region in binary_props
-    #                               if (region['area'] > pix_range[0]) & (region['area'] <= pix_range[1])],
-    #                               columns=['label','coords','moments','moments_central','moments_normalized','bbox',
-    #                                        'perimeter','convex_image','major_axis_length','minor_axis_length']
-    #     )
-
-    shape_df = pd.DataFrame([[region[prop] for prop in prop_list] for region in binary_props
-                              if (region['area'] > pix_range[0]) & (region['area'] <= pix_range[1])],
-                              columns=prop_list
+    return offsets, pixel_rows[order], pixel_cols[order]
+#*********************************************************************************************#
+def _central_moments(offsets, rows, cols, centroids, order=3):
+    """regionprops moments_central (rows by columns, up to order) of every label in a CSR coords array"""
+    label_ix = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    dr = rows - centroids[label_ix,0]
+    dc = cols - centroids[label_ix,1]
+
+    mu = np.empty((len(offsets) - 1, order + 1, order + 1))
+    for p in range(order + 1):
+        for q in range(order + 1):
+            mu[:,p,q] = np.bincount(label_ix, weights=dr**p * dc**q, minlength=len(offsets) - 1)
+
+    return mu
+#*********************************************************************************************#
+def _filled_images(pic_label, labels, slices):
+    """
+    regionprops filled_image of each label. A particle can only have a hole where the union
+    of all particles has one, so holes are filled once for the whole image, and only the
+    particles with a hole pixel inside their bounding box are filled on their own.
+    """
+    fill_struct = np.ones((3,3))
+    holes = binary_fill_holes(pic_label > 0, structure=fill_struct) & (pic_label == 0)
+    hole_sum = np.zeros((holes.shape[0] + 1, holes.shape[1] + 1), dtype=int)
+    hole_sum[1:,1:] = holes.cumsum(axis=0).cumsum(axis=1)
+
+    filled_images = []
+    for sl, lbl in zip(slices, labels):
+        region_img = pic_label[sl] == lbl
+        top, bottom, left, right = sl[0].start, sl[0].stop, sl[1].start, sl[1].stop
+        if hole_sum[bottom,right] - hole_sum[top,right] - hole_sum[bottom,left] + hole_sum[top,left] > 0:
+            region_img = binary_fill_holes(region_img, structure=fill_struct)
+        filled_images.append(region_img)
+
+    return filled_images
+#*********************************************************************************************#
+def label_props(pic_label, prop_list, pix_range, intensity_img=None):
+    """
+    Table of region properties for the labels whose area is in (pix_range[0], pix_range[1]].
+    Areas are counted for every label at once and filtered before anything else is measured.
+    label, coords, area, centroid, bbox, moments_central, major_axis_length, minor_axis_length
+    and filled_image are computed here for all labels together (coords as views into one
+    array; see label_coords); any other property is read from skimage regionprops.
+    """
+    areas = np.bincount(pic_label.ravel())
+    areas[0] = 0
+    labels = np.flatnonzero((areas > pix_range[0]) & (areas <= pix_range[1]))
+    if len(labels) == 0:
+        return pd.DataFrame(columns=prop_list)
+
+    offsets, rows, cols = label_coords(pic_label, labels)
+    area = areas[labels]
+    label_ix = np.repeat(np.arange(len(labels)), area)
+    centroids = np.column_stack([np.bincount(label_ix, weights=rows) / area,
+                                 np.bincount(label_ix, weights=cols) / area]
     )
 
+    prop_dict = {'label': labels, 'area': area, 'centroid': list(map(tuple, centroids))}
 
+    if 'coords' in prop_list:
+        coord_array = np.column_stack((rows, cols))
+        prop_dict['coords'] = [coord_array[start:stop] for start, stop in zip(offsets[:-1], offsets[1:])]
 
+    label_slices = find_objects(pic_label)
+    slices = [label_slices[lbl - 1] for lbl in labels]
+    if 'bbox' in prop_list:
+        prop_dict['bbox'] = [(sl[0].start, sl[1].start, sl[0].stop, sl[1].stop) for sl in slices]
+
+    if 'filled_image' in prop_list:
+        prop_dict['filled_image'] = _filled_images(pic_label, labels, slices)
+
+    if {'moments_central','major_axis_length','minor_axis_length'} & set(prop_list):
+        mu = _central_moments(offsets, rows, cols, centroids)
+        prop_dict['moments_central'] = list(mu)
+
+        ##Eigenvalues of the inertia tensor, as regionprops uses for the axis lengths
+        a, b, c = mu[:,0,2] / area, -mu[:,1,1] / area, mu[:,2,0] / area
+        spread = np.sqrt(((a - c) / 2)**2 + b**2)
+        prop_dict['major_axis_length'] = 4 * np.sqrt(np.clip((a + c) / 2 + spread, 0, None))
+        prop_dict['minor_axis_length'] = 4 * np.sqrt(np.clip((a + c) / 2 - spread, 0, None))
+
+    other_props = [prop for prop in prop_list if prop not in prop_dict]
+    if other_props:
+        label_set = set(labels)
+        regions = [region for region in regionprops(pic_label, intensity_img, cache=True)
+                   if region.label in label_set
+        ]
+        for prop in other_props:
+            prop_dict[prop] = [region[prop] for region in regions]
+
+    return pd.DataFrame({prop: prop_dict[prop] for prop in prop_list}, columns=prop_list)
+#*********************************************************************************************#
+def binary_data_extraction(pic_binary, intensity_img, prop_list, pix_range, return_label=False):
 
+    pic_label = label(pic_binary, connectivity=2)
 
+    shape_df = label_props(pic_label, prop_list, pix_range, intensity_img=intensity_img)
 
+    if return_label == True:
+        return shape_df, pic_label
 
     return shape_df
 #*********************************************************************************************#
+def measure_z_profiles(pic_label, labels, pic3D, diff_img=None, std_profile=False):
+    """
+    Measures the z-profiles of every particle in one pass over the labeled image.
+    The profile used for each particle is that of its first pixel (in row-major order)
+    holding the greatest intensity in the stack, as in the old per-particle loop.
+    Returns a DataFrame (one row per label, in the order given) with greatest_max,
+    max_z_stack, max_z_slice, z_intensity and validity; intensity_increase is added when a
+    difference image is given, and the per-slice std of all particle pixels if std_profile=True.
+    """
+    labels = np.asarray(labels)
+    rows, cols = np.nonzero(pic_label)
+    pix_labels = pic_label[rows, cols]
+
+    keep = np.isin(pix_labels, labels)
+    rows, cols, pix_labels = rows[keep], cols[keep], pix_labels[keep]
+    ##Stable sort keeps the row-major order of the pixels within each particle
+    order = np.argsort(pix_labels, kind='stable')
+    rows, cols, pix_labels = rows[order], cols[order], pix_labels[order]
+
+    label_vals, starts, counts = np.unique(pix_labels, return_index=True, return_counts=True)
+    pix_group = np.repeat(np.arange(len(label_vals)), counts)
+
+    all_z_stacks = pic3D[:, rows, cols].T
+
+    pix_max = all_z_stacks.max(axis=1)
+    greatest_max = np.maximum.reduceat(pix_max, starts)
+
+    pix_index = np.where(pix_max == greatest_max[pix_group], np.arange(len(pix_max)), len(pix_max))
+    max_pix = np.minimum.reduceat(pix_index, starts)
+
+    max_z_stack = all_z_stacks[max_pix]
+    if np.issubdtype(max_z_stack.dtype, np.integer):
+        max_z_stack = max_z_stack.astype(np.int64)
+
+    profile_df = pd.DataFrame({'label': label_vals})
+    profile_df['greatest_max'] = greatest_max
+    profile_df['max_z_stack'] = max_z_stack.tolist()
+    profile_df['max_z_slice'] = np.argmax(max_z_stack, axis=1)
+    profile_df['z_intensity'] = (max_z_stack.max(axis=1) - max_z_stack.min(axis=1))*100
+    profile_df['validity'] = max_z_stack[:,0] >= max_z_stack[:,-1]
+
+    if diff_img is not None:
+        profile_df['intensity_increase'] = np.maximum.reduceat(diff_img[rows, cols], starts)
+
+    if std_profile == True:
+        mean_z_stacks = np.add.reduceat(all_z_stacks, starts, axis=0) / counts[:,None]
+        sq_dev = (all_z_stacks - mean_z_stacks[pix_group])**2
+        std_z_stacks = np.sqrt(np.add.reduceat(sq_dev, starts, axis=0) / counts[:,None])
+        profile_df['std_z_stack'] = np.round(std_z_stacks,4).tolist()
+
+    profile_df = profile_df.set_index('label').loc[labels].reset_index()
+
+    return profile_df
+#*********************************************************************************************#
 def particle_masker(pic_binary, shape_df, pass_num, first_scan = 1):
     particle_mask = np.zeros_like(pic_binary, dtype=int)
-    rows, cols = zip(*[item for sublist in shape_df.coords.tolist() for item in sublist])
-    particle_mask[rows,cols] = 1
+    coord_array = np.concatenate([np.asarray(coords, dtype=int).reshape(-1,2) for coords in shape_df.coords])
+    particle_mask[coord_array[:,0], coord_array[:,1]] = 1
 
     return particle_mask
 #*********************************************************************************************#
 def density_normalizer(spot_df, spot_counter):
-    """Particle count normalizer so pass 1 = 0 particle density"""
-    normalized_density = []
-    for x in range(1, spot_counter + 1):
-        kp_df = spot_df.kparticle_density[(spot_df.spot_number == x)].reset_index(drop=True)
-        pass_count = len(kp_df)
-        print(kp_df)
-        j = 0
-        if pass_count > 1:
-            while np.isnan(kp_df[j]):
-                print(kp_df)
-                j += 1
-                if (j == pass_count - 1):
-                    norm_val = [np.nan] * j
-                    break
-                print("Invalid data for spot {}, scan {}; normalizing to scan {}".format(x,j,j+1))
-
-        norm_val = [kp_df[i] - kp_df[j] for i in range(0,len(kp_df))]
-
-        normalized_density.append(norm_val)
-
-    return [item for sublist in normalized_density for item in sublist]
+    """
+    Particle count normalizer so pass 1 = 0 particle density.
+    Each spot is normalized to its first pass with a valid density; spots with none stay NaN.
+    """
+    baseline = spot_df.groupby('spot_number', sort=False).kparticle_density.transform('first')
+
+    late_baseline = spot_df.kparticle_density.isnull() & (spot_df.groupby('spot_number', sort=False).cumcount() == 0)
+    for spot_num in spot_df.spot_number[late_baseline & baseline.notnull()]:
+        print("Invalid data for spot {}; normalizing to its first valid scan".format(spot_num))
+
+    return list(spot_df.kparticle_density - baseline)
 #*********************************************************************************************#
 def vdata_reader(vdata_list):
-
-    vdata_df = pd.DataFrame()
+    """Reads the 'key: value' .vdata.txt files into one DataFrame, one row per file"""
+    vdata_rows = []
     for vfile in vdata_list:
         with open(vfile) as vdf:
+            ##Only the first colon separates the key; values such as marker_locs may hold more
+            vdata_rows.append(dict(line.rstrip('\n').split(':', 1) for line in vdf if ':' in line))
 
-            props, vals= zip(*[line.split(':') for line in vdf])
-
-            vdata_df = vdata_df.append([vals], ignore_index=True)
-    vdata_df.columns = props
-    vdata_df = vdata_df.applymap(lambda x: x.strip(' \n'))
+    vdata_df = pd.DataFrame(vdata_rows)
+    vdata_df.columns = [col.strip() for col in vdata_df.columns]
+    vdata_df = vdata_df.apply(lambda col: col.str.strip(' \n'))
 
-    vdata_df['validity'] = vdata_df['validity'].apply(lambda x: eval(x))
+    vdata_df['validity'] = vdata_df['validity'] == 'True'
 
     return vdata_df
 
 #*********************************************************************************************#
-def _pixel_graph_easy(image, steps, distances, num_edges, height=None):
-    row = np.empty(num_edges, dtype=int)
-    col = np.empty(num_edges, dtype=int)
-    data = np.empty(num_edges, dtype=float)
-    image = image.ravel()
-    n_neighbors = steps.size
-    start_idx = np.max(steps)
-    end_idx = image.size + np.min(steps)
-    k = 0
-    for i in range(start_idx, end_idx + 1):
-        if image[i] != 0:
-            for j in range(n_neighbors):
-                n = steps[j] + i
-                if image[n] != 0 and image[n] != image[i]:
-                    row[k] = image[i]
-                    col[k] = image[n]
-                    if height is None:
-                        data[k] = distances[j]
-
-                    else:
-                        data[k] = np.sqrt(distances[j] ** 2 + (height[i] - height[n]) ** 2)
-                    k += 1
-
-    graph = sparse.coo_matrix((data[:k], (row[:k], col[:k]))).tocsr()
-
-    return graph
-#*********************************************************************************************#
 def measure_filo_length(coords, pix_per_um):
-    sparse_matrix = csr_matrix(squareform(pdist(coords,metric='euclidean')))
-    # vimage.gen_img(sparse_matrix)
-
-    distances = csgraph.shortest_path(sparse_matrix,method = 'FW',return_predecessors=False)
-
-    ls_path = np.max(distances)
-
-    farpoints = np.where(distances == ls_path)
-
-    filo_len = float(round(ls_path / pix_per_um, 3))
-    vertices = [coords[farpoints[0][0]],coords[farpoints[0][len(farpoints[0]) // 2]]]
-
-    return filo_len, vertices
+    return vfilo.measure_fiber_length(coords, spacing=1/pix_per_um)
 #*********************************************************************************************#
 def measure_defocus(z_stack, std_z_stack, measure_corr=True,
                     a0=0.1, b0=0.1, c0=1, show = False):
@@ -353,6 +470,71 @@ def get_bbox_pixels(bbox, max_z_img):
 
     return np.concatenate((top_bot.ravel(), lft_rgt.ravel()))
 #*********************************************************************************************#
+def bbox_ring_pixels(bbox_array, img_shape):
+    """
+    Flat indices of the bounding box edge pixels of many particles, in the same order as
+    get_bbox_pixels (top and bottom rows, then the left and right columns between them), for an
+    (n, 4, 2) array of bbox_verts. Edges are clipped to the image instead of being changed in place.
+    Returns the flat indices and the offsets of each particle's pixels, CSR style.
+    """
+    nrows, ncols = img_shape
+    top, bot = np.clip(bbox_array[:,0,0], 0, nrows - 1), np.clip(bbox_array[:,2,0], 0, nrows - 1)
+    lft, rgt = np.clip(bbox_array[:,0,1], 0, ncols - 1), np.clip(bbox_array[:,2,1], 0, ncols - 1)
+
+    width = rgt - lft + 1
+    height = np.maximum(bot - top - 1, 0)
+    counts = 2 * width + 2 * height
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    ##Position of every ring pixel within its own particle's ring
+    particle_ix = np.repeat(np.arange(len(counts)), counts)
+    ring_pos = np.arange(offsets[-1]) - offsets[particle_ix]
+    w, h = width[particle_ix], height[particle_ix]
+
+    in_rows = ring_pos < 2 * w
+    side_pos = ring_pos - 2 * w
+    rows = np.where(in_rows, np.where(ring_pos < w, top[particle_ix], bot[particle_ix]),
+                    top[particle_ix] + 1 + side_pos // 2
+    )
+    cols = np.where(in_rows, lft[particle_ix] + ring_pos % np.maximum(w, 1),
+                    np.where(side_pos % 2 == 0, lft[particle_ix], rgt[particle_ix])
+    )
+
+    return rows * ncols + cols, offsets
+#*********************************************************************************************#
+def bbox_background(bbox_series, max_z_slices, pic3D):
+    """
+    Median and coefficient of variation of the bounding box edge pixels of every particle,
+    each taken from the particle's max_z slice, as the per-particle get_bbox_pixels path gives.
+    Each slice is read once, and the statistics are computed for all particles together.
+    """
+    particle_count = len(bbox_series)
+    if particle_count == 0:
+        return np.empty(0), np.empty(0)
+
+    bbox_array = np.stack(bbox_series.values).astype(int)
+    max_z_slices = np.asarray(max_z_slices, dtype=int)
+    ring_ix, offsets = bbox_ring_pixels(bbox_array, pic3D[max_z_slices[0]].shape)
+
+    counts = np.diff(offsets)
+    particle_ix = np.repeat(np.arange(particle_count), counts)
+    pixel_z = max_z_slices[particle_ix]
+    ring_vals = np.empty(len(ring_ix), dtype=np.float64)
+    for z in np.unique(max_z_slices):
+        in_z = pixel_z == z
+        ring_vals[in_z] = np.asarray(pic3D[z]).ravel()[ring_ix[in_z]]
+
+    mean_bg = np.bincount(particle_ix, weights=ring_vals, minlength=particle_count) / counts
+    var_bg = np.bincount(particle_ix, weights=(ring_vals - mean_bg[particle_ix])**2,
+                         minlength=particle_count) / counts
+    cv_bg = np.sqrt(var_bg) / mean_bg
+
+    ##Values sorted within each particle; the median is the mean of the middle one or two
+    sorted_vals = ring_vals[np.lexsort((ring_vals, particle_ix))]
+    median_bg = (sorted_vals[offsets[:-1] + (counts - 1) // 2] + sorted_vals[offsets[:-1] + counts // 2]) / 2
+
+    return median_bg, cv_bg
+#*********************************************************************************************#
 def _overlap_tol(z_i, z_j):
     if z_i == z_j:
         return 1.0
@@ -421,53 +603,146 @@ def _intersection_of_bbox(bb1, bb2, get_iou = False):
         return intersection_area / bb1_area
 
 #*********************************************************************************************#
+def bbox_edges(bbox_series):
+    """(top, left, bottom, right) arrays from a column of bbox_verts vertex arrays"""
+    if len(bbox_series) == 0:
+        return tuple(np.empty(0) for i in range(4))
+    bbox_array = np.stack(bbox_series.values)
+
+    return bbox_array[:,0,0], bbox_array[:,0,1], bbox_array[:,2,0], bbox_array[:,2,1]
+#*********************************************************************************************#
+def bbox_overlaps(edges, pairs, get_iou=False):
+    """
+    Vectorized _intersection_of_bbox for every (i, j) row of pairs.
+    edges are the (top, left, bottom, right) arrays from bbox_edges.
+    Returns the IoS (or IoU) of each pair; box i inside box j counts as 1.0 either way.
+    """
+    top, left, bottom, right = edges
+    i, j = pairs[:,0], pairs[:,1]
+
+    inter_h = np.minimum(bottom[i], bottom[j]) - np.maximum(top[i], top[j])
+    inter_w = np.minimum(right[i], right[j]) - np.maximum(left[i], left[j])
+    intersection_area = np.where((inter_h < 0) | (inter_w < 0), 0, inter_h * inter_w)
+
+    area_i = (bottom[i] - top[i]) * (right[i] - left[i])
+    area_j = (bottom[j] - top[j]) * (right[j] - left[j])
+
+    if get_iou == True:
+        overlap = intersection_area / (area_i + area_j - intersection_area + 0.000001)
+    else:
+        overlap = intersection_area / np.minimum(area_i, area_j)
+
+    i_inside_j = ((top[i] >= top[j]) & (bottom[i] <= bottom[j])
+                  & (left[i] >= left[j]) & (right[i] <= right[j]))
+
+    return np.where(i_inside_j, 1.0, overlap)
+#*********************************************************************************************#
+def suppress_overlaps(pairs, scores, overlaps, tolerances):
+    """
+    Greedy non-maximum suppression: objects are visited from the highest score down, and an
+    object is suppressed if it overlaps (overlaps >= tolerances) an object that was kept.
+    Ties go to the object that comes first. Returns a boolean array, True for suppressed objects.
+    """
+    suppressed = np.zeros(len(scores), dtype=bool)
+    conflicts = pairs[overlaps >= tolerances]
+    if len(conflicts) == 0:
+        return suppressed
+
+    ##Rank 0 is the highest score; each conflict points from the higher-ranked object to the lower
+    order = np.argsort(-scores, kind='stable')
+    rank = np.empty(len(scores), dtype=int)
+    rank[order] = np.arange(len(scores))
+
+    i, j = conflicts[:,0], conflicts[:,1]
+    i_wins = rank[i] < rank[j]
+    winners, losers = np.where(i_wins, i, j), np.where(i_wins, j, i)
+
+    by_loser = np.lexsort((winners, rank[losers]))
+    winners, losers = winners[by_loser], losers[by_loser]
+    loser_vals, first_ix = np.unique(rank[losers], return_index=True)
+    winner_groups = np.split(winners, first_ix[1:])
+
+    ##Winners always rank above their loser, so their fate is settled before the loser is visited
+    for loser, winner_group in zip(order[loser_vals], winner_groups):
+        suppressed[loser] = not suppressed[winner_group].all()
+
+    return suppressed
+#*********************************************************************************************#
 def mark_overlaps(neighbor_tree_dist, shape_df, iou=False):
+    """
+    Positions in shape_df of particles hidden by a brighter one (by z_intensity, or area if
+    there is none) whose bounding box overlaps theirs by at least 1/(difference in z_intensity).
+    neighbor_tree_dist is the ndarray of candidate pairs from cKDTree.query_pairs.
+    """
     try:
-        z_series = shape_df.z_intensity
+        z_vals = shape_df.z_intensity.values
     except AttributeError:
-        z_series = shape_df.area
-
-    bbox_series = shape_df.bbox
+        z_vals = shape_df.area.values
 
-    overlap_ix_list = []
+    pairs = np.asarray(neighbor_tree_dist, dtype=int).reshape(-1,2)
+    if len(pairs) == 0:
+        return []
 
-    for i,j in neighbor_tree_dist:
-        z_i,z_j = z_series[[i,j]]
-        bb_i, bb_j = bbox_series[[i,j]]
+    z_diff = np.abs(z_vals[pairs[:,0]] - z_vals[pairs[:,1]])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tolerances = np.where(z_diff == 0, 1.0, 1 / z_diff)
 
-        overlap = _overlap_tol(z_i, z_j)
-        ios = _intersection_of_bbox(bb_i, bb_j, get_iou=iou)
+    overlaps = bbox_overlaps(bbox_edges(shape_df.bbox), pairs, get_iou=iou)
 
-        if ios >= overlap:
+    ##A missing z_intensity gives a NaN tolerance, which never counts as an overlap
+    suppressed = suppress_overlaps(pairs, np.nan_to_num(z_vals, nan=-np.inf), overlaps, tolerances)
 
-            if z_i < z_j:
-                overlap_ix_list.append(i)
-            else:
-                overlap_ix_list.append(j)
-
-    return overlap_ix_list
+    return list(np.flatnonzero(suppressed))
 #*********************************************************************************************#
 def remove_overlapping_objs(shape_df, radius=20):
 
+    if len(shape_df) < 2:
+        return shape_df.reset_index(drop=True)
+
     neighbor_tree = cKDTree(np.array(shape_df.centroid.tolist()))
 
     neighbor_tree_dist = neighbor_tree.query_pairs(radius, output_type='ndarray')
 
     overlap_ix = mark_overlaps(neighbor_tree_dist, shape_df)
 
-    return shape_df.drop(overlap_ix).reset_index(drop=True)
+    return shape_df.drop(shape_df.index[overlap_ix]).reset_index(drop=True)
 #*********************************************************************************************#
-def spot_remover(spot_df, contrast_df, vcount_dir, iris_path, quarantine_img = False):
-    excise_toggle = input("Would you like to remove any spots from the analysis? (y/[n])\t")
-    assert isinstance(excise_toggle, str)
-    if excise_toggle.lower() in ('y','yes'):
-        excise_spots = input("Which spots? (Separate all spot numbers by a comma)\t")
-        excise_spots = [int(x) for x in excise_spots.split(',')]
+def remove_dupes_by_iou(overlap_ix_list):
+    """
+    Keeps each index at most once in a list of (index_1, index_2, iou) matches: matches are
+    taken from the highest IoU down, skipping any whose index_1 or index_2 was already used.
+    """
+    iou_order = np.argsort([-match[2] for match in overlap_ix_list], kind='stable')
+
+    used_1, used_2, keep = set(), set(), []
+    for ix in iou_order:
+        ix_1, ix_2 = overlap_ix_list[ix][:2]
+        if (ix_1 not in used_1) and (ix_2 not in used_2):
+            used_1.add(ix_1)
+            used_2.add(ix_2)
+            keep.append(ix)
 
+    return [overlap_ix_list[ix] for ix in sorted(keep)]
+#*********************************************************************************************#
+def spot_remover(spot_df, contrast_df, vcount_dir, iris_path, quarantine_img = False, excise_spots = None):
+    """
+    Invalidates the spots in excise_spots (and optionally quarantines their images).
+    When excise_spots is None the user is asked which spots to remove.
+    """
+    if excise_spots is None:
+        excise_toggle = vpipes.ask("Would you like to remove any spots from the analysis? (y/[n])\t",
+                                   '--remove-spots')
+        assert isinstance(excise_toggle, str)
+        if excise_toggle.lower() in ('y','yes'):
+            excise_spots = vpipes.ask("Which spots? (Separate all spot numbers by a comma)\t", '--remove-spots')
+            excise_spots = [int(x) for x in excise_spots.split(',')]
+        else:
+            excise_spots = []
+
+    if excise_spots:
         spot_df.loc[spot_df.spot_number.isin(excise_spots), 'validity'] = False
 
-        drop_col_list = [col for col in contrast_df.columns if int(col.split(".")[0]) in excise_spots]
-        contrast_df.drop(columns=drop_col_list, inplace=True)
+        contrast_df = contrast_df[~contrast_df.spot_number.isin(excise_spots)].reset_index(drop=True)
 
         os.chdir(vcount_dir)
 
@@ -489,6 +764,12 @@ def spot_remover(spot_df, contrast_df, vcount_dir, iris_path, quarantine_img = F
                         nvf.write(line)
             os.remove(old_vf)
 
+        bad_vtables = [vt for vt in glob.glob('*.*.vdata.parquet') if int(vt.split('.')[1]) in excise_spots]
+        for vt in bad_vtables:
+            vtable_df = pd.read_parquet(vt)
+            vtable_df['validity'] = False
+            vstore.write_table(vtable_df, vt)
+
         if quarantine_img == True:
             os.chdir(iris_path)
             if not os.path.exists('bad_imgs'):
@@ -0,0 +1,214 @@
+from __future__ import division
+import numpy as np
+import cv2
+from scipy import fft
+"""
+Pass-to-pass registration of the SD projections. Shifts are (row, column) of the second
+image relative to the first, like vimage.measure_shift_ORB. Each method also reports a
+confidence between 0 and 1, so the cheapest reliable method can be used:
+subpixel FFT phase correlation first (optionally on an image pyramid), then ORB feature
+matching, whose descriptors can be cached so the baseline pass is only described once.
+Where both passes have IRIS markers, a shift is also checked against them before it is used.
+"""
+##Phase correlation peaks below this are treated as failures. Set from synthetic IRIS passes
+##(benchmarks/bench_register.py): unrelated images peak at up to 0.03 and true pairs at 0.29 or
+##more, even with heavy noise and defocus
+PHASE_MIN_CONFIDENCE = 0.15
+##Width (cycles/pixel) of the Gaussian low-pass on the normalized cross-power spectrum. Whitening
+##otherwise gives the high frequencies, which hold little but sensor noise, as much weight as the scene
+PHASE_LOWPASS = 0.05
+##ORB shifts are only trusted if this fraction of the matches agree with the median shift
+ORB_MIN_CONFIDENCE = 0.3
+##A shift must carry a marker of the first image to within this many pixels of one of the second.
+##Dust or shading fixed to the camera can outweigh the scene and give a confident (0,0) shift
+MARKER_TOLERANCE = 5
+
+_lowpass_filters = {}
+#*********************************************************************************************#
+#
+#           SUBROUTINES
+#
+#*********************************************************************************************#
+def _as_float(img):
+    return np.float32(cv2.normalize(np.float32(img), None, 0, 1, cv2.NORM_MINMAX))
+#*********************************************************************************************#
+def _peak_offset(c_minus, c_peak, c_plus):
+    """Subpixel offset of a peak from a parabola through it and its two neighbours"""
+    denom = c_minus - 2 * c_peak + c_plus
+    if denom >= 0:
+        return 0.0
+
+    return float(np.clip(0.5 * (c_minus - c_plus) / denom, -0.5, 0.5))
+#*********************************************************************************************#
+def _lowpass(shape):
+    """
+    PHASE_LOWPASS filter on the rfft2 grid of shape, and its total weight over the full spectrum
+    (the height of the correlation peak of a perfect match). Kept per shape, since every pass
+    of a chip has the same frame size.
+    """
+    if shape not in _lowpass_filters:
+        nrows, ncols = shape
+        freq_r, freq_c = fft.fftfreq(nrows)[:,None], fft.rfftfreq(ncols)[None,:]
+        ##Frequencies of the half-size images, in cycles per full-size pixel
+        lowpass = np.float32(np.exp(-(freq_r**2 + freq_c**2) / (2 * (2 * PHASE_LOWPASS)**2)))
+        ##The full spectrum holds every rfft column but the first (and last) twice
+        weight = 2 * lowpass.sum() - lowpass[:,0].sum() - (lowpass[:,-1].sum() if ncols % 2 == 0 else 0)
+        _lowpass_filters[shape] = (lowpass, weight / (nrows * ncols))
+
+    return _lowpass_filters[shape]
+#*********************************************************************************************#
+def _phase_correlate(img1, img2):
+    """
+    Phase correlation of two images of the same shape, both tapered by a Hann window so the
+    frame edges do not correlate with themselves. Returns the subpixel (row, col) shift and the
+    confidence: the correlation peak relative to that of a perfect match.
+    """
+    ##PHASE_LOWPASS leaves nothing above a quarter cycle per pixel, so the images are
+    ##correlated at half size, which loses nothing the correlation uses
+    half_size = (img1.shape[1] // 2, img1.shape[0] // 2)
+    img1 = cv2.resize(img1, half_size, interpolation=cv2.INTER_AREA)
+    img2 = cv2.resize(img2, half_size, interpolation=cv2.INTER_AREA)
+
+    window = cv2.createHanningWindow(half_size, cv2.CV_32F)
+    ##The tapered images are zero at the edges, so padding them to a fast FFT size changes nothing
+    nrows, ncols = fft.next_fast_len(img1.shape[0], real=True), fft.next_fast_len(img1.shape[1], real=True)
+    lowpass, peak_weight = _lowpass((nrows, ncols))
+
+    ##scipy.fft keeps float32 images in single precision, which numpy.fft does not
+    cross_power = fft.rfft2(img2 * window, s=(nrows, ncols)) * np.conj(fft.rfft2(img1 * window, s=(nrows, ncols)))
+    cross_power /= np.maximum(np.abs(cross_power), np.float32(1e-12))
+    cross_power *= lowpass
+    correlation = fft.irfft2(cross_power, s=(nrows, ncols)) / peak_weight
+
+    peak_r, peak_c = np.unravel_index(np.argmax(correlation), correlation.shape)
+    row_shift = peak_r + _peak_offset(correlation[peak_r-1, peak_c], correlation[peak_r, peak_c],
+                                      correlation[(peak_r+1) % nrows, peak_c])
+    col_shift = peak_c + _peak_offset(correlation[peak_r, peak_c-1], correlation[peak_r, peak_c],
+                                      correlation[peak_r, (peak_c+1) % ncols])
+    ##The correlation wraps around, so peaks past the middle are negative shifts
+    if row_shift > nrows / 2: row_shift -= nrows
+    if col_shift > ncols / 2: col_shift -= ncols
+
+    return (2 * row_shift, 2 * col_shift), float(correlation[peak_r, peak_c])
+#*********************************************************************************************#
+def phase_shift(img1, img2, levels=0):
+    """
+    Measures the translation between two images by FFT phase correlation.
+    With levels > 0 (pyramid mode), the shift is first measured on the images shrunk by
+    2**levels, then refined at full resolution on the part of the scene both images share,
+    which keeps large shifts from being lost to the content that only one image has.
+    Returns (row, col) and the confidence (the correlation peak relative to a perfect match).
+    """
+    img1, img2 = _as_float(img1), _as_float(img2)
+    if levels < 1:
+        return _phase_correlate(img1, img2)
+
+    scale = 2**levels
+    nrows, ncols = img1.shape
+    small_size = (ncols // scale, nrows // scale)
+    (coarse_row, coarse_col), coarse_conf = _phase_correlate(
+        cv2.resize(img1, small_size, interpolation=cv2.INTER_AREA),
+        cv2.resize(img2, small_size, interpolation=cv2.INTER_AREA)
+    )
+    coarse_row, coarse_col = int(round(coarse_row * scale)), int(round(coarse_col * scale))
+    if (abs(coarse_row) >= nrows // 2) or (abs(coarse_col) >= ncols // 2):
+        return (coarse_row, coarse_col), coarse_conf
+
+    ##img2 shows the scene of img1 moved by the coarse shift
+    r1, r2 = max(0, -coarse_row), max(0, coarse_row)
+    c1, c2 = max(0, -coarse_col), max(0, coarse_col)
+    overlap_h, overlap_w = nrows - abs(coarse_row), ncols - abs(coarse_col)
+
+    (fine_row, fine_col), fine_conf = _phase_correlate(img1[r1:r1+overlap_h, c1:c1+overlap_w],
+                                                       img2[r2:r2+overlap_h, c2:c2+overlap_w]
+    )
+
+    return (coarse_row + fine_row, coarse_col + fine_col), fine_conf
+#*********************************************************************************************#
+def orb_features(img, nfeatures=500):
+    """ORB keypoints and descriptors of an image (converted to 8-bit as in measure_shift_ORB)"""
+    img = np.uint8(cv2.normalize(img, None, 0, 255, cv2.NORM_MINMAX))
+    orb = cv2.ORB_create(nfeatures=nfeatures)
+
+    return orb.detectAndCompute(img, None)
+#*********************************************************************************************#
+def orb_shift(features1, features2, ham_thresh=10, max_thresh=40):
+    """
+    Median (row, col) shift of the cross-checked ORB matches with a Hamming distance under
+    ham_thresh. The threshold is loosened in steps of 2 up to max_thresh until at least 3 matches
+    are found. Confidence is the fraction of matches within 2 pixels of the median shift.
+    Returns the shift (None if there were too few matches), the confidence and the matches.
+    """
+    kp1, des1 = features1
+    kp2, des2 = features2
+    if (des1 is None) or (des2 is None):
+        return None, 0, []
+
+    bruteforce = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
+    all_matches = sorted(bruteforce.match(des1, des2), key=lambda match: match.distance)
+
+    ##Matching once and filtering afterwards gives the same matches as rematching at each threshold
+    matches = []
+    while ham_thresh <= max_thresh:
+        matches = [match for match in all_matches if match.distance <= ham_thresh]
+        if len(matches) > 2:
+            break
+        ham_thresh += 2
+    if len(matches) <= 2:
+        return None, 0, matches
+
+    shift_array = np.array([np.subtract(kp2[mat.trainIdx].pt, kp1[mat.queryIdx].pt) for mat in matches])
+    shift = (np.median(shift_array[:,1]), np.median(shift_array[:,0]))
+    agree = np.all(np.abs(shift_array[:,::-1] - shift) <= 2, axis=1)
+
+    return shift, np.count_nonzero(agree) / len(matches), matches
+#*********************************************************************************************#
+def markers_agree(shift, markers):
+    """
+    Whether shift moves any of the (row, col) marker locations of the first image to within
+    MARKER_TOLERANCE of one of the second. True if either image has no markers to check.
+    """
+    locs1, locs2 = markers
+    if (len(locs1) == 0) or (len(locs2) == 0):
+        return True
+    offsets = np.asarray(locs2, dtype=float)[None,:,:] - (np.asarray(locs1, dtype=float)[:,None,:] + shift)
+
+    return bool(np.any(np.all(np.abs(offsets) <= MARKER_TOLERANCE, axis=2)))
+#*********************************************************************************************#
+def register(img1, img2, feature_cache=None, keys=(None, None), levels=0, ham_thresh=10, markers=None):
+    """
+    Measures the (row, col) shift of img2 relative to img1, trying phase correlation first
+    and ORB matching if that is not confident enough.
+    ORB features are stored in feature_cache under keys (e.g. the spot.pass strings), so the
+    baseline image is only described once for all the passes compared to it.
+    With markers (the marker locations of both images), a shift that does not match them
+    (see markers_agree) is rejected whatever its confidence; its confidence is reported as 0.
+    Returns the shift (None if every method failed), the method used and the confidence of
+    each method that was tried.
+    """
+    confidences = {}
+    shift, conf = phase_shift(img1, img2, levels=levels)
+    if (markers is not None) and not markers_agree(shift, markers):
+        conf = 0
+    confidences['phase'] = round(conf, 3)
+    if conf >= PHASE_MIN_CONFIDENCE:
+        return shift, 'phase', confidences
+
+    features = []
+    for img, key in zip((img1, img2), keys):
+        if (feature_cache is not None) and (key is not None):
+            if key not in feature_cache:
+                feature_cache[key] = orb_features(img)
+            features.append(feature_cache[key])
+        else:
+            features.append(orb_features(img))
+
+    shift, conf, matches = orb_shift(features[0], features[1], ham_thresh=ham_thresh)
+    if (shift is not None) and (markers is not None) and not markers_agree(shift, markers):
+        conf = 0
+    confidences['orb'] = round(conf, 3)
+    if (shift is not None) and (conf >= ORB_MIN_CONFIDENCE):
+        return shift, 'orb', confidences
+
+    return None, None, confidences
+#*********************************************************************************************#
@@ -0,0 +1,142 @@
+from __future__ import division
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import current_process
+from timeit import default_timer
+import os, pickle, traceback
+from modules import vworkers
+"""
+Background rendering of the figures. The analysis submits a plotting function with the data
+it needs and carries on, while a pool of worker processes using the Agg backend draws and saves
+the PNGs. wait() is the barrier at the end of a run: it waits for every figure still being
+drawn and reports the ones that failed.
+The spot pool's workers are daemonic and cannot start a pool of their own, so figures submitted
+there (or in a run with no render workers) are drawn in line, as they always were.
+"""
+##Figures that may wait for a render worker before submit blocks, per worker, so a slow
+##renderer cannot pile up the images of every pass in memory
+MAX_PENDING_PER_WORKER = 4
+
+_render_pools = {}
+_pending = {}
+_failures = {}
+#*********************************************************************************************#
+#
+#           SUBROUTINES
+#
+#*********************************************************************************************#
+def _render(func, args, kwargs, cwd=None):
+    """
+    Calls func(*args, **kwargs) and closes its figures. Returns None, or the traceback if the
+    figure could not be drawn, so one bad figure never stops the others.
+    """
+    import matplotlib.pyplot as plt
+    try:
+        if cwd is not None:
+            os.chdir(cwd)
+        func(*args, **kwargs)
+    except Exception:
+        return traceback.format_exc()
+    finally:
+        plt.close('all')
+
+    return None
+#*********************************************************************************************#
+def _render_pickled(payload):
+    """_render on a pickled (func, args, kwargs, cwd) tuple"""
+    try:
+        func, args, kwargs, cwd = pickle.loads(payload)
+    except Exception:
+        return traceback.format_exc()
+
+    return _render(func, args, kwargs, cwd)
+#*********************************************************************************************#
+def start(workers=1):
+    """
+    Starts the render pool of this process with the given number of workers; workers < 1 keeps
+    rendering in line. The workers are forked right away, before the pool starts its threads.
+    Those threads make forking this process unsafe from then on, so the pool must be started
+    after any other pool this process forks (see vmulti.multip_main_loop).
+    """
+    pid = os.getpid()
+    if (workers < 1) or current_process().daemon or (pid in _render_pools):
+        return
+
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=vworkers.worker_context(),
+                               initializer=vworkers.init_figure_worker)
+    ##With fork, the executor starts all of its workers on the first submit
+    pool.submit(os.getpid).result()
+
+    _render_pools[pid] = (pool, workers)
+    _pending[pid] = []
+    print("Rendering figures in {} background process(es)\n".format(workers))
+#*********************************************************************************************#
+def _record(name, error):
+    if error is not None:
+        _failures.setdefault(os.getpid(), []).append((name, error))
+        print("Figure failed: {}\n{}".format(name, error))
+#*********************************************************************************************#
+def _collect(name, future):
+    try:
+        error = future.result()
+    except Exception: ##e.g. a worker that died; the pool is then broken for every figure left
+        error = traceback.format_exc()
+    _record(name, error)
+#*********************************************************************************************#
+def submit(name, func, *args, **kwargs):
+    """
+    Draws func(*args, **kwargs) in the render pool of this process, or right away if there is
+    none. name identifies the figure in the failure report (e.g. the PNG path).
+    The arguments are pickled here, so the caller is free to change them afterwards.
+    """
+    pid = os.getpid()
+    if pid not in _render_pools:
+        _record(name, _render(func, args, kwargs))
+        return
+
+    try:
+        payload = pickle.dumps((func, args, kwargs, os.getcwd()), protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        _record(name, traceback.format_exc())
+        return
+
+    pool, workers = _render_pools[pid]
+    pending = _pending[pid]
+    pending.append((name, pool.submit(_render_pickled, payload)))
+    while len(pending) > MAX_PENDING_PER_WORKER * workers:
+        _collect(*pending.pop(0))
+#*********************************************************************************************#
+def pop_failures():
+    """Removes and returns the (name, traceback) of the figures of this process that failed so far"""
+    return _failures.pop(os.getpid(), [])
+#*********************************************************************************************#
+def add_failures(failures):
+    """Adds failures reported by another process (see vmulti) to the report of this one"""
+    _failures.setdefault(os.getpid(), []).extend(failures)
+#*********************************************************************************************#
+def wait():
+    """
+    Barrier: waits for every figure submitted to the render pool of this process, shuts the
+    pool down and prints a report of the figures that failed. Returns the list of their
+    (name, traceback); the report is cleared afterwards.
+    """
+    pid = os.getpid()
+    start_time = default_timer()
+    if pid in _render_pools:
+        pool, workers = _render_pools.pop(pid)
+        pending = _pending.pop(pid)
+        if pending:
+            print("Waiting for {} figure(s) to finish rendering...".format(len(pending)))
+        for name, future in pending:
+            _collect(name, future)
+        pool.shutdown(wait=True)
+        print("Figures rendered; waited {} s\n".format(round(default_timer() - start_time, 1)))
+
+    failures = pop_failures()
+    if failures:
+        print("{} figure(s) could not be rendered:".format(len(failures)))
+        for name, error in failures:
+            print("    {}: {}".format(name, error.strip().split('\n')[-1]))
+        print()
+
+    return failures
+#*********************************************************************************************#
@@ -0,0 +1,124 @@
+from __future__ import division
+from scipy.ndimage import map_coordinates
+import numpy as np
+import cv2
+"""
+Antibody spot detection with a fixed amount of work per spot: a Hough circle search on the
+SD projection shrunk by a constant factor, with a bounded list of detector settings, followed
+by a full-resolution circle fit to the spot edge. When no circle is found, the spot is assumed
+to be centered in the frame with the radius of the last spot that was found.
+"""
+##(Canny upper threshold, accumulator threshold at full resolution), tried in this order
+HOUGH_SETTINGS = ((200,100), (150,75), (100,50), (50,25))
+_last_radius = {}
+#*********************************************************************************************#
+#
+#           SUBROUTINES
+#
+#*********************************************************************************************#
+def radius_range(mAb_dict, pix_per_um, default_range):
+    """
+    Narrows the default spot radius range (in pixels) with the chip layout: a spot can be
+    no wider than the distance between neighboring spot centers in the chip file.
+    """
+    try:
+        spot_xy = np.array([(float(info[1]), float(info[2])) for info in mAb_dict.values()])
+    except (TypeError, ValueError, IndexError):
+        return default_range
+    if len(spot_xy) < 2:
+        return default_range
+
+    spot_dists = np.sqrt(((spot_xy[:,None,:] - spot_xy[None,:,:])**2).sum(axis=2))
+    np.fill_diagonal(spot_dists, np.inf)
+    pitch = np.median(spot_dists.min(axis=1))
+
+    max_rad = int(pitch / 2 * pix_per_um)
+    if not (default_range[0] < max_rad < default_range[1]):
+        return default_range
+
+    return default_range[0], max_rad
+#*********************************************************************************************#
+def _coarse_circle(sd_proj, rad_range, min_dist, scale):
+    """Strongest Hough circle on the image shrunk by scale, in full-resolution units, or None"""
+    nrows, ncols = sd_proj.shape
+    small_img = cv2.resize(sd_proj, (ncols // scale, nrows // scale), interpolation=cv2.INTER_AREA)
+
+    for canny_max, canny_min in HOUGH_SETTINGS:
+        ##Votes come from edge pixels, and the circumference shrinks with the image
+        circles = cv2.HoughCircles(small_img, cv2.HOUGH_GRADIENT, 1, minDist=min_dist / scale,
+                                   param1=canny_max, param2=max(canny_min / scale, 1),
+                                   minRadius=int(rad_range[0] / scale),
+                                   maxRadius=int(np.ceil(rad_range[1] / scale))
+        )
+        if circles is not None:
+            x, y, r = circles[0][0]
+            return (x + 0.5) * scale - 0.5, (y + 0.5) * scale - 0.5, r * scale
+
+    return None
+#*********************************************************************************************#
+def _fit_circle(x, y):
+    """Least-squares (Kasa) circle through the points; returns x, y and radius"""
+    A = np.column_stack([x, y, np.ones_like(x)])
+    (a, b, c), _, _, _ = np.linalg.lstsq(A, x**2 + y**2, rcond=None)
+    cx, cy = a / 2, b / 2
+
+    return cx, cy, np.sqrt(c + cx**2 + cy**2)
+#*********************************************************************************************#
+def refine_circle(sd_proj, circle, search_width, rays=360):
+    """
+    Refits a circle at full resolution: the spot edge is taken as the strongest radial intensity
+    change along each of rays spokes within search_width of the circle, and a circle is fit to
+    those points, twice, dropping outliers after the first fit.
+    """
+    x0, y0, r0 = circle
+    smooth_img = cv2.GaussianBlur(np.float32(sd_proj), (0,0), 2)
+
+    angles = np.linspace(0, 2*np.pi, rays, endpoint=False)
+    radii = np.arange(r0 - search_width, r0 + search_width + 1)
+    ray_x = x0 + np.cos(angles)[:,None] * radii[None,:]
+    ray_y = y0 + np.sin(angles)[:,None] * radii[None,:]
+
+    nrows, ncols = sd_proj.shape
+    in_frame = ((ray_x >= 0) & (ray_x <= ncols - 1) & (ray_y >= 0) & (ray_y <= nrows - 1)).all(axis=1)
+    if np.count_nonzero(in_frame) < rays // 4:
+        return circle
+
+    ray_x, ray_y = ray_x[in_frame], ray_y[in_frame]
+    profiles = map_coordinates(smooth_img, [ray_y.ravel(), ray_x.ravel()], order=1).reshape(ray_x.shape)
+    edge_ix = np.argmax(np.abs(np.diff(profiles, axis=1)), axis=1)
+    edge_x = (ray_x[np.arange(len(edge_ix)), edge_ix] + ray_x[np.arange(len(edge_ix)), edge_ix + 1]) / 2
+    edge_y = (ray_y[np.arange(len(edge_ix)), edge_ix] + ray_y[np.arange(len(edge_ix)), edge_ix + 1]) / 2
+
+    cx, cy, r = _fit_circle(edge_x, edge_y)
+    residuals = np.abs(np.sqrt((edge_x - cx)**2 + (edge_y - cy)**2) - r)
+    inliers = residuals <= max(3 * np.median(residuals), 1)
+    if np.count_nonzero(inliers) >= 3:
+        cx, cy, r = _fit_circle(edge_x[inliers], edge_y[inliers])
+
+    ##A fit that wanders off the coarse circle is not trusted
+    if (np.hypot(cx - x0, cy - y0) > search_width) or (abs(r - r0) > search_width):
+        return circle
+
+    return cx, cy, r
+#*********************************************************************************************#
+def find_spot(sd_proj, rad_range, min_dist=500, scale=4, fallback_radius=None):
+    """
+    Locates the antibody spot in the 8-bit SD projection. Returns (x, y, radius) rounded to
+    whole pixels, like the circles from cv2.HoughCircles. If no circle is found, the frame center
+    is used with fallback_radius, or else the radius of the last spot found by this process,
+    or else the middle of rad_range.
+    """
+    coarse_circle = _coarse_circle(sd_proj, rad_range, min_dist, scale)
+
+    if coarse_circle is not None:
+        spot_coords = refine_circle(sd_proj, coarse_circle, search_width=3*scale)
+        _last_radius[tuple(rad_range)] = spot_coords[2]
+    else:
+        nrows, ncols = sd_proj.shape
+        if fallback_radius is None:
+            fallback_radius = _last_radius.get(tuple(rad_range), sum(rad_range) / 2)
+        spot_coords = (ncols / 2, nrows / 2, fallback_radius)
+        print("Antibody spot not found; assuming a centered spot of radius {}\n".format(round(fallback_radius)))
+
+    return tuple(float(round(val, 0)) for val in spot_coords)
+#*********************************************************************************************#
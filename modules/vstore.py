@@ -0,0 +1,164 @@
+from __future__ import division
+import pandas as pd
+import numpy as np
+import glob, os
+"""
+Columnar (Parquet) storage for the per-pass vdata and the per-particle tables.
+Each spot writes its own part files (CHIP.SPOT.vdata.parquet, CHIP.SPOT.particle_data.parquet),
+so spots scanned in parallel or as separate cluster jobs never write the same file.
+Aggregation reads one table per chip (CHIP.vdata.parquet, CHIP.particle_data.parquet),
+which is rebuilt from the part files whenever any of them is newer than it.
+Tuple values are stored as one numeric column per element.
+"""
+_tuple_cols = {'spot_coords': ('spot_coords_x', 'spot_coords_y', 'spot_coords_r'),
+               'valid_shift': ('valid_shift_row', 'valid_shift_col'),
+               'centroid'   : ('centroid_row', 'centroid_col')
+}
+_vdata_floats = ['area_sqmm','classifier_median','fluor_particles_A','fluor_particles_C','spot_scan_time']
+_vdata_ints = ['total_valid_particles','pos_plane','spot_number','scan_number']
+#*********************************************************************************************#
+#
+#           SUBROUTINES
+#
+#*********************************************************************************************#
+def _split_tuples(df, col):
+    """Replaces a column of tuples (or their string form) with one float column per element"""
+    names = _tuple_cols[col]
+    def to_tuple(val):
+        if isinstance(val, str):
+            val = val.strip('()[] ').split(',')
+        try:
+            vals = [float(x) for x in val]
+        except (TypeError, ValueError):
+            vals = []
+        if len(vals) != len(names):
+            vals = [np.nan] * len(names)
+        return vals
+
+    split_df = pd.DataFrame([to_tuple(val) for val in df[col]], columns=names, index=df.index)
+    col_ix = list(df.columns).index(col)
+    df = df.drop(columns=col)
+    for i, name in enumerate(names):
+        df.insert(col_ix + i, name, split_df[name])
+
+    return df
+#*********************************************************************************************#
+def vdata_frame(vdata_rows):
+    """Typed DataFrame of vdata dictionaries (or an existing vdata DataFrame)"""
+    vdata_df = pd.DataFrame(vdata_rows).reset_index(drop=True)
+    if vdata_df.empty:
+        return vdata_df
+
+    for col in ('spot_coords', 'valid_shift'):
+        if col in vdata_df.columns:
+            vdata_df = _split_tuples(vdata_df, col)
+    for col in _vdata_floats + _vdata_ints:
+        if col in vdata_df.columns:
+            vdata_df[col] = pd.to_numeric(vdata_df[col], errors='coerce')
+    for col in _vdata_ints:
+        if col in vdata_df.columns:
+            vdata_df[col] = vdata_df[col].astype('Int64')
+    for col in ('validity', 'exo_toggle'):
+        if col in vdata_df.columns:
+            vdata_df[col] = vdata_df[col].map(lambda x: x in (True, 'True'))
+    for col in ('img_name', 'spot_type', 'overlay_mode', 'marker_locs', 'version'):
+        if col in vdata_df.columns:
+            vdata_df[col] = vdata_df[col].astype(str)
+
+    return vdata_df
+#*********************************************************************************************#
+def particle_frame(shape_df, columns, spot_num):
+    """Typed DataFrame of the particle columns that are kept, tagged with the spot number"""
+    particle_df = shape_df.reindex(columns=columns).reset_index(drop=True)
+    if 'centroid' in particle_df.columns:
+        particle_df = _split_tuples(particle_df, 'centroid')
+    particle_df['validity'] = particle_df['validity'].astype(bool)
+    particle_df.insert(0, 'spot_number', spot_num)
+
+    return particle_df
+#*********************************************************************************************#
+def write_table(df, table_file):
+    """Writes a Parquet file under a temporary name first, so readers never see a partial file"""
+    temp_file = '{}.{}.part'.format(table_file, os.getpid())
+    df.to_parquet(temp_file, index=False)
+    os.replace(temp_file, table_file)
+#*********************************************************************************************#
+def read_chip_table(vcount_dir, chip_name, table, columns=None):
+    """
+    Reads the chip-wide vdata or particle_data table, rebuilding it first if any part file
+    is newer. Only the requested columns are read. Returns None if the chip has no Parquet data.
+    """
+    table_file = '{}/{}.{}.parquet'.format(vcount_dir, chip_name, table)
+    part_files = sorted(glob.glob('{}/{}.*.{}.parquet'.format(vcount_dir, chip_name, table)))
+
+    if not part_files and not os.path.exists(table_file):
+        return None
+
+    if part_files and ((not os.path.exists(table_file))
+                       or (max(map(os.path.getmtime, part_files)) > os.path.getmtime(table_file))):
+        print("Combining {} {} files into {}\n".format(len(part_files), table, table_file.split('/')[-1]))
+        ##Later part files win, so a rescanned pass replaces the blank row written for it
+        part_files.sort(key=os.path.getmtime)
+        chip_df = pd.concat([pd.read_parquet(part_file) for part_file in part_files],
+                            ignore_index=True, sort=False
+        )
+        if table == 'vdata':
+            chip_df = chip_df.drop_duplicates('img_name', keep='last').sort_values('img_name')
+        else:
+            chip_df = chip_df.sort_values(['spot_number', 'pass_number'], kind='mergesort')
+        write_table(chip_df.reset_index(drop=True), table_file)
+
+    return pd.read_parquet(table_file, columns=columns)
+#*********************************************************************************************#
+def particle_data_by_spot(vcount_dir, chip_name, columns):
+    """
+    Yields (spot string, particle DataFrame) for every scanned spot in order, from the chip
+    Parquet table if there is one, otherwise from the per-spot particle_data.csv files.
+    """
+    particle_df = read_chip_table(vcount_dir, chip_name, 'particle_data', ['spot_number'] + columns)
+    if particle_df is not None:
+        part_files = glob.glob('{}/{}.*.particle_data.parquet'.format(vcount_dir, chip_name))
+        ##Spots without any particles only show up as part files
+        spot_nums = sorted(set(int(part_file.split('/')[-1].split('.')[1]) for part_file in part_files)
+                           | set(particle_df.spot_number)
+        )
+        spot_groups = dict(list(particle_df.groupby('spot_number')))
+        for spot_num in spot_nums:
+            spot_particle_df = spot_groups.get(spot_num, particle_df.iloc[:0])
+            yield str(spot_num).zfill(3), spot_particle_df[columns].reset_index(drop=True)
+    else:
+        for csvfile in sorted(glob.glob('{}/{}.*.particle_data.csv'.format(vcount_dir, chip_name))):
+            yield csvfile.split('/')[-1].split(".")[1], pd.read_csv(csvfile, error_bad_lines=False,
+                                                                     header=0, usecols=columns)
+#*********************************************************************************************#
+def read_particle_data(vcount_dir, chip_name, columns):
+    """
+    One DataFrame of the particle columns for every spot on the chip, with spot_number,
+    from the chip Parquet table if there is one, otherwise from all the particle_data.csv files
+    """
+    particle_df = read_chip_table(vcount_dir, chip_name, 'particle_data', ['spot_number'] + columns)
+    if particle_df is not None:
+        return particle_df
+
+    csv_list = sorted(glob.glob('{}/{}.*.particle_data.csv'.format(vcount_dir, chip_name)))
+    spot_dfs = [pd.read_csv(csvfile, error_bad_lines=False, header=0, usecols=columns)
+                for csvfile in csv_list]
+    if not spot_dfs:
+        return pd.DataFrame(columns=['spot_number'] + columns)
+    spot_nums = [int(csvfile.split('/')[-1].split(".")[1]) for csvfile in csv_list]
+
+    particle_df = pd.concat(spot_dfs, ignore_index=True, sort=False)
+    particle_df.insert(0, 'spot_number', np.repeat(spot_nums, [len(spot_df) for spot_df in spot_dfs]))
+
+    return particle_df
+#*********************************************************************************************#
+def parquet_available():
+    """True if pandas has a Parquet engine (pyarrow or fastparquet) to write with"""
+    for engine in ('pyarrow', 'fastparquet'):
+        try:
+            __import__(engine)
+            return True
+        except ImportError:
+            pass
+    return False
+#*********************************************************************************************#
@@ -0,0 +1,26 @@
+from __future__ import division
+from multiprocessing import get_context, get_all_start_methods
+"""
+Settings shared by the worker pools: the spot pool (vmulti), the render pool (vrender) and the
+TIFF conversion pool (vpipes.tiff_maker).
+The driver scripts are not import-safe, so the workers are forked wherever the platform allows it.
+A process should only be forked while it runs no other threads, so a pool that starts threads of
+its own (like the render pool) must be started after any pool forked before it.
+"""
+#*********************************************************************************************#
+#
+#           SUBROUTINES
+#
+#*********************************************************************************************#
+def worker_context():
+    """Multiprocessing context of the worker pools: fork where available, the default otherwise"""
+    if 'fork' in get_all_start_methods():
+        return get_context('fork')
+
+    return get_context()
+#*********************************************************************************************#
+def init_figure_worker():
+    """Pool initializer for workers that only ever write figures to disk (no interactive backend)"""
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
+#*********************************************************************************************#
@@ -27,7 +27,7 @@ from scipy.ndimage.morphology import binary_fill_holes, binary_dilation
 from scipy.spatial import cKDTree
 from math import isnan
 
-from modules import vpipes, vimage, vquant, vgraph, vfilo
+from modules import vpipes, vimage, vquant, vgraph, vfilo, vstore, vaggregate
 # from modules.filographs import filohisto
 from images import logo
 
@@ -1141,7 +1141,6 @@ else:
 
 
 os.chdir(vcount_dir)
-particle_data_list = sorted(glob.glob(chip_name +'*.particle_data.csv'))
 vdata_list = sorted(glob.glob(chip_name +'*.vdata.txt'))
 
 if len(vdata_list) >= (len(iris_txt) * pass_counter):
@@ -1173,50 +1172,12 @@ if len(vdata_list) >= (len(iris_txt) * pass_counter):
         histo_metric ='perc_contrast'
     print("Using {} to make histograms".format(histo_metric))
 
-    metric_df = pd.DataFrame()
-    new_particle_count, cum_particle_count = [],[]
-    for i, csvfile in enumerate(particle_data_list):
-        if i+1 not in bad_spots:
-            particle_df = pd.read_csv(csvfile, error_bad_lines=False,  header=0,
-                                      usecols=['perc_contrast','z_intensity','validity','pass_number'])
-            cumulative_particles = 0
-            for j in range(1,pass_counter+1):
-
-                area_str = spot_df.area_sqmm[(spot_df.spot_number == i+1)
-                                            & (spot_df.scan_number == j)].values[0]
-                area_squm = int(float(area_str)*1e6)
-
-                csv_id = '{}.{}.{}'.format(csvfile.split(".")[1], str(j).zfill(3), area_squm)
-
-                metric_series = particle_df[histo_metric][ (particle_df.pass_number == j)
-                                                         & (particle_df.validity == True)
-                ].reset_index(drop=True).rename(csv_id)
-
-                metric_df = pd.concat([metric_df, metric_series], axis=1)
-
-                kept_particles = metric_series[(metric_series > min_cont)
-                                             & (metric_series <= max_cont)
-                ]
-
-                particles_per_pass = len(kept_particles)
-                new_particle_count.append(particles_per_pass)
-                cumulative_particles += particles_per_pass
-                cum_particle_count.append(cumulative_particles)
-
-                print(  'File scanned: {}; '.format(csvfile)
-                      + 'Scan {}, '.format(j)
-                      + 'Particles accumulated: {}'.format(cumulative_particles)
-                )
-        else:
-            print("No data for {}\n".format(csvfile))
-            new_particle_count = new_particle_count + ([0]*pass_counter)
-            cum_particle_count = cum_particle_count + ([0]*pass_counter)
-
-    spot_df['new_particles'] = new_particle_count
-    spot_df['cumulative_particles'] = cum_particle_count
-    spot_df['kparticle_density'] = np.round(cum_particle_count
-                                            / spot_df.area_sqmm.astype(float) * 0.001, 3
+    particle_df = vstore.read_particle_data(vcount_dir, chip_name,
+                                            ['perc_contrast','z_intensity','validity','pass_number']
     )
+    metric_df = vaggregate.metric_table(particle_df, spot_df, histo_metric, bad_spots)
+    spot_df = vaggregate.particle_counts(metric_df, spot_df, metric_window, bad_spots)
+    vaggregate.print_counts(spot_df, bad_spots)
 
     spot_df.loc[spot_df.kparticle_density == 0, 'validity'] = False
 
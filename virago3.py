@@ -31,7 +31,7 @@ from math import isnan
 
 from cv2 import normalize, NORM_MINMAX
 
-from modules import vpipes, vimage, vquant, vgraph, vfilo, vmulti
+from modules import vpipes, vimage, vquant, vgraph, vfilo, vmulti, vstore, vprofile, vaggregate, vrender
 # from modules.filographs import filohisto
 from images import logo
 
@@ -86,56 +86,25 @@ Version 2 Notes:
 print("VERSION {}\n".format(version))
 print(os.path.dirname(__file__))
 
-def get_dupe_index(removal_index, l1, i1):
-
-    seen = set()
-    # adds all elements it doesn't know yet to seen and all other to seen_twice
-    dupes = set(x for x in l1 if x in seen or seen.add(x))
-        #return indices of all occurences of duplicates
-    dupes = list(dupes)
-
-    if dupes == []:
-        return []
-    else:
-        for dupe_val in dupes:
-            # print(dupe_val)
-            dupe_indices = [i for i, val in enumerate(l1) if val == dupe_val]
-            # print(dupe_indices)
-            dupe_ious = [i1[ix] for ix in dupe_indices]
-            # print(dupe_ious)
-            dupe_to_remove = dupe_indices[dupe_ious.index(min(dupe_ious))]
-            # print(dupe_to_remove)
-            removal_index.append(dupe_to_remove)
-            # print(removal_index)
-        return removal_index
-
-def remove_dupes_by_iou(overlap_ix_list):
-    v1,f1,i1 = [],[],[]
-    removal_index = []
-    for n, tup in enumerate(overlap_ix_list):
-        v1.append(tup[0])
-        f1.append(tup[1])
-        i1.append(tup[2])
-
-    removal_index = get_dupe_index(removal_index, f1,i1)
-
-    removal_index = get_dupe_index(removal_index, v1,i1)
-
-    removal_list = [overlap_ix_list[ix] for ix in removal_index]
-
-    return [val for val in overlap_ix_list if val not in removal_list]
 #*********************************************************************************************#
 #
 #    CODE BEGINS HERE
 #
 #*********************************************************************************************#
 ##Quick-change Boolean Parameters
-parser = argparse.ArgumentParser()
-
-parser.add_argument("--foo", help="foo Help")
+parser = vpipes.get_arg_parser(version)
 
 args = parser.parse_args()
 
+if args.stage is None: stages = ['scan', 'aggregate', 'plot']
+else: stages = args.stage
+args = vpipes.batch_defaults(parser, args, stages)
+
+data_format = args.data_format
+if (data_format == 'parquet') and not vstore.parquet_available():
+    print("No Parquet engine (pyarrow or fastparquet) installed; writing text and CSV files instead\n")
+    data_format = 'csv'
+
 print(sys.argv)
 
 show_particles = True ##show particle info on output images
@@ -152,7 +121,11 @@ IRISmarker_exo = skio.imread('images/IRISmarker_v4_topstack.tif')
 pgm_list, tiff_list = [],[]
 marker_dict = {}
 while (pgm_list == []) and (tiff_list == []): ##Keep repeating until pgm files are found
-    iris_path = input("\nPlease type in the path to the folder that contains the IRIS data:\n")
+    if args.iris_path:
+        iris_path = args.iris_path
+    else:
+        iris_path = vpipes.ask("\nPlease type in the path to the folder that contains the IRIS data:\n",
+                               'the iris_path argument', args.batch)
     if iris_path == 'test':
         iris_path = '/Volumes/KatahdinHD/ResilioSync/DATA/IRIS/FIGS4PAPER/expts/tCHIP007_EBOVmay@1E6'
     else:
@@ -160,6 +133,8 @@ while (pgm_list == []) and (tiff_list == []): ##Keep repeating until pgm files a
     os.chdir(iris_path)
     pgm_list = sorted(glob.glob('*.pgm'))
     tiff_list = sorted(glob.glob('*.tif'))
+    if args.iris_path and (pgm_list == []) and (tiff_list == []):
+        sys.exit("No IRIS images found in {}".format(iris_path))
 
 pgm_list, mirror = vpipes.mirror_finder(pgm_list)
 
@@ -168,17 +143,17 @@ fluor_files = [file for file in pgm_list if file.split(".")[-2] in 'ABC']
 if tiff_list == []:
     tiff_toggle = False
     image_list = pgm_list
-    convert_tiff = input("Convert PGM stacks to TIFFs (y/n)?")
+    convert_tiff = args.convert_tiff or vpipes.ask("Convert PGM stacks to TIFFs (y/n)?", '--convert-tiff', args.batch)
     while convert_tiff.lower() not in ['yes', 'y', 'no', 'n']:
-        convert_tiff = input("Convert PGM stacks to TIFFs (y/n)?")
-    if convert_tiff in ['yes', 'y']:
+        convert_tiff = vpipes.ask("Convert PGM stacks to TIFFs (y/n)?", '--convert-tiff', args.batch)
+    if convert_tiff.lower() in ['yes', 'y']:
         convert_tiff = True
     else:
         convert_tiff = False
 
 elif pgm_list == []:
     tiff_toggle = True
-    covert_tiff = False
+    convert_tiff = False
     image_list = tiff_list
 
 elif pgm_list == fluor_files:
@@ -191,10 +166,10 @@ else:
     print("Mixture of PGM and TIFF files\n")#. Please convert all PGM files before continuing")
     image_list = sorted(set(tiff_list + pgm_list) - set(fluor_files))
 
-    convert_tiff = input("Convert PGM stacks to TIFFs (y/n)?")
+    convert_tiff = args.convert_tiff or vpipes.ask("Convert PGM stacks to TIFFs (y/n)?", '--convert-tiff', args.batch)
     while convert_tiff.lower() not in ['yes', 'y', 'no', 'n']:
-        convert_tiff = input("Convert PGM stacks to TIFFs (y/n)?")
-    if convert_tiff in ['yes', 'y']:
+        convert_tiff = vpipes.ask("Convert PGM stacks to TIFFs (y/n)?", '--convert-tiff', args.batch)
+    if convert_tiff.lower() in ['yes', 'y']:
         convert_tiff = True
     else:
         convert_tiff = False
@@ -236,7 +211,7 @@ pix_per_um = mag / cam_micron_per_pix
 spacing = 1 / pix_per_um
 conv_factor = (cam_micron_per_pix / mag)**2
 
-sample_name = vpipes.sample_namer(iris_path)
+sample_name = vpipes.sample_namer(iris_path, sample_name=args.sample_name, batch=args.batch)
 
 virago_dir = '{}/v3-analysis'.format(iris_path)
 vcount_dir = '{}/vcounts'.format(virago_dir)
@@ -291,16 +266,18 @@ spot_df, expt_date = vpipes.iris_txt_reader(iris_txt, mAb_dict, pass_counter)
 # Image Scanning
 
 #*********************************************************************************************#
-if (image_set != set()):
+if (image_set != set()) and ('scan' in stages):
 
-    if made_dir == True: image_toggle = 'yes'
-    else: image_toggle = ''
+    if (made_dir == True) or (args.stage is not None) or (args.spots is not None) or args.batch:
+        image_toggle = 'yes'
+    else:
+        image_toggle = ''
 
     toggle_list = [str(i) for i in spot_list]
     toggle_list.extend(['yes', 'y', 'no', 'n'])
     while image_toggle not in (toggle_list):
-        image_toggle = input("\nImage files detected. Do you want scan them for particles? (y/n)\n"
-                           + "WARNING: This will take a long time!\n")
+        image_toggle = vpipes.ask("\nImage files detected. Do you want scan them for particles? (y/n)\n"
+                                  + "WARNING: This will take a long time!\n", '--stage or --spots', args.batch)
 else:
     image_toggle = 'no'
 
@@ -311,24 +288,35 @@ if image_toggle.lower() not in ('no', 'n'):
         spot_to_scan = 1
     startTime = datetime.now()
 
-    circle_dict, marker_dict, overlay_dict, shift_dict = {},{},{},{}
-
-    while spot_to_scan <= spot_counter:
+    params_dict.update({'version'       : version,
+                        'Ab_spot_mode'  : Ab_spot_mode,
+                        'pass_counter'  : pass_counter,
+                        'mAb_dict'      : mAb_dict,
+                        'convert_tiff'  : convert_tiff,
+                        'show_particles': show_particles,
+                        'particle_labels': args.particle_labels,
+                        'cache_gb'      : args.cache_gb,
+                        'data_format'   : data_format,
+                        'profile_spot'  : args.profile_spot,
+                        'threads'       : args.threads,
+                        'register_levels': args.register_levels
+    })
+
+    if args.spots is not None:
+        spot_nums = [spot_num for spot_num in args.spots if spot_num <= spot_counter]
+    else:
+        spot_nums = range(spot_to_scan, spot_counter+1)
+    for spot_num in spot_nums:
 
         vdata_dict = vpipes.get_vdata_dict(params_dict['exo_toggle'], version)
 
-        pps_list = sorted([file for file in image_list if int(file.split(".")[1]) == spot_to_scan])
-        fluor_files = [file for file in pps_list if file.split(".")[-2] in 'ABC']
-        if fluor_files:
-            pps_list = tuple(file for file in pps_list if file not in fluor_files)
-            print("\nFluorescent channel(s) detected: {}\n".format(fluor_files))
-
-
-        passes_per_spot = len(pps_list)
-        spot_ID = pps_list[0][:-8]
+        pps_list = sorted([file for file in image_list if int(file.split(".")[1]) == spot_num])
+        if not pps_list:
+            continue
+        spot_ID = '.'.join(pps_list[0].split(".")[:2])
         scans_counted = {int(file.split(".")[2]) for file in pps_list}
 
-        if (passes_per_spot != pass_counter):
+        if (len(scans_counted) != pass_counter):
             print("Missing pgm files... fixing...\n")
 
             scan_set = set(range(1,pass_counter+1))
@@ -342,19 +330,28 @@ if image_toggle.lower() not in ('no', 'n'):
                 with open('{}/{}.vdata.txt'.format(vcount_dir,bad_scan),'w') as f:
                     for k,v in vdata_dict.items():
                         f.write('{}: {}\n'.format(k,v))
+                if data_format == 'parquet':
+                    vstore.write_table(vstore.vdata_frame([vdata_dict]),
+                                       '{}/{}.vdata.parquet'.format(vcount_dir,bad_scan)
+                    )
                 print("Writing blank data files for {}".format(bad_scan))
-                keep_data = []
-
 
 #---------------------------------------------------------------------------------------------#
+    spot_tasks = vmulti.spot_tasker(image_list, spot_nums, mirror, params_dict)
 
-        main_loop(pps_list, mirror, params_dict)
+    scan_df, zslice_count, timing_df = vmulti.multip_main_loop(spot_tasks, workers=args.workers,
+                                                                 render_workers=args.render_workers
+    )
 
-        spot_to_scan += 1
+    if not scan_df.empty:
+        spot_df = spot_df.merge(scan_df[['spot_number','scan_number',
+                                         'total_valid_particles','spot_scan_time']],
+                                on=['spot_number','scan_number'], how='left'
+        )
 
-        analysis_time = str(datetime.now() - startTime)
+    analysis_time = str(datetime.now() - startTime)
 
-        print("Time to scan images: {}".format(analysis_time))
+    print("Time to scan images: {}".format(analysis_time))
 
 #*********************************************************************************************#
     info_dict = {'chip_name'      : chip_name,
@@ -369,10 +366,22 @@ if image_toggle.lower() not in ('no', 'n'):
     with open('{}/{}.expt_info_{}.txt'.format(virago_dir,chip_name,version),'w') as info_file:
         for k,v in info_dict.items():
             info_file.write('{}: {}\n'.format(k,v))
+
+    if not timing_df.empty:
+        vprofile.write_timing_log(timing_df, '{}/{}.stage_timing_{}.csv'.format(virago_dir,chip_name,version))
 #*********************************************************************************************#
+if not (('aggregate' in stages) or ('plot' in stages)):
+    vrender.wait()
+    print("Scan stage finished. Exiting...")
+    sys.exit()
+
+##The chip figures are drawn by background processes, started now that no spot pool is left to fork
+vrender.start(args.render_workers)
+
 os.chdir(virago_dir)
 info_list = sorted(glob.glob('*_info_*'))
 if info_list == []:
+    vrender.wait()
     print("No valid data to interpret. Exiting...")
     sys.exit()
 else:
@@ -391,21 +400,25 @@ else:
 
 
 os.chdir(vcount_dir)
-particle_data_list = sorted(glob.glob(chip_name +'*.particle_data.csv'))
-vdata_list = sorted(glob.glob(chip_name +'*.vdata.txt'))
+##One Parquet table per chip when there is one; the text files from older runs otherwise
+vdata_df = vstore.read_chip_table(vcount_dir, chip_name, 'vdata',
+                                  columns=['img_name','area_sqmm','validity',
+                                           'fluor_particles_A','fluor_particles_C']
+)
+if vdata_df is None:
+    vdata_list = sorted(glob.glob(chip_name +'*.vdata.txt'))
+    vdata_df = vquant.vdata_reader(vdata_list) if vdata_list else pd.DataFrame()
 
-if len(vdata_list) >= (len(iris_txt) * pass_counter):
-    metric_str = str(input("\nEnter the minimum and maximum percent intensity values,"
-                                + " separated by a dash.\n"))
+if len(vdata_df) >= (len(iris_txt) * pass_counter):
+    metric_str = args.contrast or str(vpipes.ask("\nEnter the minimum and maximum percent intensity values,"
+                                                 + " separated by a dash.\n", '--contrast', args.batch))
     while "-" not in metric_str:
-        metric_str = str(input("\nPlease enter two values separated by a dash.\n"))
+        metric_str = str(vpipes.ask("\nPlease enter two values separated by a dash.\n", '--contrast', args.batch))
     else:
         min_cont, max_cont = map(float, metric_str.split("-"))
 
     metric_window = [min_cont, max_cont]
 
-    vdata_df = vquant.vdata_reader(vdata_list)
-
     spot_df = pd.concat([spot_df, vdata_df[['area_sqmm',
                                             'validity',
                                             'fluor_particles_A',
@@ -423,50 +436,12 @@ if len(vdata_list) >= (len(iris_txt) * pass_counter):
         histo_metric ='perc_contrast'
     print("Using {} to make histograms".format(histo_metric))
 
-    metric_df = pd.DataFrame()
-    new_particle_count, cum_particle_count = [],[]
-    for i, csvfile in enumerate(particle_data_list):
-        if i+1 not in bad_spots:
-            particle_df = pd.read_csv(csvfile, error_bad_lines=False,  header=0,
-                                      usecols=['perc_contrast','z_intensity','validity','pass_number'])
-            cumulative_particles = 0
-            for j in range(1,pass_counter+1):
-
-                area_str = spot_df.area_sqmm[(spot_df.spot_number == i+1)
-                                            & (spot_df.scan_number == j)].values[0]
-                area_squm = int(float(area_str)*1e6)
-
-                csv_id = '{}.{}.{}'.format(csvfile.split(".")[1], str(j).zfill(3), area_squm)
-
-                metric_series = particle_df[histo_metric][ (particle_df.pass_number == j)
-                                                         & (particle_df.validity == True)
-                ].reset_index(drop=True).rename(csv_id)
-
-                metric_df = pd.concat([metric_df, metric_series], axis=1)
-
-                kept_particles = metric_series[(metric_series > min_cont)
-                                             & (metric_series <= max_cont)
-                ]
-
-                particles_per_pass = len(kept_particles)
-                new_particle_count.append(particles_per_pass)
-                cumulative_particles += particles_per_pass
-                cum_particle_count.append(cumulative_particles)
-
-                print(  'File scanned: {}; '.format(csvfile)
-                      + 'Scan {}, '.format(j)
-                      + 'Particles accumulated: {}'.format(cumulative_particles)
-                )
-        else:
-            print("No data for {}\n".format(csvfile))
-            new_particle_count = new_particle_count + ([0]*pass_counter)
-            cum_particle_count = cum_particle_count + ([0]*pass_counter)
-
-    spot_df['new_particles'] = new_particle_count
-    spot_df['cumulative_particles'] = cum_particle_count
-    spot_df['kparticle_density'] = np.round(cum_particle_count
-                                            / spot_df.area_sqmm.astype(float) * 0.001, 3
+    particle_df = vstore.read_particle_data(vcount_dir, chip_name,
+                                            ['perc_contrast','z_intensity','validity','pass_number']
     )
+    metric_df = vaggregate.metric_table(particle_df, spot_df, histo_metric, bad_spots)
+    spot_df = vaggregate.particle_counts(metric_df, spot_df, metric_window, bad_spots)
+    vaggregate.print_counts(spot_df, bad_spots)
 
     spot_df.loc[spot_df.kparticle_density == 0, 'validity'] = False
 
@@ -474,14 +449,15 @@ if len(vdata_list) >= (len(iris_txt) * pass_counter):
 
     os.chdir(iris_path)
 
-elif len(vdata_list) != (len(iris_txt) * pass_counter):
+elif len(vdata_df) != (len(iris_txt) * pass_counter):
+    vrender.wait()
     print("Missing VIRAGO analysis files! Exiting...\n")
     sys.exit()
 
 print(spot_df[['spot_number','scan_number','spot_type','validity','kparticle_density','normalized_density']])
 
 spot_df, metric_df = vquant.spot_remover(spot_df, metric_df, vcount_dir, iris_path,
-                                           quarantine_img=True
+                                           quarantine_img=True, excise_spots=args.remove_spots
 )
 
 
@@ -497,7 +473,10 @@ sum_histogram_df.to_csv('{}/{}.sum_histogram_data.v{}.csv'.format(histo_dir, chi
 avg_histogram_df = vgraph.average_histogram(sum_histogram_df, spot_df, pass_counter)
 avg_histogram_df.to_csv('{}/{}_avg_histogram_data.v{}.csv'.format(histo_dir, chip_name, version))
 
-vgraph.generate_histogram(avg_histogram_df, pass_counter, chip_name, metric_str, histo_metric, histo_dir)
+if 'plot' in stages:
+    vrender.submit('histograms', vgraph.generate_histogram,
+                   avg_histogram_df, pass_counter, chip_name, metric_str, histo_metric, histo_dir
+    )
 
 #*********************************************************************************************#
 spot_df['normalized_density'] = vquant.density_normalizer(spot_df, spot_counter)
@@ -509,126 +488,33 @@ print('File generated: {}'.format(spot_df_name))
 
 averaged_df = vgraph.average_spot_data(spot_df, pass_counter)
 
-if pass_counter > 2:
-    vgraph.generate_timeseries(spot_df, averaged_df, metric_window, mAb_dict,
-                                chip_name, sample_name, version,
-                                scan_or_time = timeseries_mode, baseline = True,
-                                savedir = virago_dir
-    )
-elif pass_counter <= 2:
-    vgraph.iris_barplot_gen(spot_df, pass_counter, metric_window=metric_window, chip_name=chip_name,
-                            version=version, savedir=virago_dir, plot_3sigma=True,
+if 'plot' in stages:
+    if pass_counter > 2:
+        vrender.submit('timeseries', vgraph.generate_timeseries,
+                       spot_df, averaged_df, metric_window, mAb_dict,
+                       chip_name, sample_name, version,
+                       scan_or_time = timeseries_mode, baseline = True,
+                       savedir = virago_dir
+        )
+    elif pass_counter <= 2:
+        vrender.submit('barplot', vgraph.iris_barplot_gen,
+                       spot_df, pass_counter, metric_window=metric_window, chip_name=chip_name,
+                       version=version, savedir=virago_dir, plot_3sigma=True,
+        )
+    if sys.platform != 'win32':
+        vrender.submit('chip array', vgraph.chipArray_graph,
+                       spot_df,
+                       chip_name=chip_name, sample_name=sample_name, metric_str=metric_str,
+                       exo_toggle=exo_toggle, savedir=virago_dir, version=version
+        )
+
+
+
+if fluor_files and ('plot' in stages):
+    ##fluor_bargraph has always saved to fluor_dir
+    vrender.submit('fluorescence barplot', vgraph.fluor_bargraph,
+                   spot_df, pass_counter, chip_name, version, fluor_dir,
+                   Amab=amab, Cmab=cmab
     )
-if sys.platform != 'win32':
-    vgraph.chipArray_graph(spot_df,
-                           chip_name=chip_name, sample_name=sample_name, metric_str=metric_str,
-                           exo_toggle=exo_toggle, savedir=virago_dir, version=version
-    )
-
-
-
-def fluor_bargraph(spot_df, pass_counter, chip_name=chip_name, version=version,
-                    savedir=fluor_dir, plot_3sigma=True, Amab ='', Cmab='',
-                    neg_ctrl_str='8G5|MOUSE IGG|muIgG|GFP'):
-
-    """
-    Generates a barplot for the dataset.
-    Most useful for before and after scans (pass_counter == 2)
-    """
-
-    sns.set_style('darkgrid')
-
-    Achan = '594(A)'
-    Cchan = '695(C)'
-    axis_min = 2
-
-    pre_df = spot_df[(spot_df.scan_number == 1)  & (spot_df.validity == True)]
-    post_df = spot_df[(spot_df.scan_number == pass_counter) & (spot_df.validity == True)]
-    dflen = len(pre_df)
 
-    chan_series = pd.Series(['{}: {}'.format(Achan,Amab)]*dflen + ['{}: {}'.format(Cchan,Cmab)]*dflen, name='channel')
-    spot_type_series = pre_df.spot_type.apply(lambda x: x.split('_')[0])
-    pre_area_series = pre_df.area_sqmm.astype('float')*1000
-    spot_type_series_x2 = pd.concat([spot_type_series, spot_type_series]).reset_index(drop=True)
-    channel_pre_df  = pd.concat([pre_df['fluor_particles_A'].astype('float')/pre_area_series,
-                                 pre_df['fluor_particles_C'].astype('float')/pre_area_series],
-                                 ignore_index=True).rename('fluor_val_pre')
-
-    fluorbar_df = pd.concat([spot_type_series_x2, chan_series, channel_pre_df], axis=1)
-    ax1_max = max(fluorbar_df['fluor_val_pre'])
-    if ax1_max < axis_min:
-        ax1_max = axis_min
-    elif isnan(ax1_max):
-        ax1_max = axis_min
-    else:
-        ax1_max = round(ax1_max,1) + 1
-
-    post_area_series =post_df.area_sqmm.astype('float')*1000
-    channel_post_df  = pd.concat([post_df['fluor_particles_A'].astype('float')/ post_area_series,
-                                  post_df['fluor_particles_C'].astype('float')/ post_area_series],
-                                  ignore_index=True).rename('fluor_val_post')
-
-
-    fluorbar_df = pd.concat([fluorbar_df, channel_post_df], axis=1)
-
-    ax2_max = max(fluorbar_df['fluor_val_post'])
-    if ax2_max < axis_min:
-        ax2_max = axis_min
-    elif isnan(ax2_max):
-        ax2_max = axis_min
-    else:
-        ax2_max = round(ax2_max,1) + 1
-
-    fig, (ax1, ax2)=plt.subplots(1, 2, figsize=(8, 6), sharey=True,
-                                 gridspec_kw = {'width_ratios':[ax1_max, ax2_max]}
-    )
-    colors = ('#4daf4a','#de2d26')
-    # labels = [Patch(color=colors[c], label=val) for c, val in enumerate(fluorbar_df.channel.unique())]
-
-    fig.add_subplot(111, frameon=False)
-    plt.tick_params(labelcolor='none', top='off', bottom='off', left='off', right='off')
-    plt.grid(False)
-    plt.suptitle("Fluorescence of {}".format(chip_name), y=1, fontsize=20)
-    plt.xlabel("Fluorescent Particle Density (kparticles/mm" + r'$^2$'+')', fontsize=14)
-
-    ax1 = sns.barplot(x='fluor_val_pre',y='spot_type',hue='channel', data=fluorbar_df,
-                     palette=colors, alpha = 0.5, errwidth=2, ci='sd', ax=ax1)
-    ax1.set_xlim([ax1_max,0])
-    ax1.set_title("Prescan", fontsize=12)
-    ax1.set_ylabel('')
-    ax1.set_xlabel('')
-
-    ax1.legend('')
-
-    ax2 = sns.barplot(x='fluor_val_post',y='spot_type',hue='channel', data=fluorbar_df,
-                     palette=colors, errwidth=2, ci='sd', ax=ax2)
-    if plot_3sigma == True:
-        neg_control_df = fluorbar_df[fluorbar_df.spot_type.str.contains(neg_ctrl_str)]
-        A_neg_vals = neg_control_df.fluor_val_post[neg_control_df.channel.str.contains('A')]
-        C_neg_vals = neg_control_df.fluor_val_post[neg_control_df.channel.str.contains('C')]
-        three_sigma_A = (np.std(A_neg_vals) * 3) + np.mean(A_neg_vals)
-        three_sigma_C = (np.std(C_neg_vals) * 3) + np.mean(C_neg_vals)
-        ax2.axvline(x=three_sigma_A,ls='--',lw=1,color='g', label='3'+r'$\sigma$'+' Signal Threshold A')
-        ax2.axvline(x=three_sigma_C,ls=':',lw=1,color='r', label='3'+r'$\sigma$'+' Signal Threshold C')
-        # line_legend = ax2.get_legend_handles_labels()
-        # labels = labels+line_legend[0]
-    labels = ax2.get_legend_handles_labels()[0]
-    ax2.legend(handles=labels, fontsize=10, loc ='best')
-    ax2.set_xlim([0,ax2_max])
-    ax2.yaxis.set_tick_params(labelsize=12, rotation = 45)
-    ax2.set_title("Postscan", fontsize=12)
-    ax2.set_ylabel('')
-    ax2.set_xlabel('')
-
-    plt.tight_layout()
-    plt.subplots_adjust(wspace=0, hspace=0)
-
-    plot_name="{}_fluorescence_barplot.v{}.png".format(chip_name, version)
-    plt.savefig('{}/{}'.format(fluor_dir, plot_name), bbox_inches='tight', pad_inches=0.1, dpi=300)
-    print('File generated: {}'.format(plot_name))
-    plt.close('all')
-
-if fluor_files:
-    fluor_fig = fluor_bargraph(spot_df, pass_counter, chip_name, version, virago_dir,
-                               Amab=amab, Cmab=cmab
-    )
+vrender.wait()
@@ -1,10 +1,9 @@
 import numpy as np
 import pandas as pd
+import statsmodels.api as smapi
 import warnings
 import os
 
-from matplotlib.pyplot import savefig, clf, close
-from cv2 import normalize, NORM_MINMAX, HoughCircles, HOUGH_GRADIENT
 from scipy.ndimage import gaussian_filter
 from scipy.ndimage.morphology import binary_fill_holes, binary_dilation
 from skimage.feature import shape_index
@@ -13,12 +12,18 @@ from skimage.io import imread, imread_collection
 from sys import stdin
 
 
-from modules import vpipes, vimage, vquant, vfilo, vgraph
+from modules import vpipes, vimage, vquant, vfilo, vgraph, vcache, vstore, vprofile, vspot, vregister, vrender
 
 
 #Feed in pps_list, which is the list of all images of a single spot
 def main_loop(pps_list, mirror, params_dict):
-
+    """
+    Runs the full pass sequence (load, contrast, register, classify, quantify) for one antibody
+    spot and writes its vdata and particle_data files. All per-spot state lives inside this call,
+    so spots can be scanned independently of one another (see vmulti.multip_main_loop).
+    Returns the list of vdata dictionaries written for each pass, the z-slice count and
+    the stage timing records (see vprofile.StageTimer).
+    """
     virago_dir = '{}/v3-analysis'.format(os.getcwd())
     vcount_dir = '{}/vcounts'.format(virago_dir)
     img_dir = '{}/processed_images'.format(virago_dir)
@@ -26,6 +31,7 @@ def main_loop(pps_list, mirror, params_dict):
     overlay_dir = '{}/overlays'.format(virago_dir)
     filo_dir = '{}/filo'.format(virago_dir)
     fluor_dir = '{}/fluor'.format(virago_dir)
+    cache_dir = '{}/cache'.format(virago_dir)
 
     if not os.path.exists(virago_dir):
         os.makedirs(virago_dir)
@@ -51,17 +57,34 @@ def main_loop(pps_list, mirror, params_dict):
     IRISmarker = params_dict['IRISmarker']
     # IRISmarker_exo = skio.imread('images/IRISmarker_v4_topstack.tif')
 
+    version = params_dict['version']
+    Ab_spot_mode = params_dict['Ab_spot_mode']
+    pass_counter = params_dict['pass_counter']
+    mAb_dict = params_dict['mAb_dict']
+    convert_tiff = params_dict['convert_tiff']
+    show_particles = params_dict['show_particles']
+    particle_labels = params_dict['particle_labels']
+    cache_bytes = int(params_dict['cache_gb'] * 1e9)
+    data_format = params_dict['data_format']
+    threads = params_dict['threads']
+    register_levels = params_dict['register_levels']
 
     # pps_list, mirror = vpipes.mirror_finder(pps_list)
 
-    passes_per_spot = len(pps_list)
-    spot_ID = pps_list[0][:-8]
-    scans_counted = [int(file.split(".")[2]) for file in pps_list]
+    pass_list = sorted(set('.'.join(file.split(".")[:3]) for file in pps_list))
+    passes_per_spot = len(pass_list)
+    spot_ID = pass_list[0][:-4]
+    scans_counted = [int(pass_name.split(".")[2]) for pass_name in pass_list]
     first_scan = min(scans_counted)
 
+    timer = vprofile.StageTimer(int(spot_ID.split('.')[1]))
+
     circle_dict, marker_dict, overlay_dict, shift_dict = {},{},{},{}
+    ##ORB features of each pass, so the baseline pass is only described once
+    feature_dict = {}
 
-    vdata_dict = vpipes.get_vdata_dict(exo_toggle, version="3.x")
+    vdata_dict = vpipes.get_vdata_dict(exo_toggle, version)
+    spot_vdata = []
 
     # missing_data = set(range(1,pass_counter+1)).difference(scans_counted)
     #
@@ -78,84 +101,170 @@ def main_loop(pps_list, mirror, params_dict):
 
     total_shape_df = pd.DataFrame()
 
+    keep_data = ['label','area','centroid','pass_number','max_z_slice',
+                 'eccentricity','ellipticity','curl','circularity',
+                 'validity','z_intensity','perc_contrast','cv_bg','sd_above_med_difference',
+                 'fiber_length','filo_score','roundness_score','channel','fl_intensity'
+                 ]
+
     for scan in range(0,passes_per_spot):##Main Loop for image processing begins here.
-        img_stack = tuple(file for file in pps_list if file.startswith(pps_list[scan]))
+        img_stack = tuple(file for file in pps_list if file.startswith(pass_list[scan] + '.'))
         fluor_files = [file for file in img_stack if file.split(".")[-2] in 'ABC']
         if fluor_files:
             img_stack = tuple(file for file in img_stack if file not in fluor_files)
             print("\nFluorescent channel(s) detected: {}\n".format(fluor_files))
 
-        topstack_img = img_stack[0]
-        name_split = topstack_img.split('.')
-        img_name = '.'.join(name_split[:-1])
+        img_name = pass_list[scan]
+        name_split = img_stack[0].split('.')
         spot_num, pass_num = map(int,name_split[1:3])
 
+        spot_pass_str = '{}.{}'.format(str(spot_num).zfill(3), str(pass_num).zfill(3))
+
+        spot_type = mAb_dict[spot_num][0].split("(")[-1].strip(")")
+
         if name_split[-1] == 'tif':
             tiff_toggle = True
         else:
             tiff_toggle = False
 
-        pic3D = vpipes.load_image(img_stack, tiff_toggle)
+        vdata_file = vpipes.find_file(img_name + '.vdata.txt', vcount_dir)
+
+        if type(vdata_file) != type(None):
+
+            old_vdata_dict = {}
+            with open(vdata_file) as f:
+                for line in f:
+                    (key, val) = line.split(':')
+                    old_vdata_dict[key] = val.strip(' \n')
+
+            if (old_vdata_dict['validity'] == 'True')&(old_vdata_dict['version'] == version):
+                print("Previous data detected. Loading from {}\n".format(vdata_file.split('/')[-1]))
+
+                shift_dict[spot_pass_str] = tuple(map(float, old_vdata_dict['valid_shift'][1:-1].split(',')))
+
+                marker_list = old_vdata_dict['marker_locs'][2:-2].split('), (')
+                marker_dict[spot_pass_str] = list(map(vpipes.coord_parser, marker_list))
+
+                if pass_num == first_scan:
+                    circle_dict[spot_num] = tuple(map(float, old_vdata_dict['spot_coords'][1:-1].split(',')))
+
+            else:
+                print("Previous data detected but not loaded; will be overwritten.\n")
+
+        with timer.stage('load', pass_num):
+            if (tiff_toggle == False) & (convert_tiff == True):
+                vpipes.pgm_to_tiff(vpipes.load_image(img_stack, tiff_toggle), img_name, img_stack,
+                                   tiff_compression=1, archive_pgm=True)
+                pic3D = vpipes.LazyStack(['{}.tif'.format(img_name)], True, mirror=mirror)
+            else:
+                pic3D = vpipes.LazyStack(img_stack, tiff_toggle, mirror=mirror)
 
         print("{} Loaded\n".format(img_name))
 
         validity = True
 
-    #     if convert_tiff == True:
-    #         vpipes.pgm_to_tiff(pic3D, img_name, img_stack,
-    #                            tiff_compression=1, archive_pgm=True)
-    #
         zslice_count, nrows, ncols = pic3D.shape
         total_pixels = nrows*ncols
 
-        if mirror.size == total_pixels:
-            pic3D = pic3D / mirror
-            print("Applying mirror to image stack...\n")
+        if total_pixels == 6981120:
+            minRad =700
+            maxRad =1301
+            cam_micron_per_pix = 3.45
+            pix_per_um = mag / cam_micron_per_pix
+            spacing = 1 / pix_per_um
+            conv_factor = (cam_micron_per_pix / mag)**2
+        else:
+            minRad =350
+            maxRad =601
 
-        pic3D_norm = np.uint8(normalize(pic3D, None, 0, 255, NORM_MINMAX))
+        if pic3D.mirror is not None:
+            print("Applying mirror to image stack...\n")
 
-        pic3D_clahe = vimage.cv2_clahe_3D(pic3D_norm, kernel_size=(1,1), cliplim=4)
+        ##Intermediates are cached by the image files and the settings used on them. Only the planes
+        ##used later are kept: the full stacks take longer to write and read than to recompute
+        pic3D_norm = None
+        with timer.stage('contrast', pass_num):
+            contrast_key, contrast_cache = None, None
+            if cache_bytes > 0:
+                contrast_key = vcache.stage_key('contrast', vcache.file_key(pic3D.files), pic3D.mirror,
+                                                perc_range, vimage.CONTRAST_SETTINGS
+                )
+                contrast_cache = vcache.load(cache_dir, contrast_key)
 
-        pic3D_rescale = vimage.rescale_3D(pic3D_clahe, perc_range=perc_range)
+            if contrast_cache is not None:
+                sd_proj_rescale = contrast_cache['sd_proj_rescale']
+                marker_plane = contrast_cache['marker_plane']
+                print("Contrast adjusted (cached)\n")
+            else:
+                #Normalize, CLAHE and rescale each plane in one pass over the stack.
+                #Many operations are on the Z-stack compressed image.
+                #Several methods to choose, but Standard Deviation works well (8-bit for OpenCV).
+                pic3D_norm, pic3D_rescale, sd_proj_rescale = vimage.contrast_3D(pic3D, perc_range=perc_range,
+                                                                                threads=threads,
+                                                                                **vimage.CONTRAST_SETTINGS
+                )
+                marker_plane = pic3D_rescale[0]
+                print("Contrast adjusted\n")
 
-        print("Contrast adjusted\n")
-        #Many operations are on the Z-stack compressed image.
-        #Several methods to choose, but Standard Deviation works well.
-        # maxmin_proj_rescale = np.max(pic3D_rescale, axis = 0) - np.min(pic3D_rescale, axis = 0)
-        sd_proj_rescale = np.std(pic3D_rescale, axis=0)
-        #Convert to 8-bit for OpenCV comptibility
-        sd_proj_rescale = np.uint8(normalize(sd_proj_rescale, None, 0, 255, NORM_MINMAX))
+                vcache.save(cache_dir, contrast_key, cache_bytes, sd_proj_rescale=sd_proj_rescale,
+                            marker_plane=marker_plane
+                )
 
         if pass_num == 1:
             marker = IRISmarker
         else:
             marker = found_markers
 
-        if img_name not in marker_dict:
-            marker_locs = vimage.marker_finder(pic3D_rescale[0], marker=marker,  thresh=0.6)
-            marker_dict[img_name] = marker_locs
-        else:
-            marker_locs = marker_dict[img_name]
+        with timer.stage('markers', pass_num):
+            if spot_pass_str not in marker_dict:
+                ##Markers only move a little between passes, so they are looked for near the last ones first
+                prev_locs = marker_locs if scan > 0 else None
+                marker_locs = vimage.marker_finder(marker_plane, marker=marker,  thresh=0.6,
+                                                   near=prev_locs
+                )
+                marker_dict[spot_pass_str] = marker_locs
+            else:
+                marker_locs = marker_dict[spot_pass_str]
 
-        pos_plane_list = vquant.measure_focal_plane(pic3D_norm, marker_locs,
-                                                    exo_toggle, marker_shape=IRISmarker.shape
-        )
+            focal_key, focal_cache = None, None
+            if cache_bytes > 0:
+                focal_key = vcache.stage_key('focal', contrast_key, marker_locs, exo_toggle, IRISmarker.shape)
+                focal_cache = vcache.load(cache_dir, focal_key)
 
-        if pos_plane_list != []:
-            pos_plane = max(pos_plane_list)
-        else:
-            pos_plane = zslice_count // 3
+            if focal_cache is not None:
+                pos_plane = int(focal_cache['pos_plane'])
+                pic_rescale_pos = focal_cache['pic_rescale_pos']
+            else:
+                if pic3D_norm is None:
+                    ##The markers were found elsewhere than when the contrast entry was written,
+                    ##so the full stacks are needed after all
+                    pic3D_norm, pic3D_rescale, sd_proj_rescale = vimage.contrast_3D(pic3D, perc_range=perc_range,
+                                                                                    threads=threads,
+                                                                                    **vimage.CONTRAST_SETTINGS
+                    )
+                pos_plane_list = vquant.measure_focal_plane(pic3D_norm, marker_locs,
+                                                            exo_toggle, marker_shape=IRISmarker.shape,
+                                                            threads=threads
+                )
 
-        pic_rescale_pos = pic3D_rescale[pos_plane]
+                if pos_plane_list != []:
+                    pos_plane = max(pos_plane_list)
+                else:
+                    pos_plane = zslice_count // 3
 
-        overlay_dict['.'.join(img_name.split('.')[1:])] = sd_proj_rescale
+                pic_rescale_pos = pic3D_rescale[pos_plane]
+                vcache.save(cache_dir, focal_key, cache_bytes,
+                            pos_plane=pos_plane, pic_rescale_pos=pic_rescale_pos
+                )
+
+        overlay_dict[spot_pass_str] = sd_proj_rescale
 
         print("Using image {} from stack\n".format(str(pos_plane + 1).zfill(3)))
 
-        # if pass_counter <= 15:
-        #     overlay_mode = 'series'
-        # else:
-        overlay_mode = 'baseline'
+        if pass_counter <= 15:
+            overlay_mode = 'series'
+        else:
+            overlay_mode = 'baseline'
 
         if pass_num == first_scan:
             print("First Valid Scan\n")
@@ -163,32 +272,40 @@ def main_loop(pps_list, mirror, params_dict):
             overlay_toggle = False
 
         else:
-            prescan_img, postscan_img = vimage._dict_matcher(overlay_dict, spot_num, pass_num, mode=overlay_mode)
-            overlay_toggle = True
-            # if img_name in shift_dict:
-            #     valid_shift = shift_dict[img_name]
-            # else:
-            ORB_shift = vimage.measure_shift_ORB(prescan_img, postscan_img, ham_thresh=10, show=False)
-                # for coord in ORB_shift:
-                #     if abs(coord) < 75:
-                #
-            valid_shift = ORB_shift
-                #     else: ##In case ORB fails to give a good value
-                #         # overlay_toggle = False
-                #         print("Using alternative shift measurement...\n")
-                #         mean_shift, overlay_toggle = vimage.measure_shift(marker_dict,pass_num,
-                #                                                             spot_num,mode=overlay_mode
-                #         )
-                #         valid_shift = mean_shift
-
-            print("Valid Shift: {}\n".format(valid_shift))
-
-            img_overlay = vimage.overlayer(prescan_img, postscan_img, valid_shift)
-            shape_mask = vimage.shape_mask_shift(shape_mask, valid_shift)
-            img_overlay_difference = np.int16(img_overlay[:,:,1]) - np.int16(img_overlay[:,:,0])
-            median_overlay = np.median(img_overlay_difference)
-            sd_overlay = np.std(img_overlay_difference)
-            print(median_overlay, sd_overlay)
+            with timer.stage('registration', pass_num):
+                prescan_img, postscan_img = vimage._dict_matcher(overlay_dict, spot_num, pass_num, mode=overlay_mode)
+                overlay_toggle = True
+                if spot_pass_str in shift_dict:
+                    valid_shift = shift_dict[spot_pass_str]
+
+                else:
+                    prescan_pass = 1 if overlay_mode == 'baseline' else pass_num - 1
+                    prescan_str = '{}.{}'.format(str(spot_num).zfill(3), str(prescan_pass).zfill(3))
+                    ##Marker locations of both passes, which any shift must agree with
+                    pass_markers = vimage._dict_matcher(marker_dict, spot_num, pass_num, mode=overlay_mode)
+                    reg_shift, reg_method, reg_conf = vregister.register(prescan_img, postscan_img,
+                                                                         feature_cache=feature_dict,
+                                                                         keys=(prescan_str, spot_pass_str),
+                                                                         levels=register_levels,
+                                                                         markers=pass_markers
+                    )
+                    print("Registration confidence: {}\n".format(reg_conf))
+                    if (reg_shift is not None) and all(abs(coord) < 75 for coord in reg_shift):
+                        valid_shift = tuple(round(coord, 0) for coord in reg_shift)
+                    else: ##In case registration fails to give a good value
+                        print("Using alternative shift measurement...\n")
+                        mean_shift, overlay_toggle = vimage.measure_shift(marker_dict,pass_num,
+                                                                            spot_num,mode=overlay_mode
+                        )
+                        valid_shift = mean_shift
+
+                print("Valid Shift: {}\n".format(valid_shift))
+
+                shape_mask = vimage.shape_mask_shift(shape_mask, valid_shift)
+                img_overlay_difference = vimage.overlay_difference(prescan_img, postscan_img, valid_shift)
+                median_overlay = np.median(img_overlay_difference)
+                sd_overlay = np.std(img_overlay_difference)
+                print(median_overlay, sd_overlay)
 
             # overlay_name = "{}_overlay_{}".format(img_name, overlay_mode)
             # vimage.gen_img_deets(img_overlay_difference, name=overlay_name, savedir=overlay_dir)
@@ -206,30 +323,23 @@ def main_loop(pps_list, mirror, params_dict):
             spot_coords = (shift_x, shift_y, spot_coords[2])
 
         else: #Find the Antibody spot if it has not already been determined
-            circles = None
-            cannyMax = 200
-            cannyMin = 100
-            while type(circles) == type(None):
-                circles = HoughCircles(sd_proj_rescale, HOUGH_GRADIENT,1,minDist=500,
-                                           param1=cannyMax, param2=cannyMin,
-                                           minRadius=300, maxRadius=600
-                )
-                cannyMax-=50
-                cannyMin-=25
-            spot_coords = tuple(map(lambda x: round(x,0), circles[0][0]))
-            print("Spot center coordinates (row, column, radius): {}\n".format(spot_coords))
+            with timer.stage('spot_finder', pass_num):
+                rad_range = vspot.radius_range(mAb_dict, pix_per_um, (minRad, maxRad))
+                spot_coords = vspot.find_spot(sd_proj_rescale, rad_range, min_dist=500)
+                print("Spot center coordinates (row, column, radius): {}\n".format(spot_coords))
 
         circle_dict[spot_num] = spot_coords
 
-        row, col = np.ogrid[:nrows,:ncols]
-        width = col - spot_coords[0]
-        height = row - spot_coords[1]
-        rad = spot_coords[2] - 25
-        disk_mask = (width**2 + height**2 > rad**2)
+        with timer.stage('masks', pass_num):
+            row, col = np.ogrid[:nrows,:ncols]
+            width = col - spot_coords[0]
+            height = row - spot_coords[1]
+            rad = spot_coords[2] - 25
+            disk_mask = (width**2 + height**2 > rad**2)
 
-        marker_mask, found_markers = vimage.marker_masker(pic3D_rescale[0], marker_locs, marker)
+            marker_mask, found_markers = vimage.marker_masker(marker_plane, marker_locs, marker)
 
-        full_mask = disk_mask + marker_mask
+            full_mask = disk_mask + marker_mask
 
 
 
@@ -253,85 +363,104 @@ def main_loop(pps_list, mirror, params_dict):
         #     pic_to_show = sd_proj_rescale
         # else:
 
-        if pass_num == 1:
+        if pass_num == first_scan:
             pic_to_show = sd_proj_rescale
         else:
             pic_to_show = img_overlay_difference
 
     #*********************************************************************************************#
-        with warnings.catch_warnings():
-            ##RuntimeWarning ignored: invalid values are expected
-            warnings.simplefilter("ignore")
-            warnings.warn(RuntimeWarning)
+        with timer.stage('classify', pass_num):
+            classify_key, classify_cache = None, None
+            if cache_bytes > 0:
+                shape_settings = (vquant.SHAPE_CLASSES, vquant.SHAPE_SMOOTH_SIGMA, vquant.SHAPE_THRESHOLDS)
+                if pass_num > first_scan:
+                    classify_key = vcache.stage_key('classify', contrast_key, pos_plane, full_mask, shape_mask,
+                                                    Ab_spot_mode, exo_toggle, shape_settings
+                    )
+                else:
+                    classify_key = vcache.stage_key('classify', contrast_key, pos_plane, full_mask,
+                                                    Ab_spot_mode, exo_toggle, shape_settings
+                    )
+                classify_cache = vcache.load(cache_dir, classify_key)
+
+            if classify_cache is not None:
+                pix_area = int(classify_cache['pix_area'])
+                sd_proj_bg_median = float(classify_cache['sd_proj_bg_median'])
+                sd_proj_bg_stdev = float(classify_cache['sd_proj_bg_stdev'])
+                ridge_mask = classify_cache['ridge_mask']
+                sphere_mask = classify_cache['sphere_mask']
+                ridge_mask_s = classify_cache['ridge_mask_s']
+                pic_binary = classify_cache['pic_binary']
+                print("Median intensity of spot background={}, SD={} (cached)".format(round(sd_proj_bg_median,4),
+                                                                                      round(sd_proj_bg_stdev,4))
+                )
+            else:
+                with warnings.catch_warnings():
+                    ##RuntimeWarning ignored: invalid values are expected
+                    warnings.simplefilter("ignore")
+                    warnings.warn(RuntimeWarning)
 
-            shapedex = shape_index(pic_rescale_pos)
-            shapedex = np.ma.array(shapedex,mask = full_mask).filled(fill_value = np.nan)
-            if pass_num > first_scan:
-                shapedex = np.ma.array(shapedex,mask = shape_mask).filled(fill_value = -1)
+                    shapedex = shape_index(pic_rescale_pos)
 
-            shapedex_gauss = gaussian_filter(shapedex, sigma=1)
+                    shapedex = np.ma.array(shapedex,mask = full_mask).filled(fill_value = np.nan)
+                    if pass_num > first_scan:
+                        shapedex = np.ma.array(shapedex,mask = shape_mask).filled(fill_value = -1)
 
-        pix_area = np.count_nonzero(np.invert(np.isnan(shapedex)))
-        area_sqmm = round((pix_area * conv_factor) * 1e-6, 6)
+                    shapedex_gauss = gaussian_filter(shapedex, sigma=vquant.SHAPE_SMOOTH_SIGMA)
 
-        ##Pixel topology classifications
-        background = 0
-        ridge = 0.5
-        sphere = 1
-
-        bg_rows,bg_cols = zip(*vquant.classify_shape(shapedex, sd_proj_rescale, background,
-                                                     delta=0.25, intensity=0)
-        )
-        sd_proj_bg = sd_proj_rescale[bg_rows,bg_cols]
-
-        sd_proj_bg_median = np.median(sd_proj_bg)##Important
-        sd_proj_bg_stdev = np.std(sd_proj_bg)
-        print("Median intensity of spot background={}, SD={}".format(round(sd_proj_bg_median,4),
-                                                                     round(sd_proj_bg_stdev,4))
-        )
-
-        # if Ab_spot_mode == True:
-            # if exo_toggle == True:
-        ridge_thresh   = sd_proj_bg_median*3.5
-        sphere_thresh  = sd_proj_bg_median*2.5
-        ridge_thresh_s = sd_proj_bg_median*3.5
-            # else:
-            #     ridge_thresh   = sd_proj_bg_median+sd_proj_bg_stdev*2
-            #     sphere_thresh  = sd_proj_bg_median+sd_proj_bg_stdev*2
-            #     ridge_thresh_s = sd_proj_bg_median+sd_proj_bg_stdev*3
-        # else:
-        #     ridge_thresh   = sd_proj_bg_median+sd_proj_bg_stdev*2.75
-        #     sphere_thresh  = sd_proj_bg_median+sd_proj_bg_stdev*2.75
-        #     ridge_thresh_s = sd_proj_bg_median+sd_proj_bg_stdev*2.75
+                pix_area = np.count_nonzero(np.invert(np.isnan(shapedex)))
+
+                ##Pixel topology classifications
+                background, ridge, sphere, ridge_s = (vquant.SHAPE_CLASSES[name] for name in
+                                                      ('background', 'ridge', 'sphere', 'ridge_s'))
+
+                bg_mask = vquant.classify_shape_mask(shapedex, sd_proj_rescale, background[0],
+                                                     delta=background[1], intensity=0
+                )
+                sd_proj_bg = sd_proj_rescale[bg_mask]
 
-        ridge_list = vquant.classify_shape(shapedex, sd_proj_rescale, ridge,
-                                           delta=0.25, intensity=ridge_thresh
-        )
+                sd_proj_bg_median = np.median(sd_proj_bg)##Important
+                sd_proj_bg_stdev = np.std(sd_proj_bg)
+                print("Median intensity of spot background={}, SD={}".format(round(sd_proj_bg_median,4),
+                                                                             round(sd_proj_bg_stdev,4))
+                )
 
-        sphere_list = vquant.classify_shape(shapedex, sd_proj_rescale, sphere,
-                                            delta=0.2, intensity=sphere_thresh
-        )
+                ridge_thresh, sphere_thresh, ridge_thresh_s = vquant.shape_thresholds(sd_proj_bg_median,
+                                                                                      sd_proj_bg_stdev,
+                                                                                      Ab_spot_mode, exo_toggle
+                )
 
-        ridge_list_s = vquant.classify_shape(shapedex_gauss, sd_proj_rescale, ridge,
-                                             delta=0.3, intensity=ridge_thresh_s
-        )
+                ridge_mask = vquant.classify_shape_mask(shapedex, sd_proj_rescale, ridge[0],
+                                                        delta=ridge[1], intensity=ridge_thresh
+                )
 
-        pix_list = ridge_list + sphere_list
-        ridge_list_s = list(set(pix_list) - set(ridge_list_s))
-        pix_list = pix_list + ridge_list_s
+                sphere_mask = vquant.classify_shape_mask(shapedex, sd_proj_rescale, sphere[0],
+                                                         delta=sphere[1], intensity=sphere_thresh
+                )
 
-        pic_binary = np.zeros_like(sd_proj_rescale, dtype=int)
+                ridge_mask_s = vquant.classify_shape_mask(shapedex_gauss, sd_proj_rescale, ridge_s[0],
+                                                          delta=ridge_s[1], intensity=ridge_thresh_s
+                )
 
-        if not pix_list == []:
-            rows,cols = zip(*pix_list)
+                pix_mask = ridge_mask | sphere_mask
+                ridge_mask_s = pix_mask & ~ridge_mask_s
 
-            pic_binary[rows,cols] = 1
+                pic_binary = pix_mask.astype(int)
 
-            pic_binary = binary_fill_holes(pic_binary)
+                if pix_mask.any():
+                    pic_binary = binary_fill_holes(pic_binary)
+
+                vcache.save(cache_dir, classify_key, cache_bytes, pix_area=pix_area,
+                            sd_proj_bg_median=sd_proj_bg_median, sd_proj_bg_stdev=sd_proj_bg_stdev,
+                            ridge_mask=ridge_mask, sphere_mask=sphere_mask, ridge_mask_s=ridge_mask_s,
+                            pic_binary=pic_binary
+                )
+
+        area_sqmm = round((pix_area * conv_factor) * 1e-6, 6)
 
     #*********************************************************************************************#
         vdata_dict.update({'img_name': img_name,
-                           # 'spot_type': spot_type,
+                           'spot_type': spot_type,
                            'area_sqmm': area_sqmm,
                            'valid_shift': valid_shift,
                            'overlay_mode': overlay_mode,
@@ -343,25 +472,25 @@ def main_loop(pps_list, mirror, params_dict):
 
     #*********************************************************************************************#
         ##EXTRACT DATA FROM THE BINARY IMAGE
-        prop_list =['label','coords','area','centroid','moments_central','bbox',
-                    'filled_image','major_axis_length','minor_axis_length']
+        with timer.stage('extract', pass_num):
+            prop_list =['label','coords','area','centroid','moments_central','bbox',
+                        'filled_image','major_axis_length','minor_axis_length']
 
-        shape_df = vquant.binary_data_extraction(pic_binary, pic3D[pos_plane], prop_list, pix_range=(3,500))
-        print('S')
+            shape_df, pic_label = vquant.binary_data_extraction(pic_binary, pic3D[pos_plane], prop_list,
+                                                                pix_range=(3,500), return_label=True
+            )
         if not shape_df.empty:
 
-            particle_mask = vquant.particle_masker(pic_binary, shape_df, pass_num, first_scan)
+            with timer.stage('particle_mask', pass_num):
+                particle_mask = vquant.particle_masker(pic_binary, shape_df, pass_num, first_scan)
 
-            if pass_num == first_scan:
-                shape_mask = binary_dilation(particle_mask, iterations=3)
-            else:
-                shape_mask = np.add(shape_mask, binary_dilation(particle_mask, iterations=2))
+                if pass_num == first_scan:
+                    shape_mask = binary_dilation(particle_mask, iterations=3)
+                else:
+                    shape_mask = np.add(shape_mask, binary_dilation(particle_mask, iterations=2))
 
-            shape_df['pass_number'] = [pass_num]*len(shape_df.index)
-            shape_df['coords'] = shape_df.coords.apply(lambda a: [tuple(x) for x in a])
-            shape_df['bbox'] = shape_df.bbox.map(vquant.bbox_verts)
-
-            print('R')
+                shape_df['pass_number'] = [pass_num]*len(shape_df.index)
+                shape_df['bbox'] = shape_df.bbox.map(vquant.bbox_verts)
         else:
             print("----No valid particle shapes----\n")
             vdata_dict.update({'total_valid_particles': 0, 'validity':False})
@@ -370,111 +499,93 @@ def main_loop(pps_list, mirror, params_dict):
             with open('{}/{}.vdata.txt'.format(vcount_dir,img_name),'w') as f:
                 for k,v in vdata_dict.items():
                     f.write('{}: {}\n'.format(k,v))
+            spot_vdata.append(dict(vdata_dict))
+
+            with timer.stage('particle_image', pass_num):
+                png_path = '{}/{}.{}.png'.format(img_dir, img_name, spot_type)
+                vrender.submit(png_path, vgraph.save_particle_image,
+                               png_path, pic_to_show, shape_df, spot_coords,
+                               pix_per_um=pix_per_um,
+                               show_particles=False,
+                               cv_cutoff=cv_cutoff,
+                               r2_cutoff=0,
+                               scalebar=15, markers=marker_locs,
+                               exo_toggle=exo_toggle
+                )
+            print("#******************PNG submitted for {}************************#".format(img_name))
 
             continue
     #*********************************************************************************************#
-        filo_pts_tot, round_pts_tot  = [],[]
-        z_intensity_list, max_z_slice_list, max_z_stacks, shape_validity = [],[],[],[]
-        greatest_max_list, sd_above_med_difference = [],[]
-        intensity_increase_list = []
-        print('Measuring particle intensities...\n')
-        for coord_array in shape_df.coords:
-
-            coord_set = set(coord_array)
-            filo_pts = len(coord_set.intersection(ridge_list))
-
-            filo_pts = filo_pts + (len(coord_set.intersection(ridge_list_s)) * 0.15)
-
-            round_pts = len(coord_set.intersection(sphere_list))
-
-            filo_pts_tot.append(filo_pts)
-            round_pts_tot.append(round_pts)
-
-            # if pic3D.ndim > 2:
-
-            all_z_stacks = np.array([pic3D[:,coords[0],coords[1]] for coords in coord_array])
-            greatest_max = np.max(all_z_stacks)
-            max_z_stack = all_z_stacks[np.where(all_z_stacks == np.max(all_z_stacks))[0][0]].tolist()
-            if max_z_stack[0] >= max_z_stack[-1]:
-                shape_validity.append(True)
-            else:
-                shape_validity.append(False)
-            maxmax_z = max(max_z_stack)
-            max_z_slice = max_z_stack.index(maxmax_z)
-            z_intensity = (maxmax_z - min(max_z_stack))*100
-
-            std_z_stack = list(np.round(np.std(all_z_stacks, axis=0),4))
-
-            max_z_slice_list.append(max_z_slice)
-            max_z_stacks.append(max_z_stack)
-            z_intensity_list.append(z_intensity)
-            greatest_max_list.append(greatest_max)
+        with timer.stage('z_profiles', pass_num):
+            print('Measuring particle intensities...\n')
+            filo_pts_tot = (vquant.label_pixel_counts(pic_label, ridge_mask, shape_df.label)
+                            + vquant.label_pixel_counts(pic_label, ridge_mask_s, shape_df.label) * 0.15
+            )
+            round_pts_tot = vquant.label_pixel_counts(pic_label, sphere_mask, shape_df.label)
 
             if (pass_num > first_scan) & (overlay_toggle == True):
-                intensity_increase = max([img_overlay_difference[coords[0],coords[1]] for coords in coord_array])
-                intensity_increase_list.append(intensity_increase)
+                diff_img = img_overlay_difference
             else:
-                intensity_increase_list = [np.nan] * len(shape_df)
-
-        print('N')
-
-        shape_df['max_z_slice'] = max_z_slice_list
-        shape_df['max_z_stack'] = max_z_stacks
-        shape_df['z_intensity'] = z_intensity_list
-
-        shape_df['greatest_max'] = greatest_max_list
-        shape_df['validity'] = shape_validity
+                diff_img = None
+            profile_df = vquant.measure_z_profiles(pic_label, shape_df.label, pic3D, diff_img=diff_img)
 
-        shape_df['filo_points'] = filo_pts_tot
-        shape_df['round_points'] = round_pts_tot
+            shape_df['max_z_slice'] = profile_df.max_z_slice.values
+            shape_df['max_z_stack'] = profile_df.max_z_stack.values
+            shape_df['z_intensity'] = profile_df.z_intensity.values
 
-        shape_df['intensity_increase'] = intensity_increase_list
+            shape_df['greatest_max'] = profile_df.greatest_max.values
+            shape_df['validity'] = profile_df.validity.values
 
-        bbox_pixels = [vquant.get_bbox_pixels(bbox, pic3D[z])
-                      for i, z, bbox in shape_df[['max_z_slice','bbox']].itertuples()
-        ]
+            shape_df['filo_points'] = filo_pts_tot
+            shape_df['round_points'] = round_pts_tot
 
-        median_bg_list, shape_df['cv_bg'] = zip(*map(lambda x: (np.median(x),
-                                                                np.std(x)/np.mean(x)),
-                                                                bbox_pixels)
-        )
-
-        shape_df['perc_contrast'] = ((shape_df['greatest_max'] - median_bg_list)*100
-                                                / median_bg_list
-        )
-
-        shape_df.loc[shape_df.perc_contrast <= 0,'validity'] = False
-        shape_df.loc[shape_df.cv_bg > cv_cutoff,'validity'] = False
-        shape_df.loc[shape_df.intensity_increase < 40,'validity'] = False
-
-        # if len(shape_df) > 1:
-        #     regression = smapi.OLS(shape_df.z_intensity, shape_df.perc_contrast).fit()
-        #     outlier_df = regression.outlier_test()
-        #     shape_df.loc[outlier_df['bonf(p)'] < 0.5, 'validity'] = False
-
-        shape_df = vquant.remove_overlapping_objs(shape_df, radius=10)
+            if diff_img is not None:
+                shape_df['intensity_increase'] = profile_df.intensity_increase.values
+            else:
+                shape_df['intensity_increase'] = [np.nan] * len(shape_df)
+
+        with timer.stage('background', pass_num):
+            median_bg, shape_df['cv_bg'] = vquant.bbox_background(shape_df.bbox, shape_df.max_z_slice, pic3D)
+
+            shape_df['perc_contrast'] = ((shape_df['greatest_max'] - median_bg)*100
+                                                    / median_bg
+            )
+
+            shape_df.loc[shape_df.perc_contrast <= 0,'validity'] = False
+            shape_df.loc[shape_df.cv_bg > cv_cutoff,'validity'] = False
+            shape_df.loc[shape_df.intensity_increase < 40,'validity'] = False
+
+        with timer.stage('outliers', pass_num):
+            if len(shape_df) > 1:
+                regression = smapi.OLS(shape_df.z_intensity, shape_df.perc_contrast).fit()
+                outlier_df = regression.outlier_test()
+                shape_df.loc[outlier_df['bonf(p)'] < 0.5, 'validity'] = False
+        with timer.stage('overlaps', pass_num):
+            shape_df = vquant.remove_overlapping_objs(shape_df, radius=10)
     #---------------------------------------------------------------------------------------------#
         ##Filament Measurements
-        shape_df['circularity'] = list(map(lambda A,P: round((4*np.pi*A)/(perimeter(P)**2),4),
-                                                shape_df.area, shape_df.filled_image))
+        with timer.stage('shape_metrics', pass_num):
+            shape_df['circularity'] = list(map(lambda A,P: round((4*np.pi*A)/(perimeter(P)**2),4),
+                                                    shape_df.area, shape_df.filled_image))
 
-        shape_df['ellipticity'] = round(shape_df.major_axis_length/shape_df.minor_axis_length,4)#max val = 1
+            shape_df['ellipticity'] = round(shape_df.major_axis_length/shape_df.minor_axis_length,4)#max val = 1
 
-        shape_df['eccentricity'] = shape_df.moments_central.map(vquant.eccentricity)
+            shape_df['eccentricity'] = shape_df.moments_central.map(vquant.eccentricity)
 
-        shape_df = shape_df[(shape_df['filo_points'] + shape_df['round_points']) >= 1]
+            shape_df = shape_df[(shape_df['filo_points'] + shape_df['round_points']) >= 1]
 
-        shape_df['filo_score'] = ((shape_df['filo_points'] / shape_df['area'])
-                                 -(shape_df['round_points'] / shape_df['area'])
-        )
-        shape_df['roundness_score'] = ((shape_df['round_points'] / shape_df['area']))
+            shape_df['filo_score'] = ((shape_df['filo_points'] / shape_df['area'])
+                                     -(shape_df['round_points'] / shape_df['area'])
+            )
+            shape_df['roundness_score'] = ((shape_df['round_points'] / shape_df['area']))
     #---------------------------------------------------------------------------------------------#
-        filolen_df = pd.DataFrame([vfilo.measure_fiber_length(coords, spacing=spacing)
-                                    for coords in shape_df.coords],
-                                   columns=['fiber_length','vertices'], index=shape_df.index)
-        shape_df = pd.concat([shape_df, filolen_df],axis=1)
+        with timer.stage('fiber_length', pass_num):
+            filolen_df = pd.DataFrame([vfilo.measure_fiber_length(coords, spacing=spacing)
+                                        for coords in shape_df.coords],
+                                       columns=['fiber_length','vertices'], index=shape_df.index)
+            shape_df = pd.concat([shape_df, filolen_df],axis=1)
 
-        shape_df['curl'] = (shape_df['major_axis_length'] * spacing) / shape_df['fiber_length']
+            shape_df['curl'] = (shape_df['major_axis_length'] * spacing) / shape_df['fiber_length']
 
         total_particles = len(shape_df)
         shape_df['channel'] = ['V'] * total_particles
@@ -498,34 +609,48 @@ def main_loop(pps_list, mirror, params_dict):
         total_shape_df = pd.concat([total_shape_df, shape_df], axis=0, sort=False)
         # total_shape_df.reset_index(drop=True, inplace=True)
 
-        keep_data = ['label','area','centroid','pass_number','max_z_slice',
-                    'eccentricity','ellipticity','curl','circularity',
-                     'validity','z_intensity','perc_contrast','cv_bg','sd_above_med_difference',
-                     'fiber_length','filo_score','roundness_score','channel','fl_intensity'
-                     ]
-
         vdata_dict.update({'total_valid_particles': total_valid_particles, 'validity':validity})
 
         with open('{}/{}.vdata.txt'.format(vcount_dir,img_name),'w') as f:
             for k,v in vdata_dict.items():
                 f.write('{}: {}\n'.format(k,v))
+        spot_vdata.append(dict(vdata_dict))
 
     #---------------------------------------------------------------------------------------------#
-        vgraph.gen_particle_image(pic_to_show,shape_df,spot_coords,
-                                  pix_per_um=pix_per_um,
-                                  show_particles=True,
-                                  cv_cutoff=cv_cutoff,
-                                  r2_cutoff=0,
-                                  scalebar=15, markers=marker_locs,
-                                  exo_toggle=exo_toggle
-        )
-        savefig('{}/{}.png'.format(img_dir, img_name), dpi = 96)
-        clf(); close('all')
-        print("#******************PNG generated for {}************************#\n\n".format(img_name))
+        with timer.stage('particle_image', pass_num):
+            png_path = '{}/{}.{}.png'.format(img_dir, img_name, spot_type)
+            vrender.submit(png_path, vgraph.save_particle_image,
+                           png_path, pic_to_show, shape_df, spot_coords,
+                           pix_per_um=pix_per_um,
+                           show_particles=show_particles,
+                           cv_cutoff=cv_cutoff,
+                           r2_cutoff=0,
+                           scalebar=15, markers=marker_locs,
+                           exo_toggle=exo_toggle,
+                           show_labels=particle_labels
+            )
+        print("#******************PNG submitted for {}************************#\n\n".format(img_name))
+        with timer.stage('defocus_graph', pass_num):
+            if not (shape_df.empty) | np.all(shape_df.validity == False):
+                vrender.submit('{}/{}.png'.format(vcount_dir, img_name), vgraph.defocus_profile_graph,
+                               valid_shape_df, pass_num, zslice_count,
+                               vcount_dir, exo_toggle, img_name
+                )
     #---------------------------------------------------------------------------------------------#
-    total_shape_df.to_csv('{}/{}.particle_data.csv'.format(vcount_dir, spot_ID),
-                          columns = keep_data
-    )
+    ##Spot-level stages have no pass number
+    with timer.stage('write_data', None):
+        if data_format == 'parquet':
+            spot_num = int(spot_ID.split('.')[1])
+            vstore.write_table(vstore.particle_frame(total_shape_df, keep_data, spot_num),
+                               '{}/{}.particle_data.parquet'.format(vcount_dir, spot_ID)
+            )
+            vstore.write_table(vstore.vdata_frame(spot_vdata), '{}/{}.vdata.parquet'.format(vcount_dir, spot_ID))
+        else:
+            total_shape_df.to_csv('{}/{}.particle_data.csv'.format(vcount_dir, spot_ID),
+                                  columns = keep_data
+            )
+
+    return spot_vdata, zslice_count, timer.records
 #*********************************************************************************************#
 if __name__ == "__main__":
 